@@ -0,0 +1,282 @@
+# --- START OF FILE assets/history_store.py ---
+# История диалогов пользователей в SQLite (WAL) вместо JSON-файла на пользователя.
+#   * сообщения только дописываются (без перезаписи файла целиком), старые сверх HISTORY_MAX_MESSAGES периодически удаляются;
+#   * последние сообщения активных пользователей держатся в памяти (LRU на HISTORY_CACHE_SIZE пользователей),
+#     база читается только при первом обращении к пользователю;
+#   * запись идет в фоновом потоке: обработчик запроса не ждет диска, одновременные вкладки не портят историю;
+#     append/clear не читают базу (только кэш и очередь), поэтому их можно вызывать прямо из цикла событий;
+#   * при промахе кэша чтение ждет только отложенные записи этого пользователя, а не всю очередь.
+# Старые файлы logs/user_history/history_<user>.json переносятся в базу при первом запуске. В имени файла логин
+# был очищен (оставались только буквы, цифры, "_" и "-"), поэтому файл сопоставляется с настоящим логином по списку
+# пользователей (configure_history_users); файлы без однозначного пользователя остаются на месте с предупреждением.
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+LOGS_DIR = "logs"
+LEGACY_HISTORY_DIR = os.path.join(LOGS_DIR, "user_history")
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", os.path.join(LOGS_DIR, "history.sqlite"))
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "256")) # Пользователей в памяти
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "50")) # Сообщений на пользователя (как прежний MAX_HISTORY_LEN)
+WRITE_BATCH_SIZE = 256 # Операций записи в одной транзакции
+
+_STOP = object()
+
+def legacy_history_name(username: str) -> str:
+    """Логин в имени старого файла истории (как в прежнем get_history_filepath)."""
+    return "".join(c for c in username if c.isalnum() or c in ('_', '-')).rstrip()
+
+def _legacy_name(filename: str) -> Optional[str]:
+    if filename.startswith("history_") and filename.endswith(".json"):
+        return filename[len("history_"):-len(".json")] or None
+    return None
+
+def _legacy_name_map(known_users: Iterable[str]) -> Dict[str, Optional[str]]:
+    # Очищенное имя -> настоящий логин; None, если имя получается у нескольких логинов
+    mapping: Dict[str, Optional[str]] = {}
+    for username in known_users:
+        name = legacy_history_name(username)
+        mapping[name] = username if mapping.get(name, username) == username else None
+    return mapping
+
+class HistoryStore:
+    """История сообщений {"role", "content"} по пользователям. Потокобезопасна."""
+
+    def __init__(self, path: str = HISTORY_DB_PATH, cache_size: int = HISTORY_CACHE_SIZE,
+                 max_messages: int = HISTORY_MAX_MESSAGES, legacy_dir: Optional[str] = LEGACY_HISTORY_DIR,
+                 known_users: Optional[Iterable[str]] = None):
+        self.path = path
+        self.cache_size = max(1, cache_size)
+        self.max_messages = max(1, max_messages)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._read_conn = self._connect()
+        self._read_conn.execute("""CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL, role TEXT NOT NULL,
+            content TEXT NOT NULL, created REAL NOT NULL)""")
+        self._read_conn.execute("CREATE INDEX IF NOT EXISTS messages_user ON messages (username, id)")
+        self._read_conn.commit()
+        self._read_lock = threading.Lock()
+        self._cache: "OrderedDict[str, Deque[Dict[str, str]]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._writes_done = threading.Condition(self._cache_lock) # Сигнал писателя: записи пользователей дошли до базы
+        self._pending: Dict[str, int] = {} # Пользователь -> операций в очереди
+        self._versions: Dict[str, int] = {} # Пользователь -> счетчик поставленных операций (заметить запись во время чтения)
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._appended_since_trim: Dict[str, int] = {}
+        if legacy_dir and os.path.isdir(legacy_dir):
+            self._migrate_legacy(legacy_dir, known_users)
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # В WAL достаточно: при сбое теряются только последние транзакции
+        return conn
+
+    # --- Перенос старых JSON-файлов ---
+    def _migrate_legacy(self, legacy_dir: str, known_users: Optional[Iterable[str]]) -> None:
+        names = _legacy_name_map(known_users or [])
+        migrated = skipped = 0
+        for filename in sorted(os.listdir(legacy_dir)):
+            name = _legacy_name(filename)
+            if name is None:
+                continue
+            filepath = os.path.join(legacy_dir, filename)
+            username = names.get(name)
+            if username is None: # Строки под очищенным именем не нашел бы ни один настоящий логин
+                reason = "несколько пользователей с таким именем" if name in names else "пользователь не найден"
+                sys.stderr.write(f"⚠️ История {filepath} не перенесена ({reason}), файл оставлен на месте.\n")
+                skipped += 1
+                continue
+            try:
+                with open(filepath, "r", encoding="utf-8") as f:
+                    history = json.load(f)
+                rows = [(username, str(item["role"]), str(item["content"]), time.time())
+                        for item in history[-self.max_messages:] if isinstance(item, dict) and 'role' in item and 'content' in item]
+                with self._read_conn:
+                    self._read_conn.executemany("INSERT INTO messages (username, role, content, created) VALUES (?, ?, ?, ?)", rows)
+                os.replace(filepath, filepath + ".migrated")
+                migrated += 1
+            except Exception as e:
+                sys.stderr.write(f"⚠️ Не удалось перенести историю {filepath}: {e}\n")
+        if migrated:
+            print(f"✅ История {migrated} пользователей перенесена из {legacy_dir} в {self.path}.")
+        if skipped:
+            print(f"⚠️ Не перенесено файлов истории: {skipped} (см. предупреждения выше).")
+
+    # --- Чтение ---
+    def _load(self, username: str) -> Deque[Dict[str, str]]:
+        while True:
+            with self._cache_lock:
+                messages = self._cache.get(username)
+                if messages is not None:
+                    self._cache.move_to_end(username)
+                    return messages
+                # Промах кэша: сначала в базу дописываются отложенные записи этого пользователя (он мог быть вытеснен из кэша)
+                while self._pending.get(username):
+                    self._writes_done.wait()
+                version = self._versions.get(username, 0)
+            with self._read_lock:
+                rows = self._read_conn.execute(
+                    "SELECT role, content FROM messages WHERE username = ? ORDER BY id DESC LIMIT ?",
+                    (username, self.max_messages)).fetchall()
+            loaded: Deque[Dict[str, str]] = deque(({"role": role, "content": content} for role, content in reversed(rows)),
+                                                  maxlen=self.max_messages)
+            with self._cache_lock:
+                messages = self._cache.get(username) # Другой поток мог загрузить раньше
+                if messages is None:
+                    if self._versions.get(username, 0) != version:
+                        continue # Во время чтения пришла новая запись — прочитанное могло устареть
+                    messages = self._cache[username] = loaded
+                self._cache.move_to_end(username)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+                return messages
+
+    def get_history(self, username: str) -> List[Dict[str, str]]:
+        """Вся хранимая история пользователя (не более max_messages сообщений), копия."""
+        messages = self._load(username)
+        with self._cache_lock:
+            return [dict(item) for item in messages]
+
+    def recent_messages(self, username: str, limit: int) -> List[Dict[str, str]]:
+        """Последние limit сообщений — для промпта не нужна вся история."""
+        if limit <= 0:
+            return []
+        messages = self._load(username)
+        with self._cache_lock:
+            return [dict(item) for item in list(messages)[-limit:]]
+
+    # --- Запись (в фоне) ---
+    def append_turn(self, username: str, question: str, answer: str) -> None:
+        """Дописывает пару вопрос-ответ."""
+        self.append(username, [{"role": "user", "content": question}, {"role": "assistant", "content": answer}])
+
+    def append(self, username: str, messages: List[Dict[str, str]]) -> None:
+        """Не читает базу: дописывает в кэш (если пользователь в нем) и ставит запись в очередь."""
+        items = [{"role": str(m["role"]), "content": str(m["content"])} for m in messages]
+        if not items:
+            return
+        now = time.time()
+        with self._cache_lock:
+            cached = self._cache.get(username)
+            if cached is not None: # Не в кэше — следующее чтение загрузит из базы после этой записи
+                cached.extend(items)
+                self._cache.move_to_end(username)
+            self._enqueue(("append", username, [(username, m["role"], m["content"], now) for m in items]))
+
+    def clear(self, username: str) -> None:
+        with self._cache_lock:
+            self._cache[username] = deque(maxlen=self.max_messages)
+            self._cache.move_to_end(username)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            self._enqueue(("clear", username, None))
+
+    def _enqueue(self, operation: Tuple[str, str, Any]) -> None:
+        # Вызывается под _cache_lock: порядок в очереди совпадает с порядком изменений кэша
+        username = operation[1]
+        self._pending[username] = self._pending.get(username, 0) + 1
+        self._versions[username] = self._versions.get(username, 0) + 1
+        self._queue.put(operation)
+
+    def _finish(self, batch: List[Any]) -> None:
+        with self._cache_lock:
+            for operation in batch:
+                if operation is _STOP:
+                    continue
+                username = operation[1]
+                remaining = self._pending.get(username, 0) - 1
+                if remaining > 0:
+                    self._pending[username] = remaining
+                else:
+                    self._pending.pop(username, None)
+            self._writes_done.notify_all()
+
+    def _apply(self, conn: sqlite3.Connection, operation: Tuple[str, str, Any]) -> None:
+        kind, username, rows = operation
+        if kind == "append":
+            conn.executemany("INSERT INTO messages (username, role, content, created) VALUES (?, ?, ?, ?)", rows)
+            appended = self._appended_since_trim.get(username, 0) + len(rows)
+            if appended >= self.max_messages: # Периодическое удаление старых сообщений (не на каждой записи)
+                conn.execute("DELETE FROM messages WHERE username = ? AND id NOT IN "
+                             "(SELECT id FROM messages WHERE username = ? ORDER BY id DESC LIMIT ?)",
+                             (username, username, self.max_messages))
+                appended = 0
+            self._appended_since_trim[username] = appended
+        elif kind == "clear":
+            conn.execute("DELETE FROM messages WHERE username = ?", (username,))
+            self._appended_since_trim.pop(username, None)
+
+    def _write_loop(self) -> None:
+        conn = self._connect()
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with conn:
+                    for operation in batch:
+                        if operation is _STOP:
+                            stopping = True
+                        else:
+                            self._apply(conn, operation)
+            except Exception as e:
+                sys.stderr.write(f"❌ Ошибка записи истории в {self.path}: {e}\n")
+            finally:
+                self._finish(batch) # И при ошибке: ожидающие чтения не должны зависнуть
+                for _ in batch:
+                    self._queue.task_done()
+        conn.close()
+
+    def queue_depth(self) -> int:
+        """Операций записи, ожидающих фонового потока."""
+        return self._queue.qsize()
+
+    def flush(self) -> None:
+        """Ждет, пока отложенные записи попадут в базу."""
+        self._queue.join()
+
+    def close(self) -> None:
+        if self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+        with self._read_lock:
+            self._read_conn.close()
+
+# --- Общий экземпляр для приложения ---
+_history_store: Optional[HistoryStore] = None
+_history_store_lock = threading.Lock()
+_history_users: List[str] = [] # Логины для сопоставления старых файлов истории
+
+def configure_history_users(usernames: Iterable[str]) -> None:
+    """Задает логины приложения до первого обращения к истории: по ним переносятся старые JSON-файлы."""
+    global _history_users
+    with _history_store_lock:
+        _history_users = list(usernames)
+        if _history_store is not None:
+            sys.stderr.write("⚠️ История уже открыта: список пользователей применится только при следующем запуске.\n")
+
+def get_history_store() -> HistoryStore:
+    global _history_store
+    if _history_store is None:
+        with _history_store_lock:
+            if _history_store is None:
+                _history_store = HistoryStore(known_users=_history_users)
+                atexit.register(_history_store.close) # Дописать очередь при выходе
+    return _history_store
+
+# --- END OF FILE assets/history_store.py ---
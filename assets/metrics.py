@@ -0,0 +1,251 @@
+# --- START OF FILE assets/metrics.py ---
+# Метрики приложения в текстовом формате Prometheus: http://<METRICS_HOST>:<METRICS_PORT>/metrics рядом с Gradio.
+#   * promoai_stage_duration_seconds{stage=...} — гистограммы времени этапов обработчика чата (classify, embed, search,
+#     rerank, cross_encoder, mmr, answer_cache, pack_context, llm_first_token, llm, deobfuscate, history_read,
+#     history_write, total); заполняются через add_stage_listener из assets/event_handlers.py;
+#   * счетчик обработанных запросов;
+#   * gauge: доли попаданий кэшей (ответов, результатов поиска, single-flight), глубина очередей (лог запросов,
+#     история), размер и версия индекса, состояние выключателей провайдеров LLM. Считываются в момент опроса.
+# Сервер — http.server в фоновом потоке, без дополнительных зависимостей.
+
+import os
+import sys
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").strip().lower() not in ("0", "false", "no")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+METRICS_PREFIX = "promoai"
+# Границы корзин (секунды): от миллисекундных этапов (classify, rerank) до LLM
+STAGE_BUCKETS_S = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+# Источник gauge: возвращает [(имя, тип, справка, метки, значение), ...] на момент опроса
+GaugeSample = Tuple[str, str, str, Dict[str, Any], float]
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in items) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Histogram:
+    """Гистограмма с метками: корзины, сумма и количество наблюдений на набор меток."""
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = STAGE_BUCKETS_S):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = sorted(float(b) for b in buckets)
+        self._series: Dict[Labels, List[float]] = {} # [счетчики корзин..., +Inf, сумма]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0.0] * (len(self.buckets) + 2)
+            series[position] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {key: list(series) for key, series in self._series.items()}
+        for key in sorted(snapshot):
+            series = snapshot[key]; cumulative = 0.0
+            for bound, count in zip(self.buckets + [float("inf")], series[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', _format_value(bound)))} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {_format_value(cumulative)}")
+        return lines
+
+class Counter:
+    """Монотонный счетчик с метками."""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        lines.extend(f"{self.name}{_format_labels(key)} {_format_value(values[key])}" for key in sorted(values))
+        return lines
+
+class MetricsRegistry:
+    """Гистограммы и счетчики, заполняемые по ходу работы, и источники gauge, опрашиваемые при каждом запросе /metrics."""
+
+    def __init__(self, prefix: str = METRICS_PREFIX):
+        self.prefix = prefix
+        self.stage_duration = Histogram(f"{prefix}_stage_duration_seconds", "Время этапа обработки запроса чата")
+        self.requests = Counter(f"{prefix}_requests_total", "Обработанные запросы чата")
+        self._gauge_sources: List[Callable[[], List[GaugeSample]]] = []
+        self._sources_lock = threading.Lock()
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        """Слушатель этапов (add_stage_listener): (этап, секунды)."""
+        self.stage_duration.observe(seconds, stage=stage)
+        if stage == "total":
+            self.requests.inc()
+
+    def add_gauge_source(self, source: Callable[[], List[GaugeSample]]) -> None:
+        with self._sources_lock:
+            if source not in self._gauge_sources:
+                self._gauge_sources.append(source)
+
+    def _collect_gauges(self) -> List[str]:
+        grouped: Dict[str, Tuple[str, str, List[str]]] = {}
+        with self._sources_lock:
+            sources = list(self._gauge_sources)
+        for source in sources:
+            try:
+                samples = source()
+            except Exception as e: # Сбой одного источника не ломает весь ответ
+                sys.stderr.write(f"⚠️ Ошибка источника метрик {getattr(source, '__name__', source)}: {e}\n")
+                continue
+            for name, kind, help_text, labels, value in samples:
+                if value is None:
+                    continue
+                full_name = f"{self.prefix}_{name}"
+                _, _, lines = grouped.setdefault(full_name, (kind, help_text, []))
+                key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+                lines.append(f"{full_name}{_format_labels(key)} {_format_value(value)}")
+        rendered: List[str] = []
+        for full_name, (kind, help_text, lines) in grouped.items():
+            rendered.extend([f"# HELP {full_name} {help_text}", f"# TYPE {full_name} {kind}"] + lines)
+        return rendered
+
+    def render(self) -> str:
+        lines = self.stage_duration.render() + self.requests.render() + self._collect_gauges()
+        return "\n".join(lines) + "\n"
+
+# --- Источники gauge приложения ---
+def _cache_gauges() -> List[GaugeSample]:
+    samples: List[GaugeSample] = []
+    from assistant.answer_cache import get_answer_cache
+    answer_cache = get_answer_cache()
+    if answer_cache is not None:
+        stats = answer_cache.stats()
+        samples.append(("cache_hit_ratio", "gauge", "Доля попаданий кэша", {"cache": "answer"}, stats["hit_rate"]))
+        samples.append(("cache_entries", "gauge", "Записей в кэше", {"cache": "answer"}, stats["size"]))
+    from assistant.search_engine import get_search_engine
+    stats = get_search_engine().cache_stats()
+    samples.append(("cache_hit_ratio", "gauge", "Доля попаданий кэша", {"cache": "search"}, stats["hit_rate"]))
+    samples.append(("cache_entries", "gauge", "Записей в кэше", {"cache": "search"}, stats["size"]))
+    from assistant.single_flight import single_flight_stats
+    for flight, stats in single_flight_stats().items():
+        samples.append(("single_flight_coalesced_ratio", "gauge", "Доля запросов, получивших результат чужого вычисления",
+                        {"flight": flight}, stats["coalesced_rate"]))
+        samples.append(("single_flight_in_flight", "gauge", "Выполняемых вычислений", {"flight": flight}, stats["in_flight"]))
+    return samples
+
+def _queue_gauges() -> List[GaugeSample]:
+    from assets.query_logger import get_query_logger
+    from assets.history_store import get_history_store
+    query_log = get_query_logger().stats()
+    return [
+        ("queue_depth", "gauge", "Записей в очереди фоновой записи", {"queue": "query_log"}, query_log["queued"]),
+        ("queue_depth", "gauge", "Записей в очереди фоновой записи", {"queue": "history"}, get_history_store().queue_depth()),
+        ("query_log_dropped_total", "counter", "Записей лога запросов, отброшенных из-за переполнения очереди", {}, query_log["dropped"]),
+    ]
+
+def _index_gauges() -> List[GaugeSample]:
+    from assistant.search_engine import get_search_engine
+    stats = get_search_engine().index_stats()
+    if stats is None:
+        return []
+    return [
+        ("index_vectors", "gauge", "Векторов в активном индексе", {}, stats["vectors"]),
+        ("index_shards", "gauge", "Шардов в активном индексе", {}, stats["shards"]),
+        ("index_info", "gauge", "Активная версия индекса", {"version": stats["version"], "dimension": stats["dimension"]}, 1),
+    ]
+
+def _llm_gauges() -> List[GaugeSample]:
+    from assistant.llm_policy import get_llm_policy
+    samples: List[GaugeSample] = []
+    for provider, stats in get_llm_policy().stats().items():
+        samples.append(("llm_breaker_open", "gauge", "Выключатель провайдера LLM разомкнут (1) или нет (0)",
+                        {"provider": provider}, 1 if stats["breaker"] == "open" else 0))
+        samples.append(("llm_first_token_p95_seconds", "gauge", "p95 времени до первого фрагмента ответа",
+                        {"provider": provider}, stats["p95_first_token_s"]))
+    return samples
+
+# --- HTTP-сервер ---
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: "MetricsRegistry"
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # Опросы Prometheus не засоряют вывод
+        pass
+
+def start_metrics_server(registry: "MetricsRegistry", host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[ThreadingHTTPServer]:
+    """Запускает /metrics в фоновом потоке. None — порт занят или недоступен (приложение работает без метрик)."""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as e:
+        sys.stderr.write(f"⚠️ Не удалось запустить сервер метрик на {host}:{port}: {e}\n")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"📈 Метрики Prometheus: http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+# --- Общий экземпляр для приложения ---
+_registry: Optional[MetricsRegistry] = None
+_registry_lock = threading.Lock()
+
+def get_metrics_registry() -> MetricsRegistry:
+    """Общий реестр: слушатель этапов обработчика чата и источники gauge подключаются при создании."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                from assets.event_handlers import add_stage_listener
+                registry = MetricsRegistry()
+                add_stage_listener(registry.observe_stage)
+                for source in (_cache_gauges, _queue_gauges, _index_gauges, _llm_gauges):
+                    registry.add_gauge_source(source)
+                _registry = registry
+    return _registry
+
+def start_app_metrics() -> Optional[ThreadingHTTPServer]:
+    """Подключает метрики к обработчику чата и запускает /metrics (если METRICS_ENABLED)."""
+    if not METRICS_ENABLED:
+        print("ℹ️ Метрики выключены (METRICS_ENABLED=0).")
+        return None
+    return start_metrics_server(get_metrics_registry())
+
+# --- END OF FILE assets/metrics.py ---
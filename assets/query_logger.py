@@ -0,0 +1,149 @@
+# --- START OF FILE assets/query_logger.py ---
+# Структурированный лог запросов: одна JSON-строка на запрос в logs/queries.jsonl.
+# Обработчик только кладет запись в ограниченную очередь (без ожидания диска); запись, сериализация и ротация —
+# в фоновом потоке. Переполненная очередь не тормозит запросы: лишние записи отбрасываются и считаются.
+# При превышении QUERY_LOG_MAX_BYTES файл сжимается в queries.jsonl.1.gz (старые сдвигаются до QUERY_LOG_BACKUPS).
+
+import os
+import sys
+import gzip
+import json
+import queue
+import atexit
+import shutil
+import threading
+from typing import Any, Dict, List, Optional
+
+QUERY_LOG_PATH = os.getenv("QUERY_LOG_PATH", os.path.join("logs", "queries.jsonl"))
+QUERY_LOG_QUEUE_SIZE = int(os.getenv("QUERY_LOG_QUEUE_SIZE", "10000"))
+QUERY_LOG_MAX_BYTES = int(os.getenv("QUERY_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+QUERY_LOG_BACKUPS = int(os.getenv("QUERY_LOG_BACKUPS", "5"))
+WRITE_BATCH_SIZE = 512
+
+_STOP = object()
+
+class QueryLogger:
+    """Асинхронная запись JSON-строк с ротацией по размеру и сжатием gzip."""
+
+    def __init__(self, path: str = QUERY_LOG_PATH, queue_size: int = QUERY_LOG_QUEUE_SIZE,
+                 max_bytes: int = QUERY_LOG_MAX_BYTES, backups: int = QUERY_LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = max(0, backups)
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=max(1, queue_size))
+        self._counts_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._writer = threading.Thread(target=self._write_loop, name="query-logger", daemon=True)
+        self._writer.start()
+
+    def log(self, record: Dict[str, Any]) -> bool:
+        """Ставит запись в очередь. False — очередь полна, запись отброшена."""
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            with self._counts_lock:
+                self.dropped += 1
+            return False
+
+    def _rotate(self) -> None:
+        # queries.jsonl.N.gz -> N+1, текущий файл сжимается в .1.gz
+        if self.backups == 0:
+            os.remove(self.path)
+            return
+        for number in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{number}.gz"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{number + 1}.gz")
+        with open(self.path, "rb") as source, gzip.open(f"{self.path}.1.gz.tmp", "wb") as target:
+            shutil.copyfileobj(source, target)
+        os.replace(f"{self.path}.1.gz.tmp", f"{self.path}.1.gz")
+        os.remove(self.path)
+        self.rotations += 1
+
+    def _write_loop(self) -> None:
+        stopping = False
+        while not stopping:
+            batch: List[Any] = [self._queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for record in batch:
+                if record is _STOP:
+                    stopping = True
+                    continue
+                try:
+                    lines.append(json.dumps(record, ensure_ascii=False, default=str))
+                except Exception as e:
+                    sys.stderr.write(f"⚠️ Запись лога запросов не сериализуется: {e}\n")
+            try:
+                if lines:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write("\n".join(lines) + "\n")
+                    with self._counts_lock:
+                        self.written += len(lines)
+                    if self.max_bytes > 0 and os.path.getsize(self.path) >= self.max_bytes:
+                        self._rotate()
+            except Exception as e:
+                sys.stderr.write(f"⚠️ Ошибка записи лога запросов {self.path}: {e}\n")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def flush(self) -> None:
+        self._queue.join()
+
+    def close(self) -> None:
+        if self._writer.is_alive():
+            self._queue.put(_STOP) # Блокирующе: при выходе очередь дописывается полностью
+            self._writer.join()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._counts_lock:
+            return {"queued": self.queue_depth(), "written": self.written, "dropped": self.dropped, "rotations": self.rotations}
+
+def read_query_log(path: str) -> List[Dict[str, Any]]:
+    """Записи лога (queries.jsonl или сжатый queries.jsonl.N.gz); битые строки пропускаются."""
+    opener = gzip.open if path.endswith(".gz") else open
+    records: List[Dict[str, Any]] = []
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+# --- Общий экземпляр для приложения ---
+_query_logger: Optional[QueryLogger] = None
+_query_logger_lock = threading.Lock()
+
+def get_query_logger() -> QueryLogger:
+    global _query_logger
+    if _query_logger is None:
+        with _query_logger_lock:
+            if _query_logger is None:
+                _query_logger = QueryLogger()
+                atexit.register(_query_logger.close)
+    return _query_logger
+
+def configure_query_logger(path: str) -> QueryLogger:
+    """Переключает общий лог на другой файл (например, нагрузочный тест не пишет в рабочий queries.jsonl)."""
+    global _query_logger
+    with _query_logger_lock:
+        previous, _query_logger = _query_logger, QueryLogger(path=path)
+        atexit.register(_query_logger.close)
+    if previous is not None:
+        previous.close()
+    return _query_logger
+
+# --- END OF FILE assets/query_logger.py ---
@@ -0,0 +1,160 @@
+# --- START OF FILE answer_cache.py ---
+# Кэш ответов LLM перед вызовом модели: частые вопросы ("SLA отдела CX при инцидентах?") не платят за полный запрос к LLM.
+# Попадание — тот же нормализованный вопрос или близкий по эмбеддингу (косинус >= ANSWER_CACHE_SIMILARITY),
+# и в обоих случаях тот же набор чанков контекста: ответ строится по тем же документам.
+# Записи разделены по версии индекса, выбранной LLM и SAFE_MODE и устаревают через ANSWER_CACHE_TTL_S.
+# В SAFE_MODE хранится ответ LLM с токенами (до деобфускации), так что реальные данные в кэш не попадают.
+# Предыдущий диалог (последние реплики, которые идут в промпт) входит в раздел через отпечаток dialog_fingerprint:
+# уточняющий вопрос ("а какой у него email?") зависит от диалога и не получает ответ, построенный по чужому.
+
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1").strip().lower() in ("1", "true", "yes", "on")
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL_S = float(os.getenv("ANSWER_CACHE_TTL_S", "21600")) # 6 часов
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.92")) # Порог косинуса для перефразированных вопросов
+
+_WORD_RE = re.compile(r"\w+")
+
+def normalize_question(question: str) -> str:
+    """Вопрос без регистра, пунктуации и лишних пробелов ("ё" -> "е")."""
+    return " ".join(_WORD_RE.findall(str(question).lower().replace("ё", "е")))
+
+def dialog_fingerprint(messages: Optional[Sequence[Dict[str, Any]]]) -> str:
+    """Отпечаток предыдущего диалога {"role", "content"}; пустая строка — диалога нет."""
+    if not messages:
+        return ""
+    digest = hashlib.sha1()
+    for item in messages:
+        digest.update(f"{item.get('role', '')}\x1f{item.get('content', '')}\x1e".encode("utf-8"))
+    return digest.hexdigest()
+
+def _unit_vector(vector: Optional[np.ndarray]) -> Optional[np.ndarray]:
+    if vector is None:
+        return None
+    vec = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm > 0 else None
+
+class AnswerCache:
+    """LRU кэш ответов с TTL. Потокобезопасен."""
+
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE, ttl_s: float = ANSWER_CACHE_TTL_S,
+                 similarity: float = ANSWER_CACHE_SIMILARITY):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self.similarity = similarity
+        # Ключ записи: (раздел, нормализованный вопрос); раздел = (версия, LLM, SAFE_MODE, отпечаток диалога, ID чанков контекста)
+        self._entries: "OrderedDict[Tuple[Tuple[Any, ...], str], Dict[str, Any]]" = OrderedDict()
+        self._by_partition: Dict[Tuple[Any, ...], List[str]] = {} # Раздел -> вопросы (для поиска по сходству)
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    @staticmethod
+    def _partition(index_version: Optional[str], llm_choice: str, safe_mode: bool, chunk_ids: Sequence[Any],
+                   dialog: str) -> Tuple[Any, ...]:
+        return (index_version, llm_choice, bool(safe_mode), dialog, tuple(sorted(str(cid) for cid in chunk_ids)))
+
+    def _remove(self, key: Tuple[Tuple[Any, ...], str]) -> None:
+        if self._entries.pop(key, None) is None:
+            return
+        questions = self._by_partition.get(key[0])
+        if questions is not None:
+            questions.remove(key[1])
+            if not questions:
+                del self._by_partition[key[0]]
+
+    def _is_expired(self, entry: Dict[str, Any], now: float) -> bool:
+        return self.ttl_s > 0 and now - entry["created"] > self.ttl_s
+
+    def get(self, question: str, query_vector: Optional[np.ndarray], chunk_ids: Sequence[Any], index_version: Optional[str],
+            llm_choice: str, safe_mode: bool, dialog: str = "") -> Optional[Tuple[str, str]]:
+        """Возвращает (ответ, "exact" | "semantic") или None. dialog — dialog_fingerprint предыдущих реплик промпта."""
+        if self.max_size <= 0 or not chunk_ids:
+            return None
+        partition = self._partition(index_version, llm_choice, safe_mode, chunk_ids, dialog)
+        normalized = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            key = (partition, normalized)
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry, now):
+                self._remove(key); self.expired += 1; entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry["answer"], "exact"
+
+            vector = _unit_vector(query_vector)
+            best_key, best_similarity = None, self.similarity
+            if vector is not None:
+                for other in list(self._by_partition.get(partition, [])):
+                    other_key = (partition, other)
+                    other_entry = self._entries[other_key]
+                    if self._is_expired(other_entry, now):
+                        self._remove(other_key); self.expired += 1
+                        continue
+                    if other_entry["vector"] is None or other_entry["vector"].shape != vector.shape:
+                        continue
+                    similarity = float(other_entry["vector"] @ vector)
+                    if similarity >= best_similarity:
+                        best_key, best_similarity = other_key, similarity
+            if best_key is not None:
+                self._entries.move_to_end(best_key)
+                self.semantic_hits += 1
+                return self._entries[best_key]["answer"], "semantic"
+            self.misses += 1
+            return None
+
+    def put(self, question: str, query_vector: Optional[np.ndarray], chunk_ids: Sequence[Any], index_version: Optional[str],
+            llm_choice: str, safe_mode: bool, answer: str, dialog: str = "") -> None:
+        if self.max_size <= 0 or not chunk_ids or not answer:
+            return
+        partition = self._partition(index_version, llm_choice, safe_mode, chunk_ids, dialog)
+        key = (partition, normalize_question(question))
+        with self._lock:
+            if key not in self._entries:
+                self._by_partition.setdefault(partition, []).append(key[1])
+            self._entries[key] = {"answer": answer, "vector": _unit_vector(query_vector), "created": time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_partition.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            lookups = hits + self.misses
+            return {"size": len(self._entries), "exact_hits": self.exact_hits, "semantic_hits": self.semantic_hits,
+                    "misses": self.misses, "expired": self.expired, "hit_rate": hits / lookups if lookups else 0.0}
+
+# --- Общий экземпляр для приложения ---
+_answer_cache: Optional[AnswerCache] = None
+_answer_cache_lock = threading.Lock()
+
+def get_answer_cache() -> Optional[AnswerCache]:
+    """Общий кэш ответов; None, если ANSWER_CACHE_ENABLED выключен."""
+    global _answer_cache
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    if _answer_cache is None:
+        with _answer_cache_lock:
+            if _answer_cache is None:
+                _answer_cache = AnswerCache()
+    return _answer_cache
+
+# --- END OF FILE answer_cache.py ---
@@ -0,0 +1,130 @@
+# --- START OF FILE artifacts.py ---
+# Версионированные артефакты поиска:
+#   data/cache/versions/<версия>/  — индекс, хранилище чанков, метаданные, эмбеддинги одной сборки
+#   data/cache/CURRENT             — имя активной версии (заменяется атомарно через os.replace)
+# run_embedder.py пишет новую версию целиком и только потом переключает указатель,
+# поэтому search_engine никогда не видит наполовину записанный индекс.
+# Шардированная версия содержит shards.json и подкаталоги shards/<шард>/ с тем же набором артефактов.
+
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import datetime
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+CACHE_DIR = "data/cache"
+VERSIONS_DIRNAME = "versions"
+CURRENT_POINTER_FILENAME = "CURRENT"
+LEGACY_VERSION = "legacy" # Артефакты, лежащие прямо в CACHE_DIR (до версионирования)
+SHARDS_MANIFEST_FILENAME = "shards.json"
+SHARDS_DIRNAME = "shards"
+MAIN_SHARD = "main" # Имя единственного шарда нешардированной версии
+
+def versions_dir(cache_dir: str = CACHE_DIR) -> str:
+    return os.path.join(cache_dir, VERSIONS_DIRNAME)
+
+def version_dir(version: str, cache_dir: str = CACHE_DIR) -> str:
+    """Каталог артефактов версии; для 'legacy' — сам CACHE_DIR."""
+    if version == LEGACY_VERSION:
+        return cache_dir
+    return os.path.join(versions_dir(cache_dir), version)
+
+def create_version_dir(cache_dir: str = CACHE_DIR) -> str:
+    """Создает каталог новой версии и возвращает её имя (метка времени + короткий суффикс)."""
+    version = f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    os.makedirs(version_dir(version, cache_dir), exist_ok=False)
+    return version
+
+def read_current_version(cache_dir: str = CACHE_DIR) -> Optional[str]:
+    """
+    Возвращает активную версию из указателя CURRENT.
+    Если указателя нет, но в CACHE_DIR лежит старый индекс — 'legacy'. Иначе None.
+    """
+    pointer_path = os.path.join(cache_dir, CURRENT_POINTER_FILENAME)
+    try:
+        with open(pointer_path, "r", encoding="utf-8") as f:
+            version = f.read().strip()
+        if version:
+            return version
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        sys.stderr.write(f"⚠️ Не удалось прочитать указатель версии {pointer_path}: {e}\n")
+        return None
+    if os.path.exists(os.path.join(cache_dir, "faiss_index.bin")):
+        return LEGACY_VERSION
+    return None
+
+def publish_version(version: str, cache_dir: str = CACHE_DIR) -> None:
+    """Атомарно делает версию активной: пишет временный файл и заменяет им CURRENT."""
+    if not os.path.isdir(version_dir(version, cache_dir)):
+        raise FileNotFoundError(f"Каталог версии не найден: {version_dir(version, cache_dir)}")
+    pointer_path = os.path.join(cache_dir, CURRENT_POINTER_FILENAME)
+    tmp_path = f"{pointer_path}.{uuid.uuid4().hex[:6]}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, pointer_path)
+
+def link_or_copy(src: str, dst: str) -> None:
+    """Переносит неизменный артефакт в новую версию: жесткая ссылка, если возможно, иначе копия."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def shard_dir_name(shard_name: str) -> str:
+    """Имя подкаталога шарда: читаемая часть имени + хеш (имена документов могут быть любыми)."""
+    readable = re.sub(r"[^\w.-]+", "_", shard_name, flags=re.UNICODE).strip("._")[:48] or "shard"
+    return f"{readable}-{hashlib.md5(shard_name.encode('utf-8')).hexdigest()[:8]}"
+
+def write_shard_manifest(directory: str, manifest: Dict[str, Any]) -> None:
+    """Сохраняет shards.json: {"shard_by": ..., "shards": [{"name", "dir", "count", "fingerprint"}, ...]}."""
+    path = os.path.join(directory, SHARDS_MANIFEST_FILENAME)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+def read_shard_manifest(directory: str) -> Optional[Dict[str, Any]]:
+    """Читает shards.json версии; None — версия не шардирована."""
+    path = os.path.join(directory, SHARDS_MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def list_shards(version: str, cache_dir: str = CACHE_DIR) -> List[Tuple[str, str]]:
+    """Список (имя шарда, каталог артефактов) версии. Нешардированная версия — один шард 'main'."""
+    directory = version_dir(version, cache_dir)
+    manifest = read_shard_manifest(directory)
+    if manifest is None:
+        return [(MAIN_SHARD, directory)]
+    return [(shard["name"], os.path.join(directory, shard["dir"])) for shard in manifest.get("shards", [])]
+
+def list_versions(cache_dir: str = CACHE_DIR) -> List[str]:
+    root = versions_dir(cache_dir)
+    if not os.path.isdir(root):
+        return []
+    names = [name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name))]
+    # От старых к новым; время изменения каталога различает версии, созданные в одну секунду
+    return sorted(names, key=lambda name: (os.path.getmtime(os.path.join(root, name)), name))
+
+def prune_versions(keep: int = 3, cache_dir: str = CACHE_DIR) -> List[str]:
+    """
+    Удаляет старые версии, оставляя `keep` последних и обязательно активную.
+    Процессы, которые ещё держат открытые файлы удаленной версии, продолжают работать
+    (файлы освобождаются ОС после закрытия), но перезапустить их на старой версии уже нельзя.
+    """
+    current = read_current_version(cache_dir)
+    versions = list_versions(cache_dir)
+    removable = [v for v in versions[:-keep] if v != current] if keep > 0 else [v for v in versions if v != current]
+    for version in removable:
+        shutil.rmtree(version_dir(version, cache_dir), ignore_errors=True)
+    return removable
+
+# --- END OF FILE artifacts.py ---
@@ -0,0 +1,186 @@
+# --- START OF FILE chunk_store.py ---
+# Компактное хранилище чанков (SQLite, сжатый zlib текст и метаданные) с доступом по номеру строки FAISS.
+# Заменяет загрузку всего indexed_chunks.json в память: каждый процесс декодирует только
+# те ~20 чанков, которые вернул поиск, а сам файл разделяется через page cache ОС.
+
+import os
+import sys
+import json
+import zlib
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+CHUNK_STORE_FILENAME = "chunks.sqlite"
+COMPRESSION_LEVEL = 6
+SQLITE_MAX_VARIABLES = 900 # Запас до лимита SQLITE_MAX_VARIABLE_NUMBER старых сборок (999)
+
+def _pack(value: Any) -> bytes:
+    return zlib.compress(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"), COMPRESSION_LEVEL)
+
+def _unpack(blob: bytes) -> Any:
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+def write_chunk_store(path: str, chunks: Iterable[Dict[str, Any]]) -> int:
+    """
+    Записывает чанки в SQLite: строка N соответствует вектору N в FAISS индексе.
+    Текст и метаданные сжимаются zlib; предвычисленные признаки chunk["features"]
+    (см. assistant/heuristic_ranker.py), если есть, хранятся в отдельной колонке.
+    Запись атомарная (временный файл + os.replace). Возвращает количество записанных чанков.
+    """
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("CREATE TABLE chunks (row INTEGER PRIMARY KEY, id TEXT, text BLOB NOT NULL, meta BLOB NOT NULL, features BLOB)")
+        rows = ((row, chunk.get("id"), _pack(chunk.get("text", "")), _pack(chunk.get("meta", {})),
+                 _pack(chunk["features"]) if chunk.get("features") is not None else None)
+                for row, chunk in enumerate(chunks))
+        conn.executemany("INSERT INTO chunks (row, id, text, meta, features) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.execute("CREATE INDEX idx_chunks_id ON chunks (id)")
+        count = conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    return int(count)
+
+class ChunkStore:
+    """
+    Доступ к чанкам по номеру строки FAISS. Файл открывается только на чтение;
+    у каждого потока свое соединение (sqlite3 не разделяет соединения между потоками).
+    """
+
+    def __init__(self, path: str):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        self.path = path
+        # immutable=1: артефакты не меняются после записи, SQLite может не брать блокировки
+        self._uri = f"file:{os.path.abspath(path)}?mode=ro&immutable=1"
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = [] # Все соединения потоков — для close()
+        self._connections_lock = threading.Lock()
+        self._count = int(self._connection().execute("SELECT COUNT(*) FROM chunks").fetchone()[0])
+        # Хранилища, записанные до появления признаков, не имеют колонки features
+        columns = {record[1] for record in self._connection().execute("PRAGMA table_info(chunks)")}
+        self._columns = "row, id, text, meta, " + ("features" if "features" in columns else "NULL")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def __len__(self) -> int:
+        return self._count
+
+    @staticmethod
+    def _decode(record: Sequence[Any]) -> Dict[str, Any]:
+        _, chunk_id, text_blob, meta_blob, features_blob = record
+        chunk = {"id": chunk_id, "text": _unpack(text_blob), "meta": _unpack(meta_blob)}
+        if features_blob is not None:
+            chunk["features"] = _unpack(features_blob)
+        return chunk
+
+    def get(self, row: int) -> Optional[Dict[str, Any]]:
+        """Возвращает чанк по номеру строки FAISS (или None)."""
+        record = self._connection().execute(
+            f"SELECT {self._columns} FROM chunks WHERE row = ?", (int(row),)).fetchone()
+        return self._decode(record) if record else None
+
+    def get_many(self, rows: Sequence[int]) -> List[Optional[Dict[str, Any]]]:
+        """Возвращает чанки для списка строк в том же порядке; отсутствующие — None."""
+        wanted = [int(r) for r in rows]
+        found: Dict[int, Dict[str, Any]] = {}
+        unique_rows = list(dict.fromkeys(wanted))
+        for start in range(0, len(unique_rows), SQLITE_MAX_VARIABLES):
+            part = unique_rows[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ",".join("?" * len(part))
+            for record in self._connection().execute(
+                    f"SELECT {self._columns} FROM chunks WHERE row IN ({placeholders})", part):
+                found[record[0]] = self._decode(record)
+        return [found.get(r) for r in wanted]
+
+    def row_of(self, chunk_id: str) -> Optional[int]:
+        """Номер строки FAISS для ID чанка (или None)."""
+        record = self._connection().execute("SELECT row FROM chunks WHERE id = ? LIMIT 1", (chunk_id,)).fetchone()
+        return int(record[0]) if record else None
+
+    def rows_of(self, chunk_ids: Sequence[str]) -> List[Optional[int]]:
+        """Номера строк FAISS для списка ID в том же порядке; отсутствующие — None."""
+        wanted = [str(chunk_id) for chunk_id in chunk_ids]
+        found: Dict[str, int] = {}
+        unique_ids = list(dict.fromkeys(wanted))
+        for start in range(0, len(unique_ids), SQLITE_MAX_VARIABLES):
+            part = unique_ids[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ",".join("?" * len(part))
+            for row, chunk_id in self._connection().execute(
+                    f"SELECT row, id FROM chunks WHERE id IN ({placeholders})", part):
+                found.setdefault(chunk_id, int(row))
+        return [found.get(chunk_id) for chunk_id in wanted]
+
+    def iter_chunks(self) -> Iterator[Dict[str, Any]]:
+        """Последовательно перебирает все чанки (для пересборки вспомогательных индексов)."""
+        for record in self._connection().execute(f"SELECT {self._columns} FROM chunks ORDER BY row"):
+            yield self._decode(record)
+
+    def close(self) -> None:
+        """Закрывает соединения всех потоков. Вызывать, когда хранилищем больше никто не пользуется."""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self._local = threading.local()
+
+class InMemoryChunkStore:
+    """Тот же интерфейс поверх списка чанков — для старых артефактов (indexed_chunks.json)."""
+
+    def __init__(self, chunks: List[Dict[str, Any]]):
+        self.chunks = chunks
+        self._row_by_id = {chunk.get("id"): row for row, chunk in enumerate(chunks)}
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def get(self, row: int) -> Optional[Dict[str, Any]]:
+        return self.chunks[row] if 0 <= row < len(self.chunks) else None
+
+    def get_many(self, rows: Sequence[int]) -> List[Optional[Dict[str, Any]]]:
+        return [self.get(int(r)) for r in rows]
+
+    def row_of(self, chunk_id: str) -> Optional[int]:
+        return self._row_by_id.get(chunk_id)
+
+    def rows_of(self, chunk_ids: Sequence[str]) -> List[Optional[int]]:
+        return [self._row_by_id.get(chunk_id) for chunk_id in chunk_ids]
+
+    def iter_chunks(self) -> Iterator[Dict[str, Any]]:
+        return iter(self.chunks)
+
+    def close(self) -> None:
+        pass
+
+def open_chunk_store(store_path: str, legacy_json_path: Optional[str] = None):
+    """
+    Открывает ChunkStore; если его нет, а есть старый indexed_chunks.json — загружает его в память.
+    Возвращает None, если данных нет.
+    """
+    if os.path.exists(store_path):
+        return ChunkStore(store_path)
+    if legacy_json_path and os.path.exists(legacy_json_path):
+        print(f"   ⚠️ Хранилище чанков {store_path} не найдено, используется {legacy_json_path} (загрузка целиком в память).")
+        with open(legacy_json_path, "r", encoding="utf-8") as f:
+            return InMemoryChunkStore(json.load(f))
+    sys.stderr.write(f"❌ Не найдено ни хранилище чанков ({store_path}), ни {legacy_json_path}.\n")
+    return None
+
+# --- END OF FILE chunk_store.py ---
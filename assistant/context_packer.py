@@ -0,0 +1,199 @@
+# --- START OF FILE context_packer.py ---
+# Сборка контекста промпта в пределах бюджета токенов.
+#   * соседние чанки одного документа (chunk_index_in_doc подряд) склеиваются в один фрагмент,
+#     повтор перекрытия (chunk_overlap сплиттера, ~200 символов) удаляется;
+#   * фрагменты добавляются по убыванию скора, пока помещаются в CONTEXT_TOKEN_BUDGET;
+#   * заголовок фрагмента короткий: документ, страница, скор и компактные метаданные вместо JSON.
+# Токены считаются токенизатором CONTEXT_TOKENIZER (transformers), без него — оценка по числу символов.
+
+import os
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "BAAI/bge-m3") # Токенизатор модели эмбеддингов уже есть в кэше HF
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "3.0")) # Оценка для русского текста без токенизатора
+MAX_OVERLAP_CHARS = int(os.getenv("CONTEXT_MAX_OVERLAP_CHARS", "400"))
+MIN_OVERLAP_CHARS = 20 # Более короткие совпадения конца и начала считаются случайными
+
+META_KEYS = ['type', 'responsible', 'department', 'stage', 'geo', 'priority_level', 'sla', 'duration', 'mechanic', 'bonus_type',
+             'metric', 'form_type', 'wager', 'payout', 'currency', 'related_to', 'tools']
+SPAN_SEPARATOR = "\n\n"
+LINKS_HEADER = "--- Найденные ссылки в контексте ---"
+
+_tokenizer = None
+_tokenizer_failed = False
+_tokenizer_lock = threading.Lock()
+
+def _get_tokenizer():
+    global _tokenizer, _tokenizer_failed
+    if _tokenizer is not None or _tokenizer_failed or not CONTEXT_TOKENIZER:
+        return _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None and not _tokenizer_failed:
+            try:
+                from transformers import AutoTokenizer
+                _tokenizer = AutoTokenizer.from_pretrained(CONTEXT_TOKENIZER)
+            except Exception as e:
+                sys.stderr.write(f"⚠️ Токенизатор '{CONTEXT_TOKENIZER}' недоступен ({e}); токены контекста оцениваются по символам.\n")
+                _tokenizer_failed = True
+    return _tokenizer
+
+def count_tokens(text: str) -> int:
+    """Число токенов текста (токенизатор или оценка ~CONTEXT_CHARS_PER_TOKEN символов на токен)."""
+    if not text:
+        return 0
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        try:
+            return len(tokenizer.encode(text, add_special_tokens=False))
+        except Exception:
+            pass
+    return int(len(text) / CONTEXT_CHARS_PER_TOKEN) + 1
+
+def _strip_overlap(previous: str, following: str) -> Tuple[str, int]:
+    """Убирает из начала following текст, которым заканчивается previous. Возвращает (остаток, число удаленных символов)."""
+    longest = min(len(previous), len(following), MAX_OVERLAP_CHARS)
+    for size in range(longest, MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(following[:size]):
+            return following[size:].lstrip(), size
+    return following, 0
+
+def _merge_meta(metas: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+    """Метаданные фрагмента: первое непустое значение ключа, списки — объединение без повторов."""
+    merged: Dict[str, Any] = {}
+    for meta in metas:
+        for key in META_KEYS:
+            value = meta.get(key)
+            if not value:
+                continue
+            if isinstance(value, list):
+                existing = merged.setdefault(key, [])
+                if isinstance(existing, list):
+                    existing.extend(v for v in value if v not in existing)
+            elif key not in merged:
+                merged[key] = value
+    return merged
+
+def _format_meta(meta: Dict[str, Any]) -> str:
+    return "; ".join(f"{key}: {', '.join(map(str, value)) if isinstance(value, list) else value}" for key, value in meta.items())
+
+def build_spans(chunks_with_scores: Sequence[Tuple[Dict[str, Any], float]]) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Склеивает соседние чанки одного документа. Возвращает фрагменты
+    [{"chunks", "text", "score" — лучший скор среди чанков, "rank" — позиция лучшего чанка}, ...]
+    и общее число удаленных символов перекрытия.
+    """
+    by_doc: Dict[str, List[Tuple[int, int, Dict[str, Any], float]]] = {}
+    standalone: List[Tuple[int, Dict[str, Any], float]] = []
+    for rank, (chunk, score) in enumerate(chunks_with_scores):
+        if not isinstance(chunk, dict):
+            continue
+        meta = chunk.get("meta", {}) or {}
+        position = meta.get("chunk_index_in_doc")
+        if isinstance(position, int) and meta.get("document_name"):
+            by_doc.setdefault(str(meta["document_name"]), []).append((position, rank, chunk, score))
+        else:
+            standalone.append((rank, chunk, score))
+
+    spans: List[Dict[str, Any]] = []
+    removed_total = 0
+    for items in by_doc.values():
+        items.sort(key=lambda item: item[0])
+        current: Optional[Dict[str, Any]] = None
+        last_position = None
+        for position, rank, chunk, score in items:
+            text = str(chunk.get("text", "")).strip()
+            if current is not None and position == last_position + 1:
+                tail, removed = _strip_overlap(current["text"], text)
+                removed_total += removed
+                current["text"] = f"{current['text']}\n{tail}" if tail else current["text"]
+                current["chunks"].append(chunk)
+                current["score"] = max(current["score"], score)
+                current["rank"] = min(current["rank"], rank)
+            elif position != last_position: # Дубликат позиции (тот же чанк дважды) пропускается
+                current = {"chunks": [chunk], "text": text, "score": score, "rank": rank}
+                spans.append(current)
+            last_position = position
+    spans.extend({"chunks": [chunk], "text": str(chunk.get("text", "")).strip(), "score": score, "rank": rank}
+                 for rank, chunk, score in standalone)
+    # Порядок фрагментов — порядок рейтинга (лучший чанк фрагмента)
+    spans.sort(key=lambda span: span["rank"])
+    return spans, removed_total
+
+def _format_span(number: int, span: Dict[str, Any]) -> str:
+    first_meta = span["chunks"][0].get("meta", {}) or {}
+    pages = [str(c.get("meta", {}).get("page")) for c in span["chunks"] if c.get("meta", {}).get("page") not in (None, "N/A")]
+    pages = list(dict.fromkeys(pages))
+    source = str(first_meta.get("document_name", "N/A")) + (f", стр. {'-'.join([pages[0], pages[-1]]) if len(pages) > 1 else pages[0]}" if pages else "")
+    header = f"--- [{number}] {source} (score {span['score']:.3f}) ---\n"
+    meta_summary = _merge_meta([c.get("meta", {}) or {} for c in span["chunks"]])
+    if any((c.get("meta", {}) or {}).get("table") for c in span["chunks"]):
+        meta_summary["table"] = True
+    if meta_summary:
+        header += f"Метаданные: {_format_meta(meta_summary)}\n"
+    return header + span["text"]
+
+def _span_links(span: Dict[str, Any]) -> List[str]:
+    links: List[str] = []
+    for chunk in span["chunks"]:
+        meta = chunk.get("meta", {}) or {}
+        links.extend(str(url) for url in meta.get("link", []) or [])
+        for link_info in meta.get("document_links", []) or []:
+            if isinstance(link_info, dict) and isinstance(link_info.get("url"), str):
+                links.append(link_info["url"])
+    return links
+
+def pack_context(chunks_with_scores: Sequence[Tuple[Dict[str, Any], float]],
+                 token_budget: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+    """
+    Собирает контекст из [(chunk, score), ...] (по убыванию релевантности) в пределах token_budget.
+    Фрагмент, который не помещается, пропускается — следующие, более короткие, еще могут поместиться.
+    Возвращает текст контекста и статистику {"tokens", "chunks", "packed_chunks", "spans", "dropped_spans", "overlap_chars_removed"}.
+    """
+    budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    spans, removed = build_spans(chunks_with_scores)
+    stats = {"tokens": 0, "chunks": len(chunks_with_scores), "packed_chunks": 0, "spans": 0, "dropped_spans": 0,
+             "overlap_chars_removed": removed}
+    if not spans:
+        return "Контекст не найден.", stats
+
+    parts: List[str] = []
+    links: List[str] = []
+    used = 0
+    separator_tokens = count_tokens(SPAN_SEPARATOR)
+    links_header_tokens = count_tokens(LINKS_HEADER) + separator_tokens
+
+    def links_cost(new_links: List[str]) -> int:
+        if not new_links:
+            return 0
+        return sum(count_tokens(f"- {url}\n") for url in new_links) + (0 if links else links_header_tokens)
+
+    for span in spans:
+        block = _format_span(len(parts) + 1, span)
+        span_links = [url for url in dict.fromkeys(_span_links(span)) if url not in links]
+        cost = count_tokens(block) + separator_tokens + links_cost(span_links)
+        if used + cost > budget:
+            if parts:
+                stats["dropped_spans"] += 1
+                continue
+            # Лучший фрагмент больше всего бюджета — текст обрезается пропорционально, чтобы контекст не был пустым
+            text_tokens = max(1, count_tokens(span["text"]))
+            available = max(0, budget - (cost - text_tokens))
+            span = dict(span, text=span["text"][:int(len(span["text"]) * available / text_tokens)].rstrip() + " …")
+            block = _format_span(1, span)
+            cost = count_tokens(block) + separator_tokens + links_cost(span_links)
+        parts.append(block)
+        links.extend(span_links)
+        used += cost
+        stats["spans"] += 1
+        stats["packed_chunks"] += len(span["chunks"])
+
+    if links:
+        parts.append(LINKS_HEADER + "\n" + "\n".join(f"- {url}" for url in sorted(links)))
+    context = SPAN_SEPARATOR.join(parts)
+    stats["tokens"] = count_tokens(context)
+    return context, stats
+
+# --- END OF FILE context_packer.py ---
@@ -0,0 +1,192 @@
+# --- START OF FILE cross_encoder_ranker.py ---
+# Необязательный этап ре-ранкинга кросс-энкодером (CPU) между поиском и сборкой контекста.
+# Кандидаты оцениваются батчами в порядке текущего рейтинга, пока не исчерпан бюджет задержки на запрос;
+# неоцененные остаются после оцененных в прежнем порядке. Оценки кэшируются по (хеш запроса, ID чанка):
+# ID чанка — хеш его текста, поэтому кэш остается верным и после пересборки индекса.
+# Включается переменной RERANKER_ENABLED=1.
+
+import os
+import sys
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+RERANKER_ENABLED = os.getenv("RERANKER_ENABLED", "0").strip().lower() in ("1", "true", "yes", "on")
+RERANKER_MODEL_NAME = os.getenv("RERANKER_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1") # Небольшая мультиязычная модель
+RERANKER_TOP_N = int(os.getenv("RERANKER_TOP_N", "20")) # Сколько кандидатов из начала рейтинга можно переоценить
+RERANKER_BATCH_SIZE = int(os.getenv("RERANKER_BATCH_SIZE", "8"))
+RERANKER_BUDGET_MS = float(os.getenv("RERANKER_BUDGET_MS", "300")) # Бюджет на запрос, включая ожидание слота
+RERANKER_MAX_LENGTH = int(os.getenv("RERANKER_MAX_LENGTH", "512")) # Макс. токенов в паре (запрос, чанк)
+RERANKER_CACHE_SIZE = int(os.getenv("RERANKER_CACHE_SIZE", "4096"))
+RERANKER_MAX_CONCURRENCY = int(os.getenv("RERANKER_MAX_CONCURRENCY", "0")) or max(1, (os.cpu_count() or 4) // 4)
+
+EWMA_ALPHA = 0.3 # Сглаживание оценки времени на одну пару
+
+def _normalize_query(query: str) -> str:
+    return " ".join(str(query).split())
+
+class CrossEncoderReranker:
+    """
+    Ре-ранкер на sentence_transformers.CrossEncoder. Модель загружается лениво (или через load()),
+    потокобезопасен: одновременно работает не более max_concurrency вызовов модели.
+    """
+
+    def __init__(self, model_name: str = RERANKER_MODEL_NAME, top_n: int = RERANKER_TOP_N,
+                 batch_size: int = RERANKER_BATCH_SIZE, budget_ms: float = RERANKER_BUDGET_MS,
+                 max_length: int = RERANKER_MAX_LENGTH, cache_size: int = RERANKER_CACHE_SIZE,
+                 max_concurrency: int = RERANKER_MAX_CONCURRENCY):
+        self.model_name = model_name
+        self.top_n = max(0, top_n)
+        self.batch_size = max(1, batch_size)
+        self.budget_ms = budget_ms
+        self.max_length = max_length
+        self.cache_size = max(0, cache_size)
+        self._model = None
+        self._load_failed = False
+        self._load_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrency))
+        self._cache: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._pair_seconds: Optional[float] = None # EWMA времени на одну пару — чтобы не начинать батч, который не успеет
+
+    def load(self) -> bool:
+        """Загружает модель (однократно). False — модель недоступна, этап пропускается."""
+        if self._model is not None:
+            return True
+        if self._load_failed:
+            return False
+        with self._load_lock:
+            if self._model is None and not self._load_failed:
+                try:
+                    from sentence_transformers import CrossEncoder
+                    start = time.perf_counter()
+                    self._model = CrossEncoder(self.model_name, max_length=self.max_length, device="cpu")
+                    print(f"✅ Кросс-энкодер '{self.model_name}' загружен за {time.perf_counter() - start:.1f} с "
+                          f"(top-{self.top_n}, батч {self.batch_size}, бюджет {self.budget_ms:.0f} мс).")
+                except Exception as e:
+                    sys.stderr.write(f"❌ Не удалось загрузить кросс-энкодер '{self.model_name}': {e}. Ре-ранкинг кросс-энкодером отключен.\n")
+                    self._load_failed = True
+        return self._model is not None
+
+    # --- Кэш оценок ---
+    def _cache_get(self, key: Tuple[str, str]) -> Optional[float]:
+        with self._cache_lock:
+            score = self._cache.get(key)
+            if score is not None:
+                self._cache.move_to_end(key)
+            return score
+
+    def _cache_put(self, key: Tuple[str, str], score: float) -> None:
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = score
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def clear_cache(self) -> None:
+        with self._cache_lock:
+            self._cache.clear()
+
+    def _predict(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        start = time.perf_counter()
+        scores = self._model.predict(pairs, batch_size=len(pairs), show_progress_bar=False, convert_to_numpy=True)
+        per_pair = (time.perf_counter() - start) / len(pairs)
+        self._pair_seconds = per_pair if self._pair_seconds is None else (1 - EWMA_ALPHA) * self._pair_seconds + EWMA_ALPHA * per_pair
+        return [float(s) for s in scores]
+
+    def score_chunks(self, query: str, chunks: Sequence[Dict[str, Any]]) -> Tuple[List[Optional[float]], Dict[str, Any]]:
+        """
+        Оценивает первые top_n чанков в заданном порядке. Возвращает оценки (None — не оценен:
+        за пределами top_n или не хватило бюджета) и статистику этапа для лога.
+        """
+        available = self.load() # Загрузка модели (однократная) не входит в бюджет запроса
+        start = time.perf_counter()
+        query = _normalize_query(query)
+        query_hash = hashlib.sha1(f"{self.model_name}\n{query}".encode("utf-8")).hexdigest()
+        scores: List[Optional[float]] = [None] * len(chunks)
+        stats = {"candidates": min(len(chunks), self.top_n), "scored": 0, "cached": 0, "budget_exhausted": False}
+
+        pending: List[int] = []
+        for i, chunk in enumerate(chunks[:self.top_n]):
+            cached = self._cache_get((query_hash, str(chunk.get("id"))))
+            if cached is not None:
+                scores[i] = cached
+                stats["cached"] += 1
+            else:
+                pending.append(i)
+
+        if pending and available:
+            budget_s = self.budget_ms / 1000.0
+            for offset in range(0, len(pending), self.batch_size):
+                batch = pending[offset:offset + self.batch_size]
+                expected = (self._pair_seconds or 0.0) * len(batch)
+                if time.perf_counter() - start + expected > budget_s:
+                    stats["budget_exhausted"] = True
+                    break
+                with self._slots:
+                    # Пока ждали слот, бюджет мог закончиться
+                    if time.perf_counter() - start + expected > budget_s:
+                        stats["budget_exhausted"] = True
+                        break
+                    try:
+                        batch_scores = self._predict([(query, str(chunks[i].get("text", ""))) for i in batch])
+                    except Exception as e:
+                        sys.stderr.write(f"⚠️ Ошибка кросс-энкодера: {e}\n")
+                        break
+                for i, score in zip(batch, batch_scores):
+                    scores[i] = score
+                    self._cache_put((query_hash, str(chunks[i].get("id"))), score)
+                stats["scored"] += len(batch)
+
+        stats["elapsed_ms"] = (time.perf_counter() - start) * 1000.0
+        return scores, stats
+
+    def rerank(self, query: str, items: Sequence[Any], chunk_of: Callable[[Any], Dict[str, Any]] = lambda item: item[0]
+               ) -> Tuple[List[Tuple[Any, Optional[float]]], Dict[str, Any]]:
+        """
+        Переупорядочивает элементы рейтинга: оцененные кросс-энкодером — по убыванию оценки,
+        за ними неоцененные в исходном порядке. Возвращает [(item, score | None), ...] и статистику.
+        """
+        scores, stats = self.score_chunks(query, [chunk_of(item) for item in items])
+        scored = sorted((i for i, s in enumerate(scores) if s is not None), key=lambda i: -scores[i])
+        unscored = [i for i, s in enumerate(scores) if s is None]
+        print(f"🎯 Кросс-энкодер: оценено {stats['scored']} (+{stats['cached']} из кэша) из {stats['candidates']} кандидатов "
+              f"за {stats['elapsed_ms']:.0f} мс (бюджет {self.budget_ms:.0f} мс)" + (", бюджет исчерпан" if stats["budget_exhausted"] else ""))
+        return [(items[i], scores[i]) for i in scored + unscored], stats
+
+# --- Общий экземпляр для приложения ---
+_reranker: Optional[CrossEncoderReranker] = None
+_reranker_lock = threading.Lock()
+
+def get_reranker() -> Optional[CrossEncoderReranker]:
+    """Общий ре-ранкер; None, если RERANKER_ENABLED не включен."""
+    global _reranker
+    if not RERANKER_ENABLED:
+        return None
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = CrossEncoderReranker()
+    return _reranker
+
+def initialize_reranker() -> None:
+    """Загружает модель при старте приложения, чтобы первый запрос не платил за загрузку из бюджета."""
+    reranker = get_reranker()
+    if reranker is None:
+        print("ℹ️ Ре-ранкинг кросс-энкодером выключен (RERANKER_ENABLED=0).")
+        return
+    reranker.load()
+
+def rerank_with_cross_encoder(query: str, items: Sequence[Any], chunk_of: Callable[[Any], Dict[str, Any]] = lambda item: item[0]
+                              ) -> Tuple[List[Tuple[Any, Optional[float]]], Optional[Dict[str, Any]]]:
+    """Этап ре-ранкинга для обработчика: если ре-ранкер выключен — порядок не меняется, оценки None."""
+    reranker = get_reranker()
+    if reranker is None or not items:
+        return [(item, None) for item in items], None
+    return reranker.rerank(query, items, chunk_of)
+
+# --- END OF FILE cross_encoder_ranker.py ---
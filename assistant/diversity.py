@@ -0,0 +1,50 @@
+# --- START OF FILE diversity.py ---
+# Отбор контекста по Maximal Marginal Relevance: следующий чанк выбирается по
+#   (1 - MMR_DIVERSITY) * релевантность - MMR_DIVERSITY * max(сходство с уже выбранными),
+# чтобы повторно загруженные документы и похожие строки Excel не занимали весь контекст.
+# Работает на эмбеддингах кандидатов, уже найденных FAISS (search_engine.get_chunk_vectors), без новых вызовов модели.
+
+import os
+import numpy as np
+from typing import List, Optional, Sequence
+
+MMR_DIVERSITY = float(os.getenv("MMR_DIVERSITY", "0.3")) # 0 — только релевантность (порядок не меняется), 1 — только разнообразие
+
+def mmr_select(vectors: Optional[np.ndarray], relevance: Sequence[float], k: int,
+               diversity: float = MMR_DIVERSITY, found: Optional[np.ndarray] = None) -> List[int]:
+    """
+    Возвращает индексы не более k кандидатов в порядке выбора MMR.
+    relevance — скоры ранжирования в шкале косинуса (семантический/итоговый скор или оценка кросс-энкодера 0..1);
+    vectors — нормализованные эмбеддинги (n, d).
+    Кандидаты без вектора (found[i] == False) не штрафуются за сходство. Без векторов — просто top-k по релевантности.
+    """
+    n = len(relevance)
+    k = min(k, n)
+    if k <= 0:
+        return []
+    rel = np.asarray(relevance, dtype=np.float64)
+    rel = np.nan_to_num(rel, nan=np.nanmin(rel) if not np.isnan(rel).all() else 0.0)
+    if vectors is None or diversity <= 0.0 or n == 1:
+        return [int(i) for i in np.argsort(-rel, kind="stable")[:k]]
+
+    vecs = np.asarray(vectors, dtype=np.float32)
+    similarity = vecs @ vecs.T # Векторы нормализованы: скалярное произведение = косинус
+    if found is not None:
+        missing = ~np.asarray(found, dtype=bool)
+        similarity[missing, :] = 0.0
+        similarity[:, missing] = 0.0
+
+    selected: List[int] = [int(np.argmax(rel))]
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+    max_similarity = similarity[selected[0]].astype(np.float64)
+    for _ in range(k - 1):
+        scores = (1.0 - diversity) * rel - diversity * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return selected
+
+# --- END OF FILE diversity.py ---
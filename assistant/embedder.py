@@ -4,6 +4,7 @@ import os
 import numpy as np
 from sentence_transformers import SentenceTransformer
 import sys
+import threading
 # --- ДОБАВЛЕНО: Импорт типов ---
 from typing import List, Optional
 # --- Конец добавления ---
@@ -19,6 +20,34 @@ except Exception as e:
     sys.stderr.write("   Убедитесь, что библиотека sentence-transformers установлена и есть доступ к Hugging Face Hub.\n")
     model = None
 
+# --- Бюджет потоков torch ---
+# torch по умолчанию занимает все ядра на каждый encode; при одновременных запросах пользователей
+# потоки intra-op перегружают CPU. Приложение фиксирует число потоков torch и число одновременных encode.
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        sys.stderr.write(f"⚠️ Некорректное значение {name}, используется {default}.\n")
+        return default
+
+CPU_COUNT = os.cpu_count() or 4
+TORCH_THREADS = max(1, _env_int("EMBEDDER_TORCH_THREADS", 0) or min(4, CPU_COUNT))
+MAX_CONCURRENT_ENCODES = max(1, _env_int("EMBEDDER_MAX_CONCURRENCY", 0) or CPU_COUNT // TORCH_THREADS)
+_encode_slots = threading.BoundedSemaphore(MAX_CONCURRENT_ENCODES)
+
+def configure_torch_threads(threads: Optional[int] = None) -> None:
+    """
+    Устанавливает число потоков torch для всего процесса (по умолчанию EMBEDDER_TORCH_THREADS).
+    Вызывается приложением при старте; run_embedder.py его не вызывает и индексирует на всех ядрах.
+    """
+    threads = threads or TORCH_THREADS
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        print(f"🧵 Потоков torch: {threads}, одновременных encode запросов: до {MAX_CONCURRENT_ENCODES}.")
+    except Exception as e:
+        sys.stderr.write(f"⚠️ Не удалось установить число потоков torch: {e}\n")
+
 # --- Функции для эмбеддинга ---
 
 def embed_query(query: str) -> Optional[np.ndarray]:
@@ -30,12 +59,32 @@ def embed_query(query: str) -> Optional[np.ndarray]:
         return None
     prompt = query
     try:
-        embedding = model.encode(prompt, convert_to_numpy=True, normalize_embeddings=True)
+        with _encode_slots:
+            embedding = model.encode(prompt, convert_to_numpy=True, normalize_embeddings=True)
         return embedding
     except Exception as e:
         sys.stderr.write(f"❌ Ошибка при генерации эмбеддинга для запроса: {e}\n")
         return None
 
+def embed_queries(queries: List[str], batch_size: int = 32) -> Optional[np.ndarray]:
+    """
+    Генерирует эмбеддинги сразу для нескольких запросов (матрица (n, d), нормализованная).
+    Пара к semantic_search_batch: один вызов модели и один вызов FAISS на весь батч.
+    """
+    if model is None:
+        sys.stderr.write("❌ Ошибка: Модель эмбеддингов не загружена. Невозможно создать эмбеддинги запросов.\n")
+        return None
+    if not queries:
+        dim = get_embedding_dim()
+        return np.empty((0, dim if dim else 1024), dtype=np.float32)
+    try:
+        with _encode_slots:
+            embeddings = model.encode(queries, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+        return embeddings.astype(np.float32, copy=False)
+    except Exception as e:
+        sys.stderr.write(f"❌ Ошибка при генерации эмбеддингов для запросов: {e}\n")
+        return None
+
 def embed_texts(texts: List[str]) -> Optional[np.ndarray]:
     """
     Генерирует эмбеддинги для списка текстов (например, для индексации или сравнения).
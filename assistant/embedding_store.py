@@ -0,0 +1,156 @@
+# --- START OF FILE embedding_store.py ---
+# Компактное хранение матрицы эмбеддингов (float16 / int8 с масштабами на вектор)
+# в формате, который можно отобразить в память (np.memmap) без чтения всего файла.
+
+import os
+import sys
+import json
+import struct
+import numpy as np
+from typing import Iterator, Optional, Sequence, Tuple
+
+# --- Формат файла ---
+# [8 байт MAGIC][uint32 LE длина заголовка][JSON заголовок][выравнивание][матрица n x d][масштабы n x float32 (только int8)]
+MAGIC = b"PAIEMB01"
+ALIGNMENT = 64
+SUPPORTED_DTYPES = ("float32", "float16", "int8")
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+class EmbeddingMatrix:
+    """Матрица эмбеддингов, отображенная в память. Строки декодируются в float32 только при чтении."""
+
+    def __init__(self, path: str, model_name: Optional[str], dtype: str,
+                 vectors: np.ndarray, scales: Optional[np.ndarray] = None):
+        self.path = path
+        self.model_name = model_name
+        self.dtype = dtype
+        self.vectors = vectors
+        self.scales = scales
+
+    @property
+    def count(self) -> int:
+        return int(self.vectors.shape[0])
+
+    @property
+    def dim(self) -> int:
+        return int(self.vectors.shape[1])
+
+    def __len__(self) -> int:
+        return self.count
+
+    def get_rows(self, rows: Sequence[int]) -> np.ndarray:
+        """Возвращает выбранные строки как float32 (n, d)."""
+        idx = np.asarray(rows, dtype=np.int64)
+        block = np.asarray(self.vectors[idx], dtype=np.float32)
+        if self.scales is not None:
+            block *= np.asarray(self.scales[idx], dtype=np.float32)[:, None]
+        return block
+
+    def get_range(self, start: int, end: int) -> np.ndarray:
+        """Возвращает непрерывный диапазон строк [start, end) как float32."""
+        block = np.asarray(self.vectors[start:end], dtype=np.float32)
+        if self.scales is not None:
+            block *= np.asarray(self.scales[start:end], dtype=np.float32)[:, None]
+        return block
+
+    def iter_batches(self, batch_size: int = 65536) -> Iterator[Tuple[int, np.ndarray]]:
+        """Итерирует по матрице батчами (start, float32 батч), не загружая её целиком."""
+        for start in range(0, self.count, batch_size):
+            yield start, self.get_range(start, min(start + batch_size, self.count))
+
+def save_embeddings(path: str, embeddings: np.ndarray, model_name: Optional[str], dtype: str = "float16") -> None:
+    """
+    Сохраняет матрицу эмбеддингов с заголовком (модель, размерность, тип).
+    int8 хранит по одному масштабу float32 на вектор (симметричная квантизация).
+    Запись атомарная: сначала во временный файл, затем os.replace.
+    """
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f"Неподдерживаемый тип хранения эмбеддингов: {dtype} (допустимо: {', '.join(SUPPORTED_DTYPES)})")
+    matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if matrix.ndim != 2:
+        raise ValueError(f"Ожидается 2D матрица эмбеддингов, получено ndim={matrix.ndim}")
+    count, dim = matrix.shape
+
+    scales: Optional[np.ndarray] = None
+    if dtype == "int8":
+        max_abs = np.abs(matrix).max(axis=1) if count else np.empty((0,), dtype=np.float32)
+        scales = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+        data = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    else:
+        data = matrix.astype(dtype)
+
+    header = {"model": model_name, "dim": int(dim), "count": int(count), "dtype": dtype}
+    # Смещения зависят от длины заголовка, поэтому считаем их с запасом под сами числа
+    header_probe = json.dumps({**header, "data_offset": 0, "scales_offset": 0}).encode("utf-8")
+    data_offset = _align(len(MAGIC) + 4 + len(header_probe) + 32)
+    scales_offset = _align(data_offset + data.nbytes) if scales is not None else 0
+    header.update({"data_offset": data_offset, "scales_offset": scales_offset})
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b"\0" * (data_offset - f.tell()))
+        f.write(data.tobytes())
+        if scales is not None:
+            f.write(b"\0" * (scales_offset - f.tell()))
+            f.write(scales.tobytes())
+    os.replace(tmp_path, path)
+
+def read_header(path: str) -> Optional[dict]:
+    """Читает только заголовок файла эмбеддингов (без данных)."""
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            (header_len,) = struct.unpack("<I", f.read(4))
+            return json.loads(f.read(header_len).decode("utf-8"))
+    except Exception as e:
+        sys.stderr.write(f"❌ Ошибка чтения заголовка эмбеддингов {path}: {e}\n")
+        return None
+
+def load_embeddings(path: str, mmap: bool = True) -> Optional[EmbeddingMatrix]:
+    """
+    Открывает файл эмбеддингов. По умолчанию данные отображаются в память (только чтение),
+    поэтому несколько процессов разделяют один page cache.
+    Поддерживает и старый формат embeddings.npy (float32 без метаданных).
+    """
+    if not os.path.exists(path):
+        sys.stderr.write(f"❌ Файл эмбеддингов не найден: {path}\n")
+        return None
+    try:
+        if path.endswith(".npy"):
+            vectors = np.load(path, mmap_mode="r" if mmap else None)
+            return EmbeddingMatrix(path, None, str(vectors.dtype), vectors)
+
+        header = read_header(path)
+        if header is None:
+            sys.stderr.write(f"❌ Неизвестный формат файла эмбеддингов: {path}\n")
+            return None
+        dtype = header["dtype"]
+        shape = (int(header["count"]), int(header["dim"]))
+        np_dtype = np.dtype(dtype)
+        if shape[0] == 0:
+            # Пустой файл нельзя отобразить в память
+            empty_scales = np.empty((0,), dtype=np.float32) if dtype == "int8" else None
+            return EmbeddingMatrix(path, header.get("model"), dtype, np.empty(shape, dtype=np_dtype), empty_scales)
+        if mmap:
+            vectors = np.memmap(path, dtype=np_dtype, mode="r", offset=header["data_offset"], shape=shape)
+        else:
+            vectors = np.fromfile(path, dtype=np_dtype, count=shape[0] * shape[1], offset=header["data_offset"]).reshape(shape)
+        scales = None
+        if dtype == "int8":
+            if mmap:
+                scales = np.memmap(path, dtype=np.float32, mode="r", offset=header["scales_offset"], shape=(shape[0],))
+            else:
+                scales = np.fromfile(path, dtype=np.float32, count=shape[0], offset=header["scales_offset"])
+        return EmbeddingMatrix(path, header.get("model"), dtype, vectors, scales)
+    except Exception as e:
+        sys.stderr.write(f"❌ Ошибка при открытии файла эмбеддингов {path}: {e}\n")
+        return None
+
+# --- END OF FILE embedding_store.py ---
@@ -0,0 +1,197 @@
+# --- START OF FILE heuristic_ranker.py ---
+# Эвристический ре-ранкинг кандидатов семантического поиска.
+# Признаки чанков (хеши слов crc32, флаги контактов/SLA/ссылок, заголовки таблиц, тулы и формы)
+# считаются один раз при индексации (run_embedder.py -> chunk_store), а на запрос
+# бонусы всех кандидатов вычисляются одним проходом numpy. Логика бонусов совпадает
+# с прежней calculate_heuristic_bonus из assets/event_handlers.py.
+
+import re
+import zlib
+import numpy as np
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+FEATURES_VERSION = 1 # Увеличить при изменении состава признаков — старые пересчитаются на лету
+
+# Ключевые ссылки: (слова запроса) -> фрагмент URL нужной формы/доски
+KEY_LINK_KEYWORDS = {("inbox", "360"): "form.asana.com/?k=x7VsquZlamoAzBhkho0TkQ",("miro", "структура"): "miro.com/app/board/",("calendar", "календарь"): "confluence.dats.tech/display/MOS/calendar/",("msd", "инцидент"): "form.asana.com/?k=nc3ajhWt-yVWuXSG1U5m5w",("promo process", "процесс промо"): "app.asana.com/0/1207021300313272",("routing", "роутинг"): "form.asana.com/?k=0DSknHTYjf1cmHosatN3Zg",("logo", "лого", "плашк"): "form.asana.com/?k=nQkrYEdZO-TqK8bFVdw2ww",}
+_KEY_LINK_ITEMS = list(KEY_LINK_KEYWORDS.items()) # Позиция в списке = номер бита в features["link_keys"]
+
+CONTACT_HEADER_KEYS = ('position', 'должность', 'name', 'имя', 'фамилия', 'email', 'почта', 'tg', 'telegram', 'contact', 'контакт', 'responsible', 'ответственный')
+SLA_HEADER_KEYS = ('sla', 'срок', 'время', 'duration')
+CONTACT_CHANNEL_KEYWORDS = ('email', 'почта', 'телеграм', 'tg', 'телефон', 'связаться')
+
+WORD_RE = re.compile(r'\b\w{3,}\b')
+CONTACT_RE = re.compile(r"[\w\.-]+@[\w\.-]+|@[\w\d\._]+")
+MENTIONED_NAME_RE = re.compile(r"([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?|@[a-zA-Z0-9._]+)")
+
+# --- Биты флагов ---
+F_STRUCTURED = 1 << 0
+F_EXCEL = 1 << 1
+F_RESPONSIBLE = 1 << 2
+F_CONTACT_IN_TEXT = 1 << 3
+F_CONTACT_HEADERS = 1 << 4
+F_SLA = 1 << 5
+F_SLA_HEADERS = 1 << 6
+F_INCIDENT = 1 << 7
+F_STAGE = 1 << 8
+F_TYPE_PROCESS = 1 << 9
+F_TYPE_FORM_INSTRUCTION = 1 << 10
+F_TOOLS_OR_FORMS = 1 << 11
+F_LINKS = 1 << 12
+
+MAX_HEURISTIC_SCORE = 100.0
+WORD_ID_DTYPE = np.dtype("<u4")
+WORD_ID_HEX_LEN = 2 * WORD_ID_DTYPE.itemsize
+
+def _word_id(word: str) -> int:
+    return zlib.crc32(word.encode("utf-8"))
+
+def _pack_word_ids(word_ids) -> str:
+    # hex little-endian uint32: строки признаков всех кандидатов склеиваются и читаются одним np.frombuffer
+    return np.array(sorted(word_ids), dtype=WORD_ID_DTYPE).tobytes().hex()
+
+def compute_chunk_features(chunk: Dict[str, Any]) -> Dict[str, Any]:
+    """Признаки чанка для ре-ранкинга (считаются при индексации и хранятся в chunk_store)."""
+    meta = chunk.get("meta") or {}
+    text = str(chunk.get("text", "")).lower()
+    headers = [str(h).lower() for h in meta.get("columns", []) or []]
+    is_structured = bool(meta.get("table", False))
+    flags = 0
+    if is_structured: flags |= F_STRUCTURED
+    if str(meta.get("source_type_raw", "")).startswith("excel"): flags |= F_EXCEL
+    if meta.get("responsible"): flags |= F_RESPONSIBLE
+    if CONTACT_RE.search(text): flags |= F_CONTACT_IN_TEXT
+    if is_structured and any(k in hdr for k in CONTACT_HEADER_KEYS for hdr in headers): flags |= F_CONTACT_HEADERS
+    if meta.get("sla"): flags |= F_SLA
+    if is_structured and any(k in hdr for k in SLA_HEADER_KEYS for hdr in headers): flags |= F_SLA_HEADERS
+    if 'инцидент' in text: flags |= F_INCIDENT
+    if meta.get("stage"): flags |= F_STAGE
+    if meta.get("type") == "process": flags |= F_TYPE_PROCESS
+    if meta.get("type") == "form_instruction": flags |= F_TYPE_FORM_INSTRUCTION
+    if meta.get("tools") or meta.get("form_type"): flags |= F_TOOLS_OR_FORMS
+    urls = [str(url) for url in meta.get("link", []) or []]
+    if urls: flags |= F_LINKS
+
+    link_keys = 0
+    for bit, (_, pattern) in enumerate(_KEY_LINK_ITEMS):
+        if any(pattern in url for url in urls):
+            link_keys |= 1 << bit
+
+    tools = sorted({str(t).lower() for t in (meta.get("tools") or []) + (meta.get("form_type") or []) if str(t)})
+    return {
+        "v": FEATURES_VERSION,
+        "flags": flags,
+        "words": _pack_word_ids({_word_id(w) for w in WORD_RE.findall(text)}),
+        "tools": tools,
+        "link_keys": link_keys,
+    }
+
+def get_chunk_features(chunk: Dict[str, Any]) -> Dict[str, Any]:
+    """Признаки из хранилища; для старых артефактов без признаков — вычисляются и запоминаются в чанке."""
+    features = chunk.get("features")
+    if not features or features.get("v") != FEATURES_VERSION:
+        features = compute_chunk_features(chunk)
+        chunk["features"] = features
+    return features
+
+def _link_key_bit(link_target: Optional[str]) -> Optional[int]:
+    if not link_target:
+        return None
+    for bit, (keywords, _) in enumerate(_KEY_LINK_ITEMS):
+        if link_target == " ".join(keywords):
+            return bit
+    return None
+
+def heuristic_bonuses(chunks: Sequence[Dict[str, Any]], query_lower: str, query_type: str = 'general',
+                      link_target: Optional[str] = None) -> np.ndarray:
+    """Эвристические бонусы (0..100) для всех кандидатов одним проходом по матрице признаков."""
+    n = len(chunks)
+    if n == 0:
+        return np.zeros(0, dtype=np.float64)
+    features = [get_chunk_features(chunk) for chunk in chunks]
+    flags = np.fromiter((f["flags"] for f in features), dtype=np.int64, count=n)
+
+    def has(bit: int) -> np.ndarray:
+        return (flags & bit) != 0
+
+    score = np.zeros(n, dtype=np.float64)
+    structured = has(F_STRUCTURED)
+    if query_type in ('contact', 'sla', 'general', 'link'):
+        score += 5.0 * structured
+
+    if query_type == 'contact':
+        multiplier = np.where(has(F_EXCEL), 0.5, 1.0)
+        if any(kw in query_lower for kw in CONTACT_CHANNEL_KEYWORDS): multiplier = multiplier * 1.5
+        name_match = MENTIONED_NAME_RE.search(query_lower)
+        responsible_bonus = np.full(n, 10.0)
+        if name_match:
+            mentioned_name = name_match.group(1).lower()
+            named = np.zeros(n, dtype=bool)
+            for i in np.flatnonzero(has(F_RESPONSIBLE)): # Имя сверяется только у чанков с ответственным
+                named[i] = mentioned_name in str(chunks[i]["meta"]["responsible"]).lower()
+            responsible_bonus = np.where(named, 25.0, 10.0)
+        score += np.where(has(F_RESPONSIBLE), responsible_bonus, 0.0) * multiplier
+        score += 5.0 * multiplier * has(F_CONTACT_IN_TEXT)
+        score += 8.0 * multiplier * (structured & has(F_CONTACT_HEADERS))
+    elif query_type == 'sla':
+        score += 25.0 * has(F_SLA)
+        score += 15.0 * (structured & has(F_SLA_HEADERS))
+        if 'инцидент' in query_lower: score += 10.0 * has(F_INCIDENT)
+    elif query_type == 'process':
+        score += 15.0 * has(F_STAGE)
+        score += 15.0 * has(F_TYPE_PROCESS)
+    elif query_type == 'tool':
+        # Тулы/формы, упомянутые в запросе, проверяются один раз по объединению имен кандидатов
+        names_in_query = {name for name in set().union(*(f["tools"] for f in features)) if name in query_lower}
+        in_query = np.fromiter((bool(names_in_query) and not names_in_query.isdisjoint(f["tools"]) for f in features), dtype=bool, count=n)
+        score += np.where(in_query, 20.0, np.where(has(F_TOOLS_OR_FORMS), 10.0, 0.0))
+        score += 10.0 * has(F_TYPE_FORM_INSTRUCTION)
+    elif query_type == 'link':
+        has_links = has(F_LINKS)
+        score += 10.0 * has_links
+        if link_target:
+            bit = _link_key_bit(link_target)
+            key_hit = np.zeros(n, dtype=bool)
+            if bit is not None:
+                link_keys = np.fromiter((f["link_keys"] for f in features), dtype=np.int64, count=n)
+                key_hit = (link_keys & (1 << bit)) != 0
+                score += 60.0 * key_hit
+            # Без точного совпадения ключевой ссылки — поиск цели в URL (только у кандидатов со ссылками)
+            fallback = np.fromiter((not hit and bool(links) and any(link_target in str(url).lower() for url in (c.get("meta") or {}).get("link", []))
+                                    for c, hit, links in zip(chunks, key_hit, has_links)), dtype=bool, count=n)
+            score += 30.0 * fallback
+
+    # --- Пересечение слов запроса и чанка (хеши crc32) ---
+    query_words = np.array(sorted({_word_id(w) for w in WORD_RE.findall(query_lower)}), dtype=WORD_ID_DTYPE)
+    if query_words.size:
+        packed = [f["words"] for f in features]
+        lengths = np.fromiter((len(words) // WORD_ID_HEX_LEN for words in packed), dtype=np.int64, count=n)
+        if lengths.sum():
+            all_words = np.frombuffer(bytes.fromhex("".join(packed)), dtype=WORD_ID_DTYPE)
+            owners = np.repeat(np.arange(n), lengths)
+            common = np.bincount(owners[np.isin(all_words, query_words)], minlength=n)
+            score += common * (3.0 if query_type == 'general' else 5.0)
+
+    score = np.minimum(score, MAX_HEURISTIC_SCORE)
+    return np.nan_to_num(score, nan=0.0)
+
+def rerank(results: Sequence[Tuple[Dict[str, Any], float]], query_lower: str, query_type: str = 'general',
+           link_target: Optional[str] = None, heuristic_weight: float = 0.4) -> List[Tuple[Dict[str, Any], float, float, float]]:
+    """
+    Пересортировывает результаты поиска [(chunk, semantic_score), ...] с учетом эвристик.
+    Возвращает [(chunk, final_score, semantic_score, heuristic_bonus), ...] по убыванию final_score;
+    каждый скор считается один раз и используется и для сортировки, и для лога.
+    """
+    if not results:
+        return []
+    chunks = [chunk for chunk, _ in results]
+    semantic = np.fromiter((score for _, score in results), dtype=np.float64, count=len(results))
+    bonuses = heuristic_bonuses(chunks, query_lower, query_type, link_target)
+    normalized = np.clip(bonuses / MAX_HEURISTIC_SCORE, 0.0, 1.0)
+    final = (1.0 + semantic) * (1.0 + heuristic_weight * normalized) - 1.0
+    final = np.where(np.isnan(final), semantic, final)
+    # Как у sorted(..., reverse=True) по кортежу (final, sem, heur): при равенстве — исходный порядок
+    order = np.lexsort((-bonuses, -semantic, -final))
+    return [(chunks[i], float(final[i]), float(semantic[i]), float(bonuses[i])) for i in order]
+
+# --- END OF FILE heuristic_ranker.py ---
@@ -0,0 +1,303 @@
+# --- START OF FILE index_builder.py ---
+# Построение FAISS индекса: тип индекса (Flat / IVF-Flat / IVF-PQ / HNSW, авто-выбор по размеру корпуса),
+# опциональная проекция (PCA/OPQ) в пространство меньшей размерности,
+# метаданные индекса и оценка recall уменьшенного индекса относительно полного.
+
+import os
+import sys
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import faiss
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+INDEX_META_FILENAME = "index_meta.json"
+METADATA_INDEX_FILENAME = "metadata_index.json"
+# Поля meta чанка, по которым строятся инвертированные индексы для фильтрации поиска
+FILTERABLE_FIELDS = ("type", "geo", "stage", "tools", "document_name", "table")
+SUPPORTED_PROJECTIONS = ("none", "pca", "opq")
+SUPPORTED_INDEX_TYPES = ("auto", "flat", "ivf_flat", "ivf_pq", "hnsw")
+SUPPORTED_SHARD_KEYS = ("none", "document_name", "department") # Источник документа или бизнес-подразделение
+UNASSIGNED_SHARD = "_other" # Шард для чанков без значения ключа
+
+# --- Настройки по умолчанию ---
+PROJECTION_TRAIN_SAMPLE = 100_000 # Максимум векторов для обучения проекции
+OPQ_MIN_TRAIN_POINTS = 256 * 39    # Меньше — k-means внутри OPQ обучается плохо (рекомендация FAISS)
+INDEX_TRAIN_SAMPLE = 200_000       # Максимум векторов для обучения IVF / PQ
+
+# Пороги авто-выбора типа индекса по количеству векторов
+AUTO_FLAT_MAX = 50_000       # До этого размера полный перебор быстрее любой структуры и точен
+AUTO_HNSW_MAX = 500_000      # Граф HNSW: лучший recall/latency, но память ~ векторы + граф
+AUTO_IVF_FLAT_MAX = 2_000_000 # Дальше векторы в float32 не помещаются в RAM — сжимаем PQ
+
+# --- Типы индексов ---
+
+def choose_index_type(count: int) -> str:
+    """Выбирает тип индекса по размеру корпуса (режим 'auto')."""
+    if count <= AUTO_FLAT_MAX:
+        return "flat"
+    if count <= AUTO_HNSW_MAX:
+        return "hnsw"
+    if count <= AUTO_IVF_FLAT_MAX:
+        return "ivf_flat"
+    return "ivf_pq"
+
+def _pq_subquantizers(dim: int) -> int:
+    """Число подквантизаторов PQ: ~4 измерения на подвектор, dim должна делиться на m."""
+    for m in (128, 96, 64, 48, 32, 16, 8, 4, 2):
+        if dim % m == 0 and dim // m >= 4:
+            return m
+    return 1
+
+def default_index_params(index_type: str, count: int, dim: int) -> Dict[str, int]:
+    """Параметры построения и поиска по умолчанию для выбранного типа индекса."""
+    if index_type in ("ivf_flat", "ivf_pq"):
+        # Эмпирика FAISS: nlist ~ 4*sqrt(N), не больше N/39 (минимум точек на центроид при обучении)
+        nlist = int(min(max(4 * np.sqrt(max(count, 1)), 16), max(count // 39, 1), 65536))
+        params = {"nlist": nlist, "nprobe": max(1, min(nlist, nlist // 16 or 1))}
+        if index_type == "ivf_pq":
+            # Кодовая книга PQ — 2^nbits центроидов, обучающих точек нужно не меньше: малые шарды получают меньше бит
+            nbits = int(min(8, max(1, np.floor(np.log2(max(count, 2))))))
+            if nbits < 8:
+                print(f"⚠️ Мало векторов для PQ ({count} < 256): nbits уменьшен до {nbits}.")
+            params.update({"m": _pq_subquantizers(dim), "nbits": nbits})
+        return params
+    if index_type == "hnsw":
+        return {"M": 32, "efConstruction": 200, "efSearch": 128}
+    return {}
+
+def create_index(index_type: str, dim: int, params: Dict[str, int]) -> faiss.Index:
+    """Создает пустой (при необходимости необученный) индекс с метрикой скалярного произведения."""
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dim)
+    if index_type == "ivf_flat":
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, params["nlist"], faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = params["nprobe"]
+    elif index_type == "ivf_pq":
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFPQ(quantizer, dim, params["nlist"], params["m"], params["nbits"], faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = params["nprobe"]
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, params["M"], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params["efConstruction"]
+        index.hnsw.efSearch = params["efSearch"]
+        return index
+    else:
+        raise ValueError(f"Неизвестный тип индекса: {index_type} (допустимо: {', '.join(SUPPORTED_INDEX_TYPES)})")
+    return index
+
+def sample_rows(count: int, sample_size: int, seed: int = 123) -> np.ndarray:
+    """Возвращает отсортированные индексы случайной подвыборки строк (для чтения из memmap по порядку)."""
+    if count <= sample_size:
+        return np.arange(count, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(count, size=sample_size, replace=False))
+
+def _opq_subquantizers(out_dim: int) -> int:
+    """Подбирает число подквантизаторов OPQ, на которое делится целевая размерность."""
+    for m in (64, 32, 16, 8, 4, 2):
+        if out_dim % m == 0 and out_dim // m >= 4:
+            return m
+    return 1
+
+def train_projection(train_vectors: np.ndarray, projection_type: str, out_dim: int) -> List[faiss.VectorTransform]:
+    """
+    Обучает цепочку преобразований d -> out_dim (последним идет L2-нормализация).
+
+    'pca' — проекция на главные компоненты матрицы второго момента XᵀX без центрирования:
+            в отличие от faiss.PCAMatrix, она не вычитает среднее, поэтому скалярные произведения
+            (косинусная близость нормализованных векторов) сохраняются без смещения.
+    'opq' — faiss.OPQMatrix (поворот + уменьшение размерности, обучается под PQ).
+    """
+    x = np.ascontiguousarray(train_vectors, dtype=np.float32)
+    d = x.shape[1]
+    if not 0 < out_dim < d:
+        raise ValueError(f"Целевая размерность проекции ({out_dim}) должна быть в диапазоне (0, {d}).")
+
+    if projection_type == "pca":
+        second_moment = (x.T.astype(np.float64) @ x.astype(np.float64)) / max(len(x), 1)
+        eigvals, eigvecs = np.linalg.eigh(second_moment)
+        top = np.argsort(eigvals)[::-1][:out_dim]
+        matrix = np.ascontiguousarray(eigvecs[:, top].T, dtype=np.float32) # (out_dim, d)
+        transform = faiss.LinearTransform(d, out_dim, False)
+        faiss.copy_array_to_vector(matrix.ravel(), transform.A)
+        transform.is_trained = True
+        explained = float(eigvals[top].sum() / max(eigvals.sum(), 1e-12))
+        print(f"   📐 PCA {d} -> {out_dim}: сохранено {explained:.1%} энергии.")
+    elif projection_type == "opq":
+        if len(x) < OPQ_MIN_TRAIN_POINTS:
+            print(f"⚠️ Предупреждение: Для OPQ мало векторов ({len(x)} < {OPQ_MIN_TRAIN_POINTS}), качество проекции может быть низким.")
+        transform = faiss.OPQMatrix(d, _opq_subquantizers(out_dim), out_dim)
+        transform.train(x)
+    else:
+        raise ValueError(f"Неизвестный тип проекции: {projection_type} (допустимо: {', '.join(SUPPORTED_PROJECTIONS)})")
+
+    return [transform, faiss.NormalizationTransform(out_dim, 2.0)]
+
+def build_index(
+    dim: int,
+    batches: Iterable[Tuple[int, np.ndarray]],
+    projection: Optional[List[faiss.VectorTransform]] = None,
+    index_type: str = "flat",
+    params: Optional[Dict[str, int]] = None,
+    train_vectors: Optional[np.ndarray] = None,
+) -> faiss.Index:
+    """
+    Создает индекс заданного типа, обучает его (IVF/PQ) на подвыборке train_vectors
+    и добавляет векторы батчами.
+    При наличии проекции индекс оборачивается в IndexPreTransform: FAISS сам применяет
+    преобразование к добавляемым векторам и к каждому запросу при поиске.
+    """
+    index_dim = projection[-1].d_out if projection else dim
+    inner = create_index(index_type, index_dim, params or {})
+    index: faiss.Index = inner
+    if projection:
+        index = faiss.IndexPreTransform(inner)
+        for transform in reversed(projection):
+            index.prepend_transform(transform)
+    if not index.is_trained:
+        if train_vectors is None or len(train_vectors) == 0:
+            raise ValueError(f"Индекс типа '{index_type}' требует обучения, но обучающая выборка не передана.")
+        print(f"   🎓 Обучение индекса {index_type} на {len(train_vectors)} векторах...")
+        index.train(np.ascontiguousarray(train_vectors, dtype=np.float32))
+    for _, batch in batches:
+        index.add(np.ascontiguousarray(batch, dtype=np.float32))
+    return index
+
+def write_index_meta(path: str, meta: Dict[str, Any]) -> None:
+    """Сохраняет метаданные индекса (тип, проекция, размерности) рядом с индексом."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+def read_index_meta(path: str) -> Dict[str, Any]:
+    """Читает метаданные индекса. Для старых индексов без файла возвращает пустой словарь."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        sys.stderr.write(f"⚠️ Не удалось прочитать метаданные индекса {path}: {e}\n")
+        return {}
+
+# --- Инвертированные индексы по метаданным ---
+
+def normalize_filter_value(value: Any) -> str:
+    """Приводит значение метаданных / фильтра к ключу индекса (строка в нижнем регистре)."""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value).strip().lower()
+
+def build_metadata_index(chunks: Sequence[Dict[str, Any]], fields: Sequence[str] = FILTERABLE_FIELDS) -> Dict[str, Dict[str, List[int]]]:
+    """
+    Строит инвертированные индексы {поле: {значение: [номера строк FAISS по возрастанию]}}.
+    Списковые поля (geo, stage, tools) индексируются по каждому элементу.
+    Поле 'table' индексируется и для отсутствующего значения ('false').
+    """
+    inverted: Dict[str, Dict[str, List[int]]] = {field: {} for field in fields}
+    for row, chunk in enumerate(chunks):
+        meta = chunk.get("meta", {}) if isinstance(chunk, dict) else {}
+        for field in fields:
+            value = meta.get(field)
+            if field == "table":
+                value = bool(value)
+            if value is None or value == "" or value == []:
+                continue
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            for item in values:
+                key = normalize_filter_value(item)
+                if not key:
+                    continue
+                postings = inverted[field].setdefault(key, [])
+                if not postings or postings[-1] != row: # Повторы в списке значений одного чанка
+                    postings.append(row)
+    return inverted
+
+def write_metadata_index(path: str, inverted: Dict[str, Dict[str, List[int]]]) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(inverted, f, ensure_ascii=False, separators=(",", ":"))
+
+def read_metadata_index(path: str) -> Optional[Dict[str, Dict[str, np.ndarray]]]:
+    """Читает инвертированные индексы; списки строк возвращаются как отсортированные int64 массивы."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        return {field: {value: np.asarray(rows, dtype=np.int64) for value, rows in values.items()}
+                for field, values in raw.items()}
+    except Exception as e:
+        sys.stderr.write(f"⚠️ Не удалось прочитать индекс метаданных {path}: {e}\n")
+        return None
+
+# --- Шардирование ---
+
+def shard_key(chunk: Dict[str, Any], shard_by: str) -> str:
+    """Шард чанка. Для списковых полей (department) берется первое значение по алфавиту."""
+    value = (chunk.get("meta") or {}).get(shard_by)
+    if isinstance(value, (list, tuple, set)):
+        items = sorted(str(v).strip() for v in value if str(v).strip())
+        value = items[0] if items else None
+    value = str(value).strip() if value is not None else ""
+    return value or UNASSIGNED_SHARD
+
+def group_chunks_by_shard(chunks: Sequence[Dict[str, Any]], shard_by: str) -> "OrderedDict[str, List[Dict[str, Any]]]":
+    """Разбивает чанки по шардам (порядок чанков внутри шарда сохраняется, шарды — по имени)."""
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for chunk in chunks:
+        groups.setdefault(shard_key(chunk, shard_by), []).append(chunk)
+    return OrderedDict(sorted(groups.items()))
+
+def shard_fingerprint(chunks: Sequence[Dict[str, Any]], model_name: str) -> str:
+    """
+    Отпечаток содержимого шарда: модель + ID чанков (ID — хеш текста, см. common_utils.hash_chunk).
+    Совпадение отпечатков означает, что эмбеддинги и индекс шарда можно взять из предыдущей версии.
+    """
+    digest = hashlib.sha1(str(model_name).encode("utf-8"))
+    for chunk in chunks:
+        digest.update(b"\0")
+        digest.update(str(chunk.get("id") or hashlib.md5(str(chunk.get("text", "")).encode("utf-8")).hexdigest()).encode("utf-8"))
+        digest.update(json.dumps(chunk.get("meta", {}), ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+def evaluate_projection_recall(
+    matrix,
+    dims: Sequence[int],
+    projection_type: str = "pca",
+    n_queries: int = 1000,
+    k: int = 10,
+    train_sample: int = PROJECTION_TRAIN_SAMPLE,
+    batch_size: int = 65536,
+) -> Dict[int, float]:
+    """
+    Сравнивает recall@k индексов с проекцией и полного IndexFlatIP.
+    В качестве запросов берутся случайные векторы корпуса; сам вектор-запрос из выдачи исключается.
+    matrix — EmbeddingMatrix (assistant/embedding_store.py), читается батчами из memmap.
+    """
+    query_rows = sample_rows(matrix.count, n_queries, seed=7)
+    queries = matrix.get_rows(query_rows)
+
+    def _top_k_without_self(index: faiss.Index) -> np.ndarray:
+        _, ids = index.search(queries, k + 1)
+        result = np.full((len(query_rows), k), -1, dtype=np.int64)
+        for i, (row, found) in enumerate(zip(query_rows, ids)):
+            found = found[found != row][:k]
+            result[i, :len(found)] = found
+        return result
+
+    exact_ids = _top_k_without_self(build_index(matrix.dim, matrix.iter_batches(batch_size)))
+    train_vectors = matrix.get_rows(sample_rows(matrix.count, train_sample))
+
+    recalls: Dict[int, float] = {}
+    for out_dim in dims:
+        projection = train_projection(train_vectors, projection_type, out_dim)
+        approx_ids = _top_k_without_self(build_index(matrix.dim, matrix.iter_batches(batch_size), projection))
+        hits = sum(len(set(a[a >= 0]) & set(e[e >= 0])) for a, e in zip(approx_ids, exact_ids))
+        total = int((exact_ids >= 0).sum())
+        recalls[out_dim] = hits / total if total else 0.0
+        print(f"   📊 {projection_type.upper()} {matrix.dim} -> {out_dim}: recall@{k} = {recalls[out_dim]:.4f}")
+    return recalls
+
+# --- END OF FILE index_builder.py ---
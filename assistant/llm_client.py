@@ -1,7 +1,14 @@
 # llm_client.py - Поддержка Together AI и Google Gemini с выбором при запуске
 import os
 from dotenv import load_dotenv
+import re
+import time
+import random
 import traceback
+import asyncio
+import threading
+import weakref
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
 
 # --- Загрузка переменных окружения ---
 load_dotenv()
@@ -44,6 +51,15 @@ if GEMINI_API_KEY:
 else:
     print("⚠️ ПРЕДУПРЕЖДЕНИЕ: GEMINI_API_KEY не найден в .env. Google Gemini будет недоступен.")
 
+# --- Локальная заглушка LLM ('mock') для нагрузочных тестов без расхода квоты ---
+# Профиль задержки: время до первого фрагмента (со случайным разбросом), скорость выдачи токенов, длина ответа, доля ошибок.
+LLM_MOCK_FIRST_TOKEN_S = float(os.getenv("LLM_MOCK_FIRST_TOKEN_S", "0.8"))
+LLM_MOCK_JITTER_S = float(os.getenv("LLM_MOCK_JITTER_S", "0.3"))
+LLM_MOCK_TOKENS_PER_S = float(os.getenv("LLM_MOCK_TOKENS_PER_S", "50"))
+LLM_MOCK_ANSWER_TOKENS = int(os.getenv("LLM_MOCK_ANSWER_TOKENS", "120"))
+LLM_MOCK_TOKENS_PER_CHUNK = int(os.getenv("LLM_MOCK_TOKENS_PER_CHUNK", "4")) # Токенов в одном фрагменте потока
+LLM_MOCK_ERROR_RATE = float(os.getenv("LLM_MOCK_ERROR_RATE", "0"))
+
 # --- Общий системный промпт (Улучшенная версия v2) ---
 SYSTEM_PROMPT = (
     "Ты — точный и внимательный ассистент PromoAI. Твоя задача - отвечать на вопросы пользователя СТРОГО на основе предоставленных ниже фрагментов документов (контекста)."
@@ -58,6 +74,184 @@ SYSTEM_PROMPT = (
     "\n8. Отвечай кратко, по делу, без лишней информации."
 )
 
+# --- Параметры генерации (общие для обычных и потоковых вызовов) ---
+TOGETHER_GENERATION_PARAMS = {"temperature": 0.4, "max_tokens": 1024, "top_p": 0.95}
+GEMINI_GENERATION_PARAMS = {"temperature": 0.4, "top_p": 0.95}
+GEMINI_SAFETY_SETTINGS = {
+    'HARM_CATEGORY_HARASSMENT': 'BLOCK_MEDIUM_AND_ABOVE',
+    'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_MEDIUM_AND_ABOVE',
+    'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_MEDIUM_AND_ABOVE',
+    'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_MEDIUM_AND_ABOVE',
+}
+
+# Ответы-ошибки (провайдер недоступен, блокировка, исключение): не кэшируются
+LLM_ERROR_PREFIXES = ("Ошибка:",)
+LLM_ERROR_MARKERS = ("Произошла ошибка при обращении к языковой модели", "Произошла критическая ошибка при обращении к языковой модели",
+                     "Произошла ошибка при обработке ответа", "Ответ не может быть сгенерирован из-за ограничений безопасности",
+                     "Модель не смогла сгенерировать ответ", "Модель не вернула текстовый ответ")
+
+# Из них временные — исключение при обращении к API (сеть, перегрузка, лимиты): повтор или другой провайдер может помочь.
+# Блокировка по безопасности, пустой ответ модели, "не сконфигурирован" — детерминированы и не повторяются.
+LLM_TRANSIENT_ERROR_MARKERS = ("Произошла ошибка при обращении к языковой модели", "Произошла критическая ошибка при обращении к языковой модели",
+                               "Произошла ошибка при обработке ответа")
+LLM_EMPTY_ANSWER_MESSAGE = "Модель не смогла сгенерировать ответ на данный запрос (пустой ответ)."
+
+def is_llm_error_answer(answer: str) -> bool:
+    """True, если текст — сообщение об ошибке от ask_llm*, а не ответ модели."""
+    text = str(answer or "").strip()
+    return not text or text.startswith(LLM_ERROR_PREFIXES) or any(marker in text for marker in LLM_ERROR_MARKERS)
+
+def is_llm_transient_error(answer: str) -> bool:
+    """True, если текст — сообщение о временной ошибке (исключение при обращении к API), которую имеет смысл повторить."""
+    text = str(answer or "").strip()
+    return any(marker in text for marker in LLM_TRANSIENT_ERROR_MARKERS)
+
+def _together_messages(prompt: str, system_prompt: str):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
+
+# --- Повторно используемые объекты провайдеров ---
+# GenerativeModel Gemini создается один раз на (модель, системный промпт), GenerationConfig — один раз на процесс.
+# Асинхронный клиент Together держит свой пул HTTP-соединений; он привязан к циклу событий, поэтому создается
+# один раз на цикл (в приложении цикл один — Gradio).
+GEMINI_MODEL_CACHE_SIZE = int(os.getenv("GEMINI_MODEL_CACHE_SIZE", "16"))
+_gemini_models: Dict[Tuple[str, str], Any] = {}
+_gemini_generation_config = None
+_async_together_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+_provider_lock = threading.Lock()
+
+def _get_gemini_model(system_prompt: str):
+    key = (GEMINI_MODEL_NAME, system_prompt)
+    model = _gemini_models.get(key)
+    if model is None:
+        with _provider_lock:
+            model = _gemini_models.get(key)
+            if model is None:
+                model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=system_prompt)
+                if len(_gemini_models) >= GEMINI_MODEL_CACHE_SIZE:
+                    _gemini_models.pop(next(iter(_gemini_models))) # Самый старый
+                _gemini_models[key] = model
+    return model
+
+def _get_gemini_generation_config():
+    global _gemini_generation_config
+    if _gemini_generation_config is None:
+        _gemini_generation_config = genai.types.GenerationConfig(**GEMINI_GENERATION_PARAMS)
+    return _gemini_generation_config
+
+def _get_async_together_client():
+    """Асинхронный клиент Together для текущего цикла событий (None — библиотека/ключ недоступны)."""
+    if not together_configured:
+        return None
+    loop = asyncio.get_running_loop()
+    client = _async_together_clients.get(loop)
+    if client is None:
+        with _provider_lock:
+            client = _async_together_clients.get(loop)
+            if client is None:
+                from together import AsyncTogether
+                client = AsyncTogether(api_key=TOGETHER_API_KEY)
+                _async_together_clients[loop] = client
+    return client
+
+def _together_delta_text(chunk) -> Optional[str]:
+    if not getattr(chunk, "choices", None):
+        return None
+    delta = getattr(chunk.choices[0], "delta", None)
+    return getattr(delta, "content", None) if delta is not None else None
+
+def _gemini_block_message(response) -> str:
+    block_reason = response.prompt_feedback.block_reason
+    print(f"⚠️ Запрос к Gemini заблокирован. Причина: {block_reason}")
+    for rating in response.candidates[0].safety_ratings:
+         print(f"   - Категория: {rating.category}, Вероятность: {rating.probability}")
+    return f"Ответ не может быть сгенерирован из-за ограничений безопасности (Причина: {block_reason}). Попробуйте переформулировать запрос."
+
+def _gemini_response_text(response) -> str:
+    """Текст ответа Gemini или сообщение о причине, по которой его нет."""
+    try:
+        if response.text:
+            print(">> Gemini вернул текст.")
+            return response.text
+        else:
+            print(">> Gemini НЕ вернул текст. Проверяем причины...")
+            if response.prompt_feedback.block_reason:
+                return _gemini_block_message(response)
+            else:
+                print("⚠️ Gemini вернул пустой ответ без явной причины блокировки.")
+                print(f"   Полный ответ: {response}")
+                return LLM_EMPTY_ANSWER_MESSAGE
+    except ValueError:
+         print(">> ValueError при доступе к response.text. Проверяем блокировку...")
+         if response.prompt_feedback.block_reason:
+             return _gemini_block_message(response)
+         else:
+             print("⚠️ Не удалось получить текст ответа Gemini (ValueError), причина блокировки не найдена.")
+             print(f"   Полный ответ: {response}")
+             return "Модель не вернула текстовый ответ, и причина неизвестна."
+    except Exception as e_resp:
+         print(f"❌ Ошибка при обработке ответа Gemini: {e_resp}")
+         traceback.print_exc()
+         return f"Произошла ошибка при обработке ответа Gemini: {e_resp}"
+
+def _gemini_chunk_text(chunk) -> str:
+    try:
+        return chunk.text
+    except ValueError: # Фрагмент без текста (например, только причина остановки)
+        return ""
+
+def _gemini_empty_stream_message(response) -> str:
+    feedback = getattr(response, "prompt_feedback", None)
+    block_reason = getattr(feedback, "block_reason", None)
+    if block_reason:
+        print(f"⚠️ Запрос к Gemini заблокирован. Причина: {block_reason}")
+        return f"Ответ не может быть сгенерирован из-за ограничений безопасности (Причина: {block_reason}). Попробуйте переформулировать запрос."
+    print("⚠️ Gemini вернул пустой потоковый ответ без явной причины блокировки.")
+    return LLM_EMPTY_ANSWER_MESSAGE
+
+# --- Заглушка 'mock' ---
+_MOCK_QUESTION_RE = re.compile(r"--- ПОСЛЕДНИЙ ВОПРОС ПОЛЬЗОВАТЕЛЯ ---\s*(.*?)\s*(?:--- ТВОЙ ОТВЕТ ---|$)", re.S)
+
+def _mock_plan(prompt: str) -> Tuple[Optional[str], float, List[str]]:
+    """(текст ошибки или None, задержка до первого фрагмента, фрагменты ответа) по профилю LLM_MOCK_*."""
+    rng = random.Random()
+    first_token_s = max(0.0, LLM_MOCK_FIRST_TOKEN_S + rng.uniform(-LLM_MOCK_JITTER_S, LLM_MOCK_JITTER_S))
+    if LLM_MOCK_ERROR_RATE > 0 and rng.random() < LLM_MOCK_ERROR_RATE:
+        return "Произошла ошибка при обращении к языковой модели Mock: случайная ошибка (LLM_MOCK_ERROR_RATE).", first_token_s, []
+    match = _MOCK_QUESTION_RE.search(prompt)
+    question = " ".join((match.group(1) if match else prompt[-200:]).split())
+    words = f"[mock] Ответ на вопрос «{question}»:".split()
+    words += [f"токен{i}" for i in range(max(0, LLM_MOCK_ANSWER_TOKENS - len(words)))]
+    size = max(1, LLM_MOCK_TOKENS_PER_CHUNK)
+    return None, first_token_s, [" ".join(words[i:i + size]) + " " for i in range(0, len(words), size)]
+
+def _mock_chunk_delay(chunk: str) -> float:
+    return len(chunk.split()) / LLM_MOCK_TOKENS_PER_S if LLM_MOCK_TOKENS_PER_S > 0 else 0.0
+
+def _stream_mock_internal(prompt: str, system_prompt: str = SYSTEM_PROMPT) -> Iterator[str]:
+    error, first_token_s, chunks = _mock_plan(prompt)
+    time.sleep(first_token_s)
+    if error:
+        yield error
+        return
+    for i, chunk in enumerate(chunks):
+        if i:
+            time.sleep(_mock_chunk_delay(chunk))
+        yield chunk
+
+async def _stream_mock_async(prompt: str, system_prompt: str = SYSTEM_PROMPT) -> AsyncIterator[str]:
+    error, first_token_s, chunks = _mock_plan(prompt)
+    await asyncio.sleep(first_token_s)
+    if error:
+        yield error
+        return
+    for i, chunk in enumerate(chunks):
+        if i:
+            await asyncio.sleep(_mock_chunk_delay(chunk))
+        yield chunk
+
 # --- Функция для вызова Together AI ---
 def _ask_together_internal(prompt: str, system_prompt: str = SYSTEM_PROMPT):
     if not together_configured or not together_client:
@@ -66,13 +260,8 @@ def _ask_together_internal(prompt: str, system_prompt: str = SYSTEM_PROMPT):
     try:
         response = together_client.chat.completions.create(
             model=TOGETHER_MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.4,
-            max_tokens=1024,
-            top_p=0.95
+            messages=_together_messages(prompt, system_prompt),
+            **TOGETHER_GENERATION_PARAMS
         )
         print(">> Запрос к Together AI выполнен.")
         return response.choices[0].message.content
@@ -87,61 +276,13 @@ def _ask_gemini_internal(prompt: str, system_prompt: str = SYSTEM_PROMPT):
         return "Ошибка: Gemini API не сконфигурирован или библиотека не установлена."
     print(f">> Отправка запроса в Gemini (модель: {GEMINI_MODEL_NAME})...")
     try:
-        model = genai.GenerativeModel(
-            GEMINI_MODEL_NAME,
-            system_instruction=system_prompt
-        )
-        user_prompt = prompt
-        generation_config = genai.types.GenerationConfig(
-            temperature=0.4,
-            top_p=0.95
-        )
-        safety_settings = {
-            'HARM_CATEGORY_HARASSMENT': 'BLOCK_MEDIUM_AND_ABOVE',
-            'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_MEDIUM_AND_ABOVE',
-            'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_MEDIUM_AND_ABOVE',
-            'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_MEDIUM_AND_ABOVE',
-        }
-        response = model.generate_content(
-            user_prompt,
-            generation_config=generation_config,
-            safety_settings=safety_settings
+        response = _get_gemini_model(system_prompt).generate_content(
+            prompt,
+            generation_config=_get_gemini_generation_config(),
+            safety_settings=GEMINI_SAFETY_SETTINGS
         )
         print(">> Запрос к Gemini выполнен.")
-        # Обработка ответа (как в предыдущем примере)
-        try:
-            if response.text:
-                print(">> Gemini вернул текст.")
-                return response.text
-            else:
-                print(">> Gemini НЕ вернул текст. Проверяем причины...")
-                if response.prompt_feedback.block_reason:
-                    block_reason = response.prompt_feedback.block_reason
-                    print(f"⚠️ Запрос к Gemini заблокирован. Причина: {block_reason}")
-                    for rating in response.candidates[0].safety_ratings:
-                         print(f"   - Категория: {rating.category}, Вероятность: {rating.probability}")
-                    return f"Ответ не может быть сгенерирован из-за ограничений безопасности (Причина: {block_reason}). Попробуйте переформулировать запрос."
-                else:
-                    print("⚠️ Gemini вернул пустой ответ без явной причины блокировки.")
-                    print(f"   Полный ответ: {response}")
-                    return "Модель не смогла сгенерировать ответ на данный запрос (пустой ответ)."
-        except ValueError:
-             print(">> ValueError при доступе к response.text. Проверяем блокировку...")
-             if response.prompt_feedback.block_reason:
-                 block_reason = response.prompt_feedback.block_reason
-                 print(f"⚠️ Запрос к Gemini заблокирован (ValueError). Причина: {block_reason}")
-                 for rating in response.candidates[0].safety_ratings:
-                     print(f"   - Категория: {rating.category}, Вероятность: {rating.probability}")
-                 return f"Ответ не может быть сгенерирован из-за ограничений безопасности (Причина: {block_reason}). Попробуйте переформулировать запрос."
-             else:
-                 print("⚠️ Не удалось получить текст ответа Gemini (ValueError), причина блокировки не найдена.")
-                 print(f"   Полный ответ: {response}")
-                 return "Модель не вернула текстовый ответ, и причина неизвестна."
-        except Exception as e_resp:
-             print(f"❌ Ошибка при обработке ответа Gemini: {e_resp}")
-             traceback.print_exc()
-             return f"Произошла ошибка при обработке ответа Gemini: {e_resp}"
-
+        return _gemini_response_text(response)
     except Exception as e:
         print(f"❌ КРИТИЧЕСКАЯ Ошибка при запросе к Gemini API: {e}")
         traceback.print_exc()
@@ -151,16 +292,94 @@ def _ask_gemini_internal(prompt: str, system_prompt: str = SYSTEM_PROMPT):
 def ask_llm(llm_choice: str, prompt: str, system_prompt: str = SYSTEM_PROMPT):
     """
     Вызывает выбранную LLM.
-    llm_choice: 'together' или 'gemini'
+    llm_choice: 'together', 'gemini' или 'mock' (локальная заглушка)
     """
     if llm_choice == 'together':
         return _ask_together_internal(prompt, system_prompt)
     elif llm_choice == 'gemini':
         return _ask_gemini_internal(prompt, system_prompt)
+    elif llm_choice == 'mock':
+        return "".join(_stream_mock_internal(prompt, system_prompt))
     else:
         print(f"⚠️ Неизвестный выбор LLM: {llm_choice}. Используется заглушка.")
         return "Ошибка: Неизвестный тип LLM."
 
+# --- Асинхронные потоковые вызовы: фрагменты ответа отдаются по мере генерации, ожидание — в цикле событий ---
+async def _stream_together_async(prompt: str, system_prompt: str = SYSTEM_PROMPT) -> AsyncIterator[str]:
+    if not together_configured:
+        yield "Ошибка: Together AI не сконфигурирован или библиотека не установлена."
+        return
+    print(f">> Асинхронный потоковый запрос в Together AI (модель: {TOGETHER_MODEL_NAME})...")
+    produced = False
+    try:
+        stream = await _get_async_together_client().chat.completions.create(
+            model=TOGETHER_MODEL_NAME,
+            messages=_together_messages(prompt, system_prompt),
+            stream=True,
+            **TOGETHER_GENERATION_PARAMS
+        )
+        async for chunk in stream:
+            text = _together_delta_text(chunk)
+            if text:
+                produced = True
+                yield text
+        print(">> Потоковый ответ Together AI завершен.")
+    except Exception as e:
+        print(f"❌ Ошибка при потоковом запросе к Together API: {e}")
+        traceback.print_exc()
+        yield ("\n\n" if produced else "") + f"Произошла ошибка при обращении к языковой модели Together AI: {e}"
+
+async def _stream_gemini_async(prompt: str, system_prompt: str = SYSTEM_PROMPT) -> AsyncIterator[str]:
+    if not gemini_configured or not genai:
+        yield "Ошибка: Gemini API не сконфигурирован или библиотека не установлена."
+        return
+    print(f">> Асинхронный потоковый запрос в Gemini (модель: {GEMINI_MODEL_NAME})...")
+    produced = False
+    try:
+        response = await _get_gemini_model(system_prompt).generate_content_async(
+            prompt,
+            generation_config=_get_gemini_generation_config(),
+            safety_settings=GEMINI_SAFETY_SETTINGS,
+            stream=True
+        )
+        async for chunk in response:
+            text = _gemini_chunk_text(chunk)
+            if text:
+                produced = True
+                yield text
+        if not produced:
+            yield _gemini_empty_stream_message(response)
+        print(">> Потоковый ответ Gemini завершен.")
+    except Exception as e:
+        print(f"❌ КРИТИЧЕСКАЯ Ошибка при потоковом запросе к Gemini API: {e}")
+        traceback.print_exc()
+        yield ("\n\n" if produced else "") + f"Произошла критическая ошибка при обращении к языковой модели Gemini: {e}"
+
+async def _stream_unknown_async(llm_choice: str) -> AsyncIterator[str]:
+    print(f"⚠️ Неизвестный выбор LLM: {llm_choice}. Используется заглушка.")
+    yield "Ошибка: Неизвестный тип LLM."
+
+def is_llm_configured(llm_choice: str) -> bool:
+    """True, если провайдер сконфигурирован (есть ключ и установлена библиотека)."""
+    if llm_choice == 'together':
+        return together_configured
+    if llm_choice == 'gemini':
+        return gemini_configured
+    return llm_choice == 'mock' # Заглушка доступна всегда
+
+def ask_llm_stream_async(llm_choice: str, prompt: str, system_prompt: str = SYSTEM_PROMPT) -> AsyncIterator[str]:
+    """
+    Потоковый вызов выбранной LLM: `async for delta in ask_llm_stream_async(...)` — фрагменты (дельты) ответа.
+    Ошибки не выбрасываются, а приходят последним фрагментом с текстом ошибки — как в ask_llm.
+    """
+    if llm_choice == 'together':
+        return _stream_together_async(prompt, system_prompt)
+    elif llm_choice == 'gemini':
+        return _stream_gemini_async(prompt, system_prompt)
+    elif llm_choice == 'mock':
+        return _stream_mock_async(prompt, system_prompt)
+    return _stream_unknown_async(llm_choice)
+
 # Оставляем ask_together для возможной обратной совместимости или тестов,
 # но теперь она просто вызывает ask_llm с выбором 'together'.
 # В run_app.py будем использовать ask_llm.
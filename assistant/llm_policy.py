@@ -0,0 +1,328 @@
+# --- START OF FILE llm_policy.py ---
+# Политика вызова LLM поверх потоковых вызовов провайдеров (Together, Gemini):
+#   * таймаут на первый фрагмент ответа и на паузу между фрагментами;
+#   * ограниченные повторы с экспоненциальной задержкой и случайным разбросом (jitter);
+#   * хеджирование: если основной провайдер не ответил за свой p95 времени до первого фрагмента,
+#     параллельно запускается запрос к другому сконфигурированному провайдеру, побеждает ответивший первым;
+#   * автоматический выключатель (circuit breaker): провайдер с серией ошибок временно обходится.
+# Повторы и переключение возможны только до первого фрагмента — показанный пользователю текст не переигрывается.
+# Временными считаются только исключения при обращении к API и таймауты. Детерминированные ответы (блокировка
+# по безопасности, пустой ответ модели, "не сконфигурирован") возвращаются как есть: без повторов, без ошибок
+# выключателя и без переключения на другого провайдера (иначе блокировка обходилась бы через другую модель).
+# Провайдеры передаются в LLMPolicy явно, поэтому их можно заменить локальными заглушками с заданной задержкой.
+
+import os
+import sys
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+import numpy as np
+
+from assistant.llm_client import ask_llm_stream_async, is_llm_configured, is_llm_transient_error, LLM_EMPTY_ANSWER_MESSAGE, SYSTEM_PROMPT
+
+LLM_FIRST_TOKEN_TIMEOUT_S = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT_S", "30"))
+LLM_STREAM_IDLE_TIMEOUT_S = float(os.getenv("LLM_STREAM_IDLE_TIMEOUT_S", "30")) # Макс. пауза между фрагментами
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2")) # Повторы на провайдера (не считая первой попытки)
+LLM_RETRY_BASE_DELAY_S = float(os.getenv("LLM_RETRY_BASE_DELAY_S", "0.5"))
+LLM_RETRY_MAX_DELAY_S = float(os.getenv("LLM_RETRY_MAX_DELAY_S", "4"))
+LLM_HEDGING_ENABLED = os.getenv("LLM_HEDGING_ENABLED", "1").strip().lower() in ("1", "true", "yes", "on")
+LLM_HEDGE_DEFAULT_DELAY_S = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_S", "5")) # Пока не набрана статистика p95
+LLM_HEDGE_MIN_DELAY_S = float(os.getenv("LLM_HEDGE_MIN_DELAY_S", "0.5"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5")) # Ошибок подряд до размыкания
+LLM_BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN_S", "30"))
+
+class LLMProviderError(Exception):
+    """Провайдер не вернул ответ из-за временной ошибки: исключение при обращении к API или таймаут."""
+
+class CircuitOpenError(LLMProviderError):
+    """Провайдер временно отключен выключателем."""
+
+class LLMProvider:
+    """Провайдер для политики: stream(prompt, system_prompt) — асинхронный генератор фрагментов ответа."""
+
+    def __init__(self, name: str, stream: Callable[[str, str], AsyncIterator[str]], available: Callable[[], bool] = lambda: True,
+                 failover: bool = True):
+        self.name = name
+        self.stream = stream
+        self.available = available
+        self.failover = failover # False — провайдер используется только если выбран явно (не как хедж/резерв)
+
+def default_providers() -> Dict[str, LLMProvider]:
+    """Провайдеры llm_client: Together, Gemini и локальная заглушка mock (только при явном выборе)."""
+    return {name: LLMProvider(name, lambda prompt, system_prompt, name=name: ask_llm_stream_async(name, prompt, system_prompt),
+                              lambda name=name: is_llm_configured(name), failover=(name != "mock"))
+            for name in ("together", "gemini", "mock")}
+
+class CircuitBreaker:
+    """
+    closed — запросы идут; после failure_threshold ошибок подряд — open на cooldown_s;
+    затем half_open — пропускается одна пробная попытка: успех замыкает, ошибка снова размыкает.
+    """
+
+    def __init__(self, failure_threshold: int = LLM_BREAKER_FAILURES, cooldown_s: float = LLM_BREAKER_COOLDOWN_S):
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown_s = cooldown_s
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self._opened_at >= self.cooldown_s else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown_s or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self) -> bool:
+        """Учитывает ошибку; True — выключатель только что разомкнулся."""
+        with self._lock:
+            self._failures += 1
+            was_closed = self._opened_at is None
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+                return was_closed
+            return False
+
+    def release_trial(self) -> None:
+        """Пробная попытка отменена (проиграла хедж) — без вывода о здоровье провайдера."""
+        with self._lock:
+            self._trial_in_flight = False
+
+class _ProviderState:
+    def __init__(self, provider: LLMProvider, breaker: CircuitBreaker, window: int):
+        self.provider = provider
+        self.breaker = breaker
+        self.first_token_s: Deque[float] = deque(maxlen=window)
+        self.calls = 0
+        self.failures = 0
+        self.hedges = 0 # Сколько раз этот провайдер запускался как хедж
+        self.wins = 0
+
+    def p95(self, min_samples: int) -> Optional[float]:
+        samples = list(self.first_token_s)
+        if len(samples) < min_samples:
+            return None
+        return float(np.percentile(samples, 95))
+
+class LLMPolicy:
+    """Потоковый вызов LLM с таймаутами, повторами, хеджированием и выключателями по провайдерам."""
+
+    def __init__(self, providers: Optional[Dict[str, LLMProvider]] = None,
+                 first_token_timeout_s: float = LLM_FIRST_TOKEN_TIMEOUT_S, idle_timeout_s: float = LLM_STREAM_IDLE_TIMEOUT_S,
+                 max_retries: int = LLM_MAX_RETRIES, retry_base_delay_s: float = LLM_RETRY_BASE_DELAY_S,
+                 retry_max_delay_s: float = LLM_RETRY_MAX_DELAY_S, hedging: bool = LLM_HEDGING_ENABLED,
+                 hedge_default_delay_s: float = LLM_HEDGE_DEFAULT_DELAY_S, hedge_min_delay_s: float = LLM_HEDGE_MIN_DELAY_S,
+                 hedge_min_samples: int = LLM_HEDGE_MIN_SAMPLES, latency_window: int = LLM_LATENCY_WINDOW,
+                 breaker_failures: int = LLM_BREAKER_FAILURES, breaker_cooldown_s: float = LLM_BREAKER_COOLDOWN_S):
+        providers = default_providers() if providers is None else providers
+        self._states = {name: _ProviderState(provider, CircuitBreaker(breaker_failures, breaker_cooldown_s), latency_window)
+                        for name, provider in providers.items()}
+        self.first_token_timeout_s = first_token_timeout_s
+        self.idle_timeout_s = idle_timeout_s
+        self.max_retries = max(0, max_retries)
+        self.retry_base_delay_s = retry_base_delay_s
+        self.retry_max_delay_s = retry_max_delay_s
+        self.hedging = hedging
+        self.hedge_default_delay_s = hedge_default_delay_s
+        self.hedge_min_delay_s = hedge_min_delay_s
+        self.hedge_min_samples = hedge_min_samples
+
+    def _route(self, llm_choice: str) -> List[_ProviderState]:
+        """Порядок провайдеров: выбранный, затем остальные; отключенные выключателем — в конец."""
+        chosen = self._states.get(llm_choice)
+        if chosen is not None and not chosen.provider.failover:
+            return [chosen] if chosen.provider.available() else [] # mock не смешивается с реальными провайдерами
+        names = [llm_choice] + [name for name, state in self._states.items() if name != llm_choice and state.provider.failover]
+        states = [self._states[name] for name in names if name in self._states and self._states[name].provider.available()]
+        return sorted(states, key=lambda state: state.breaker.state == "open") # sorted устойчив: порядок внутри групп сохраняется
+
+    def _hedge_delay(self, state: _ProviderState) -> float:
+        p95 = state.p95(self.hedge_min_samples)
+        return max(self.hedge_min_delay_s, p95 if p95 is not None else self.hedge_default_delay_s)
+
+    def _retry_delay(self, attempt: int) -> float:
+        # Full jitter: случайная задержка от 0 до экспоненциального предела
+        return random.uniform(0.0, min(self.retry_max_delay_s, self.retry_base_delay_s * (2 ** attempt)))
+
+    async def _open_stream(self, state: _ProviderState, prompt: str, system_prompt: str) -> Tuple[AsyncIterator[str], str]:
+        """
+        Одна попытка: открывает поток и ждет первый фрагмент. Возвращает (поток, первый фрагмент).
+        LLMProviderError — только временные ошибки; пустой поток и детерминированные ответы-ошибки возвращаются как ответ.
+        """
+        stream = state.provider.stream(prompt, system_prompt).__aiter__()
+        try:
+            first = await asyncio.wait_for(stream.__anext__(), timeout=self.first_token_timeout_s)
+        except StopAsyncIteration: # Модель ответила пустым потоком — повтор дал бы то же самое
+            return stream, LLM_EMPTY_ANSWER_MESSAGE
+        except asyncio.TimeoutError:
+            await _close_stream(stream)
+            raise LLMProviderError(f"нет ответа за {self.first_token_timeout_s:g} с")
+        except BaseException:
+            await _close_stream(stream)
+            raise
+        if is_llm_transient_error(first):
+            await _close_stream(stream)
+            raise LLMProviderError(first)
+        return stream, first
+
+    async def _attempt_with_retries(self, state: _ProviderState, prompt: str, system_prompt: str) -> Tuple[AsyncIterator[str], str]:
+        name = state.provider.name
+        last_error: Optional[BaseException] = None
+        for attempt in range(self.max_retries + 1):
+            if not state.breaker.allow():
+                if last_error is None:
+                    raise CircuitOpenError(f"{name}: выключатель разомкнут")
+                break
+            state.calls += 1
+            started = time.perf_counter()
+            try:
+                stream, first = await self._open_stream(state, prompt, system_prompt)
+            except asyncio.CancelledError:
+                state.breaker.release_trial()
+                raise
+            except Exception as e:
+                last_error = e
+                state.failures += 1
+                if state.breaker.record_failure():
+                    sys.stderr.write(f"⚠️ LLM '{name}': выключатель разомкнут на {state.breaker.cooldown_s:.0f} с после ошибок подряд.\n")
+                sys.stderr.write(f"⚠️ LLM '{name}': попытка {attempt + 1}/{self.max_retries + 1} не удалась: {str(e)[:200]}\n")
+                if attempt < self.max_retries:
+                    await asyncio.sleep(self._retry_delay(attempt))
+                continue
+            state.breaker.record_success()
+            state.first_token_s.append(time.perf_counter() - started)
+            return stream, first
+        raise LLMProviderError(f"{name}: {last_error}")
+
+    async def _first_fragment(self, llm_choice: str, prompt: str, system_prompt: str) -> Tuple[_ProviderState, AsyncIterator[str], str]:
+        """Гонка за первый фрагмент: основной провайдер, хедж/переключение на следующий. Проигравшие отменяются."""
+        route = self._route(llm_choice)
+        if not route:
+            raise LLMProviderError("нет сконфигурированных провайдеров")
+        if route[0].provider.name != llm_choice:
+            print(f"🔀 LLM '{llm_choice}' недоступен, запрос идет в '{route[0].provider.name}'.")
+        pending_route = list(route)
+        tasks: Dict[asyncio.Task, _ProviderState] = {}
+        errors: List[str] = []
+
+        def launch(hedge: bool) -> None:
+            state = pending_route.pop(0)
+            if hedge:
+                state.hedges += 1
+            tasks[asyncio.ensure_future(self._attempt_with_retries(state, prompt, system_prompt))] = state
+
+        launch(hedge=False)
+        hedge_at = time.monotonic() + self._hedge_delay(route[0])
+        try:
+            while tasks:
+                timeout = None
+                if self.hedging and pending_route and len(tasks) == 1:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                done, _ = await asyncio.wait(tasks.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    print(f"⏱️ LLM '{route[0].provider.name}' не ответил за p95 ({self._hedge_delay(route[0]):.1f} с), "
+                          f"хедж-запрос в '{pending_route[0].provider.name}'.")
+                    launch(hedge=True)
+                    continue
+                for task in done:
+                    state = tasks.pop(task)
+                    if task.exception() is None:
+                        stream, first = task.result()
+                        state.wins += 1
+                        return state, stream, first
+                    errors.append(str(task.exception()))
+                if not tasks and pending_route:
+                    # Все запущенные провайдеры отказали — переключение на следующий без ожидания хеджа
+                    print(f"🔀 Переключение на LLM '{pending_route[0].provider.name}'.")
+                    launch(hedge=False)
+        finally:
+            # Проигравшие попытки отменяются; успевшие открыть поток — закрываются
+            for task in tasks:
+                task.cancel()
+            for outcome in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(outcome, tuple):
+                    await _close_stream(outcome[0])
+        raise LLMProviderError("; ".join(errors))
+
+    async def stream(self, llm_choice: str, prompt: str, system_prompt: str = SYSTEM_PROMPT) -> AsyncIterator[str]:
+        """
+        Фрагменты ответа, как у ask_llm_stream_async. Если ни один провайдер не ответил —
+        единственный фрагмент с текстом ошибки (начинается с "Ошибка:", в кэш ответов не попадает).
+        """
+        try:
+            state, stream, first = await self._first_fragment(llm_choice, prompt, system_prompt)
+        except LLMProviderError as e:
+            sys.stderr.write(f"❌ LLM: ни один провайдер не ответил: {e}\n")
+            yield f"Ошибка: языковая модель недоступна ({str(e)[:300]}). Попробуйте позже."
+            return
+        yield first
+        try:
+            while True:
+                try:
+                    delta = await asyncio.wait_for(stream.__anext__(), timeout=self.idle_timeout_s)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    sys.stderr.write(f"⚠️ LLM '{state.provider.name}': поток прерван, нет фрагментов {self.idle_timeout_s:g} с.\n")
+                    yield "\n\nПроизошла ошибка при обращении к языковой модели: ответ прерван по таймауту."
+                    break
+                yield delta
+        finally:
+            await _close_stream(stream)
+
+    async def ask(self, llm_choice: str, prompt: str, system_prompt: str = SYSTEM_PROMPT) -> str:
+        return "".join([delta async for delta in self.stream(llm_choice, prompt, system_prompt)])
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние провайдеров: выключатель, p95 времени до первого фрагмента, вызовы, ошибки, хеджи, победы."""
+        return {name: {"breaker": state.breaker.state, "p95_first_token_s": state.p95(1), "calls": state.calls,
+                       "failures": state.failures, "hedges": state.hedges, "wins": state.wins}
+                for name, state in self._states.items()}
+
+async def _close_stream(stream: Any) -> None:
+    close = getattr(stream, "aclose", None)
+    if close is not None:
+        try:
+            await close()
+        except BaseException:
+            pass
+
+# --- Общий экземпляр для приложения ---
+_llm_policy: Optional[LLMPolicy] = None
+_llm_policy_lock = threading.Lock()
+
+def get_llm_policy() -> LLMPolicy:
+    global _llm_policy
+    if _llm_policy is None:
+        with _llm_policy_lock:
+            if _llm_policy is None:
+                _llm_policy = LLMPolicy()
+    return _llm_policy
+
+def stream_llm_with_policy(llm_choice: str, prompt: str, system_prompt: str = SYSTEM_PROMPT) -> AsyncIterator[str]:
+    """Потоковый вызов LLM через общую политику: `async for delta in stream_llm_with_policy(...)`."""
+    return get_llm_policy().stream(llm_choice, prompt, system_prompt)
+
+# --- END OF FILE llm_policy.py ---
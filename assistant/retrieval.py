@@ -0,0 +1,74 @@
+# --- START OF FILE retrieval.py ---
+# Адаптивная глубина поиска вместо фиксированных top_k=20 и 7 чанков контекста.
+#   * плоское распределение скоров (последний кандидат почти так же близок, как первый) — поиск расширяется;
+#   * явный разрыв между соседними скорами — кандидаты ниже разрыва отбрасываются до ре-ранкинга;
+#   * в контекст попадают только чанки выше порога релевантности (абсолютного и относительно лучшего).
+# RETRIEVAL_MODE=fixed возвращает прежнее поведение.
+
+import os
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+from assistant.search_engine import semantic_search
+
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "adaptive").strip().lower() # adaptive | fixed
+RETRIEVAL_FIXED_K = int(os.getenv("RETRIEVAL_FIXED_K", "20"))
+RETRIEVAL_INITIAL_K = int(os.getenv("RETRIEVAL_INITIAL_K", "12"))
+RETRIEVAL_MAX_K = int(os.getenv("RETRIEVAL_MAX_K", "48"))
+RETRIEVAL_MIN_CANDIDATES = int(os.getenv("RETRIEVAL_MIN_CANDIDATES", "3")) # Разрыв не режет выше этой позиции
+RETRIEVAL_FLAT_SPREAD = float(os.getenv("RETRIEVAL_FLAT_SPREAD", "0.05")) # top1 - topK меньше — распределение плоское
+RETRIEVAL_SCORE_GAP = float(os.getenv("RETRIEVAL_SCORE_GAP", "0.08")) # Разрыв между соседними скорами
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE", "0.35")) # Абсолютный порог для контекста
+RETRIEVAL_MAX_SCORE_DROP = float(os.getenv("RETRIEVAL_MAX_SCORE_DROP", "0.2")) # Насколько чанк контекста может уступать лучшему
+
+SearchResults = List[Tuple[Dict[str, Any], float]]
+
+def _is_flat(scores: Sequence[float], spread: float) -> bool:
+    return len(scores) > 1 and (scores[0] - scores[-1]) < spread
+
+def _gap_cut(scores: Sequence[float], gap: float, min_keep: int) -> Optional[int]:
+    """Позиция первого разрыва >= gap после min_keep кандидатов (None — разрыва нет)."""
+    if len(scores) <= max(1, min_keep):
+        return None
+    drops = -np.diff(np.asarray(scores, dtype=np.float64))
+    candidates = np.flatnonzero(drops[max(1, min_keep) - 1:] >= gap)
+    return int(candidates[0]) + max(1, min_keep) if candidates.size else None
+
+def adaptive_search(query_vector: np.ndarray, filters: Optional[Dict[str, Any]] = None,
+                    search_fn: Callable[..., SearchResults] = semantic_search) -> Tuple[SearchResults, Dict[str, Any]]:
+    """
+    Поиск кандидатов с адаптивной глубиной. Возвращает результаты (по убыванию скора) и сведения для лога:
+    {"mode", "top_k" — итоговая глубина поиска, "widened" — число расширений, "gap_cut" — позиция среза или None}.
+    """
+    if RETRIEVAL_MODE == "fixed":
+        results = search_fn(query_vector, top_k=RETRIEVAL_FIXED_K, filters=filters)
+        return results, {"mode": "fixed", "top_k": RETRIEVAL_FIXED_K, "widened": 0, "gap_cut": None}
+
+    top_k = max(1, min(RETRIEVAL_INITIAL_K, RETRIEVAL_MAX_K))
+    results = search_fn(query_vector, top_k=top_k, filters=filters)
+    widened = 0
+    # Индекс исчерпан, если вернулось меньше top_k — расширять некуда
+    while len(results) == top_k and top_k < RETRIEVAL_MAX_K and _is_flat([s for _, s in results], RETRIEVAL_FLAT_SPREAD):
+        top_k = min(RETRIEVAL_MAX_K, top_k * 2)
+        results = search_fn(query_vector, top_k=top_k, filters=filters)
+        widened += 1
+
+    cut = _gap_cut([s for _, s in results], RETRIEVAL_SCORE_GAP, RETRIEVAL_MIN_CANDIDATES)
+    if cut is not None:
+        results = results[:cut]
+    return results, {"mode": "adaptive", "top_k": top_k, "widened": widened, "gap_cut": cut}
+
+def cut_context(items: Sequence[Any], limit: int, semantic_score_of: Callable[[Any], float] = lambda item: item[1]) -> List[Any]:
+    """
+    Отбирает не более limit элементов рейтинга для контекста. В адаптивном режиме отбрасывает элементы,
+    чей семантический скор ниже RETRIEVAL_MIN_SCORE или уступает лучшему больше чем на RETRIEVAL_MAX_SCORE_DROP;
+    лучший по рейтингу элемент остается всегда.
+    """
+    selected = list(items[:limit])
+    if RETRIEVAL_MODE == "fixed" or len(selected) <= 1:
+        return selected
+    best = max(semantic_score_of(item) for item in items)
+    threshold = max(RETRIEVAL_MIN_SCORE, best - RETRIEVAL_MAX_SCORE_DROP)
+    return selected[:1] + [item for item in selected[1:] if semantic_score_of(item) >= threshold]
+
+# --- END OF FILE retrieval.py ---
@@ -4,161 +4,956 @@ import faiss
 import numpy as np
 import os
 import json
+import time
+import hashlib
+import heapq
+import itertools
+import threading
 import traceback
 import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Dict, Any, Optional
 
+from assistant.artifacts import CACHE_DIR, read_current_version, version_dir, list_shards, read_shard_manifest
+from assistant.chunk_store import CHUNK_STORE_FILENAME, open_chunk_store
+from assistant.embedding_store import load_embeddings
+from assistant.index_builder import (
+    INDEX_META_FILENAME, METADATA_INDEX_FILENAME, FILTERABLE_FIELDS,
+    read_index_meta, read_metadata_index, build_metadata_index, normalize_filter_value, shard_key
+)
+
 # --- Конфигурация Путей ---
-CACHE_DIR = "data/cache"
+# Артефакты лежат в data/cache/versions/<версия>/, активная версия — в data/cache/CURRENT (см. assistant/artifacts.py)
 
 # Имена файлов артефактов (должны совпадать с run_embedder.py)
-EMBEDDINGS_FILENAME = "embeddings.npy" # Хотя сами эмбеддинги не нужны для поиска с FAISS
-INDEXED_CHUNKS_FILENAME = "indexed_chunks.json"
+EMBEDDINGS_FILENAME = "embeddings.vec" # Для поиска не нужны; читаются лениво для векторов кандидатов (MMR)
+LEGACY_EMBEDDINGS_FILENAME = "embeddings.npy"
+INDEXED_CHUNKS_FILENAME = "indexed_chunks.json" # Старый формат (до chunks.sqlite), читается как запасной вариант
 FAISS_INDEX_FILENAME = "faiss_index.bin"
 
-INDEXED_CHUNKS_PATH = os.path.join(CACHE_DIR, INDEXED_CHUNKS_FILENAME)
-FAISS_INDEX_PATH = os.path.join(CACHE_DIR, FAISS_INDEX_FILENAME)
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        sys.stderr.write(f"⚠️ Некорректное значение {name}, используется {default}.\n")
+        return default
 
-# --- Глобальные переменные для кэширования индекса и данных ---
-faiss_index: Optional[faiss.Index] = None
-indexed_chunks: List[Dict[str, Any]] = []
-index_dimension: Optional[int] = None
-is_initialized: bool = False
+# Как часто фоновый поток проверяет указатель CURRENT (секунды; 0 — не следить)
+try:
+    INDEX_WATCH_INTERVAL = float(os.getenv("SEARCH_INDEX_WATCH_INTERVAL", "10"))
+except ValueError:
+    sys.stderr.write("⚠️ Некорректное значение SEARCH_INDEX_WATCH_INTERVAL, используется 10 с.\n")
+    INDEX_WATCH_INTERVAL = 10.0
 
-def _load_index_and_chunks() -> bool:
-    """Загружает FAISS индекс и соответствующие данные чанков."""
-    global faiss_index, indexed_chunks, index_dimension, is_initialized
+# Режим загрузки FAISS индекса: "mmap" — файл отображается в память и страницы разделяются
+# между процессами через page cache ОС; "memory" — индекс целиком копируется в память процесса
+INDEX_LOAD_MODE = os.getenv("SEARCH_INDEX_LOAD_MODE", "mmap").strip().lower()
+if INDEX_LOAD_MODE not in ("mmap", "memory"):
+    sys.stderr.write(f"⚠️ Неизвестный SEARCH_INDEX_LOAD_MODE='{INDEX_LOAD_MODE}', используется 'mmap'.\n")
+    INDEX_LOAD_MODE = "mmap"
+# Потоки для параллельного поиска по шардам (0 — по числу ядер)
+SHARD_SEARCH_WORKERS = max(1, _env_int("SEARCH_SHARD_WORKERS", 0) or (os.cpu_count() or 4))
 
-    if is_initialized: # Уже загружено
-        return True
+# IO_FLAG_MMAP_IFC (FAISS >= 1.11) отображает и векторы Flat/HNSW, старый IO_FLAG_MMAP — только списки IVF
+INDEX_MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
 
-    print("🔄 Инициализация поискового движка: Загрузка FAISS индекса и данных чанков...")
+def _process_memory_mb() -> Dict[str, float]:
+    """
+    Память текущего процесса в МБ: rss — всего, anon — собственная (куча), file — отображенные файлы
+    (эти страницы общие для всех процессов, открывших тот же файл). Вне Linux — только пик RSS.
+    """
+    memory: Dict[str, float] = {}
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "RssAnon", "RssFile"):
+                    memory[{"VmRSS": "rss", "RssAnon": "anon", "RssFile": "file"}[key]] = int(value.split()[0]) / 1024
+    except OSError:
+        try:
+            import resource
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            memory["rss"] = max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+        except Exception:
+            pass
+    return memory
+
+def _format_memory(memory: Dict[str, float]) -> str:
+    if not memory:
+        return "н/д"
+    parts = [f"RSS {memory.get('rss', 0):.0f} МБ"]
+    if "anon" in memory:
+        parts.append(f"собственная {memory['anon']:.0f} МБ, файловая (общая) {memory.get('file', 0):.0f} МБ")
+    return ", ".join(parts)
 
-    # --- Проверка наличия файлов ---
-    if not os.path.exists(FAISS_INDEX_PATH):
-        sys.stderr.write(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Файл FAISS индекса не найден по пути: {FAISS_INDEX_PATH}\n")
-        sys.stderr.write("   Запустите скрипт run_embedder.py для его создания.\n")
-        return False
-    if not os.path.exists(INDEXED_CHUNKS_PATH):
-        sys.stderr.write(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Файл данных индексированных чанков не найден по пути: {INDEXED_CHUNKS_PATH}\n")
-        sys.stderr.write("   Запустите скрипт run_embedder.py для его создания.\n")
-        return False
+def _read_faiss_index(path: str) -> Tuple[faiss.Index, str]:
+    """Читает FAISS индекс в режиме INDEX_LOAD_MODE; если mmap не поддерживается — обычным чтением."""
+    if INDEX_LOAD_MODE == "mmap":
+        try:
+            return faiss.read_index(path, INDEX_MMAP_FLAGS), "mmap"
+        except Exception as e:
+            sys.stderr.write(f"⚠️ Не удалось отобразить индекс в память (mmap): {e}. Индекс будет прочитан целиком.\n")
+    return faiss.read_index(path), "memory"
 
-    # --- Загрузка ---
+def _apply_default_search_params(index: faiss.Index, meta: Dict[str, Any]) -> None:
+    """Настраивает nprobe / efSearch по умолчанию из метаданных индекса (index_meta.json)."""
+    index_type = meta.get("index_type", "flat")
+    params = meta.get("index_params") or {}
+    parameter_space = faiss.ParameterSpace()
     try:
-        print(f"   Загрузка FAISS индекса из {FAISS_INDEX_PATH}...")
-        faiss_index = faiss.read_index(FAISS_INDEX_PATH)
-        index_dimension = faiss_index.d
-        print(f"   ✅ FAISS индекс загружен (Размерность: {index_dimension}, Кол-во векторов: {faiss_index.ntotal}).")
-
-        print(f"   Загрузка данных чанков из {INDEXED_CHUNKS_PATH}...")
-        with open(INDEXED_CHUNKS_PATH, "r", encoding="utf-8") as f:
-            indexed_chunks = json.load(f)
-        print(f"   ✅ Данные чанков загружены (Кол-во: {len(indexed_chunks)}).")
-
-        # --- Валидация ---
-        if faiss_index.ntotal != len(indexed_chunks):
-            sys.stderr.write("❌ КРИТИЧЕСКАЯ ОШИБКА: Несовпадение количества векторов в FAISS индексе "
-                             f"({faiss_index.ntotal}) и количества загруженных чанков ({len(indexed_chunks)}).\n")
-            sys.stderr.write("   Возможно, индекс или файл чанков устарели. Пересоздайте их (run_embedder.py).\n")
-            # Сбрасываем состояние, чтобы предотвратить поиск
-            faiss_index = None
-            indexed_chunks = []
-            index_dimension = None
-            return False
+        if "nprobe" in params:
+            parameter_space.set_index_parameter(index, "nprobe", int(params["nprobe"]))
+        if "efSearch" in params:
+            parameter_space.set_index_parameter(index, "efSearch", int(params["efSearch"]))
+        print(f"   ⚙️ Тип индекса: {index_type}, параметры: {params or '-'}")
+    except Exception as e:
+        sys.stderr.write(f"⚠️ Не удалось применить параметры поиска из метаданных индекса ({params}): {e}\n")
 
-        is_initialized = True
-        print("✅ Поисковый движок успешно инициализирован.")
-        return True
+def _make_search_params(index: faiss.Index, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                        selector: Optional[Any] = None) -> Tuple[Optional[Any], List[Any]]:
+    """
+    Собирает параметры поиска FAISS для одного вызова (nprobe для IVF, efSearch для HNSW,
+    IDSelector для поиска только по подмножеству строк).
+    Возвращает (params, keepalive): keepalive держит ссылки на вложенные объекты SWIG,
+    пока идет поиск. Если переопределять нечего — params равен None.
+    """
+    is_pretransform = isinstance(index, faiss.IndexPreTransform)
+    inner = faiss.downcast_index(index.index) if is_pretransform else index
+    keepalive: List[Any] = [selector] if selector is not None else []
+    if isinstance(inner, faiss.IndexIVF) and (nprobe or selector is not None):
+        inner_params = faiss.SearchParametersIVF()
+        inner_params.nprobe = int(nprobe or inner.nprobe)
+    elif isinstance(inner, faiss.IndexHNSW) and (ef_search or selector is not None):
+        inner_params = faiss.SearchParametersHNSW()
+        inner_params.efSearch = int(ef_search or inner.hnsw.efSearch)
+    elif selector is not None:
+        inner_params = faiss.SearchParameters()
+    else:
+        return None, keepalive
+    if selector is not None:
+        inner_params.sel = selector
+    if not is_pretransform:
+        return inner_params, keepalive
+    params = faiss.SearchParametersPreTransform()
+    params.index_params = inner_params
+    keepalive.append(inner_params)
+    return params, keepalive
 
-    except Exception as e:
-        sys.stderr.write(f"❌ Ошибка при загрузке/валидации индекса или данных чанков: {e}\n")
-        traceback.print_exc()
-        faiss_index = None
-        indexed_chunks = []
-        index_dimension = None
-        return False
-
-def semantic_search(query_vector: np.ndarray, top_k: int = 5) -> List[Tuple[Dict[str, Any], float]]:
+def _filtered_nprobe(index: faiss.Index, nprobe: Optional[int], subset_size: int) -> Optional[int]:
     """
-    Выполняет семантический поиск по предзагруженному индексу.
+    nprobe для поиска IVF с фильтром: IDSelector отбирает строки только внутри nprobe просмотренных списков,
+    поэтому число списков растет обратно пропорционально доле подмножества в индексе (не больше nlist).
+    """
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexPreTransform) else index
+    if not isinstance(inner, faiss.IndexIVF) or subset_size <= 0:
+        return nprobe
+    base = int(nprobe or inner.nprobe)
+    share = subset_size / max(inner.ntotal, 1)
+    return int(min(inner.nlist, max(base, np.ceil(base / share))))
 
-    Args:
-        query_vector (np.ndarray): Вектор запроса (уже нормализованный).
-        top_k (int): Количество возвращаемых результатов.
+class IndexShard:
+    """Артефакты одного шарда: FAISS индекс, хранилище чанков, индекс метаданных (номера строк — внутри шарда)."""
 
-    Returns:
-        list: Список кортежей [(chunk_dict, similarity_score), ...], отсортированных по убыванию схожести.
-              Или пустой список в случае ошибки.
+    def __init__(self, name: str, directory: str):
+        self.name = name
+        self.directory = directory
+        self.faiss_index: Optional[faiss.Index] = None
+        self.chunk_store: Optional[Any] = None # ChunkStore (SQLite) или InMemoryChunkStore для старого JSON
+        self.index_dimension: Optional[int] = None
+        self.index_meta: Dict[str, Any] = {}
+        self.load_mode: Optional[str] = None # "mmap" или "memory"
+        self.metadata_index: Dict[str, Dict[str, np.ndarray]] = {} # {поле: {значение: строки FAISS}} для фильтров
+        self.embeddings: Optional[Any] = None # EmbeddingMatrix (memmap), открывается при первом get_vectors
+        self._embeddings_lock = threading.Lock()
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def load(self) -> bool:
+        """Загружает FAISS индекс и соответствующие данные чанков шарда."""
+        faiss_index_path = self.path(FAISS_INDEX_FILENAME)
+        chunk_store_path = self.path(CHUNK_STORE_FILENAME)
+        indexed_chunks_path = self.path(INDEXED_CHUNKS_FILENAME)
+        metadata_index_path = self.path(METADATA_INDEX_FILENAME)
+
+        print(f"🔄 Загрузка шарда '{self.name}' ({self.directory})...")
+
+        # --- Проверка наличия файлов ---
+        if not os.path.exists(faiss_index_path):
+            sys.stderr.write(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Файл FAISS индекса не найден по пути: {faiss_index_path}\n")
+            sys.stderr.write("   Запустите скрипт run_embedder.py для его создания.\n")
+            return False
+        if not os.path.exists(chunk_store_path) and not os.path.exists(indexed_chunks_path):
+            sys.stderr.write(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Хранилище чанков не найдено по пути: {chunk_store_path}\n")
+            sys.stderr.write("   Запустите скрипт run_embedder.py для его создания.\n")
+            return False
+
+        # --- Загрузка ---
+        load_started = time.perf_counter()
+        try:
+            print(f"   Загрузка FAISS индекса из {faiss_index_path}...")
+            self.faiss_index, self.load_mode = _read_faiss_index(faiss_index_path)
+            self.index_dimension = self.faiss_index.d
+            print(f"   ✅ FAISS индекс загружен за {time.perf_counter() - load_started:.2f} с (Режим: {self.load_mode}, "
+                  f"Размерность: {self.index_dimension}, Кол-во векторов: {self.faiss_index.ntotal}, "
+                  f"Файл: {os.path.getsize(faiss_index_path) / 1024 / 1024:.1f} МБ).")
+            self.index_meta = read_index_meta(self.path(INDEX_META_FILENAME))
+            projection = self.index_meta.get("projection")
+            if projection:
+                # Проекция встроена в индекс (IndexPreTransform) и применяется к вектору запроса внутри FAISS
+                print(f"   📐 Индекс использует проекцию {str(projection.get('type')).upper()} {self.index_dimension} -> {projection.get('dim')}.")
+            _apply_default_search_params(self.faiss_index, self.index_meta)
+
+            print(f"   Открытие хранилища чанков {chunk_store_path}...")
+            self.chunk_store = open_chunk_store(chunk_store_path, indexed_chunks_path)
+            if self.chunk_store is None:
+                raise FileNotFoundError(chunk_store_path)
+            print(f"   ✅ Хранилище чанков открыто (Кол-во: {len(self.chunk_store)}).")
+
+            loaded_metadata_index = read_metadata_index(metadata_index_path)
+            if loaded_metadata_index is None:
+                # Старые артефакты без metadata_index.json: строим индекс по загруженным чанкам
+                print(f"   ⚠️ Индекс метаданных не найден ({metadata_index_path}), строится по данным чанков...")
+                loaded_metadata_index = {field: {value: np.asarray(rows, dtype=np.int64) for value, rows in values.items()}
+                                         for field, values in build_metadata_index(list(self.chunk_store.iter_chunks())).items()}
+            self.metadata_index = loaded_metadata_index
+            print(f"   ✅ Индекс метаданных готов (Поля: {', '.join(f'{k}={len(v)}' for k, v in self.metadata_index.items())}).")
+
+            # --- Валидация ---
+            if self.faiss_index.ntotal != len(self.chunk_store):
+                sys.stderr.write("❌ КРИТИЧЕСКАЯ ОШИБКА: Несовпадение количества векторов в FAISS индексе "
+                                 f"({self.faiss_index.ntotal}) и количества загруженных чанков ({len(self.chunk_store)}).\n")
+                sys.stderr.write("   Возможно, индекс или файл чанков устарели. Пересоздайте их (run_embedder.py).\n")
+                self.close()
+                return False
+
+            print(f"   ✅ Шард '{self.name}' загружен за {time.perf_counter() - load_started:.2f} с.")
+            return True
+
+        except Exception as e:
+            sys.stderr.write(f"❌ Ошибка при загрузке/валидации индекса или данных чанков: {e}\n")
+            traceback.print_exc()
+            self.close()
+            return False
+
+    def close(self) -> None:
+        if self.chunk_store is not None:
+            self.chunk_store.close()
+        # Память индекса освобождается вместе с последней ссылкой на объект
+        self.faiss_index = None
+        self.chunk_store = None
+        self.metadata_index = {}
+        self.embeddings = None
+
+    def _get_embeddings(self) -> Optional[Any]:
+        if self.embeddings is None:
+            with self._embeddings_lock:
+                if self.embeddings is None:
+                    for filename in (EMBEDDINGS_FILENAME, LEGACY_EMBEDDINGS_FILENAME):
+                        if os.path.exists(self.path(filename)):
+                            self.embeddings = load_embeddings(self.path(filename), mmap=True)
+                            break
+        return self.embeddings
+
+    def get_vectors(self, chunk_ids: List[str]) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """
+        Эмбеддинги чанков шарда по ID (строки memmap файла эмбеддингов, номера строк — как в FAISS).
+        Возвращает (матрица (n, d) float32 | None, маска найденных); строки ненайденных — нули.
+        """
+        found = np.zeros(len(chunk_ids), dtype=bool)
+        embeddings = self._get_embeddings()
+        if embeddings is None or self.chunk_store is None:
+            return None, found
+        rows = self.chunk_store.rows_of(chunk_ids)
+        found = np.fromiter((row is not None and row < len(embeddings) for row in rows), dtype=bool, count=len(rows))
+        vectors = np.zeros((len(chunk_ids), embeddings.dim), dtype=np.float32)
+        if found.any():
+            vectors[found] = embeddings.get_rows([row for row, ok in zip(rows, found) if ok])
+        return vectors, found
+
+    # --- Поиск ---
+    def resolve_filter_rows(self, filters: Dict[str, Any]) -> Optional[np.ndarray]:
+        """
+        Превращает фильтр {поле: значение | [значения]} в отсортированный массив строк FAISS.
+        Значения одного поля объединяются (ИЛИ), разные поля пересекаются (И).
+        Возвращает None, если фильтр пустой, и пустой массив, если ничего не подходит.
+        """
+        rows: Optional[np.ndarray] = None
+        for field, wanted in filters.items():
+            if wanted is None:
+                continue
+            if field not in self.metadata_index:
+                raise ValueError(f"Поле '{field}' не поддерживается фильтром (доступно: {', '.join(FILTERABLE_FIELDS)}).")
+            values = wanted if isinstance(wanted, (list, tuple, set)) else [wanted]
+            postings = [self.metadata_index[field].get(normalize_filter_value(v)) for v in values]
+            postings = [p for p in postings if p is not None and p.size]
+            field_rows = np.unique(np.concatenate(postings)) if postings else np.empty((0,), dtype=np.int64)
+            rows = field_rows if rows is None else np.intersect1d(rows, field_rows, assume_unique=True)
+            if rows.size == 0:
+                break
+        return rows
+
+    def _search_rows_exact(self, queries_f32: np.ndarray, top_k: int,
+                           rows: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Точный поиск по небольшому подмножеству строк (фильтр): скалярное произведение с их эмбеддингами.
+        Возвращает (scores, indices) как у faiss search или None, если эмбеддинги шарда недоступны.
+        """
+        embeddings = self._get_embeddings()
+        if embeddings is None or len(embeddings) != self.faiss_index.ntotal or embeddings.dim != queries_f32.shape[1]:
+            return None
+        row_scores = queries_f32 @ embeddings.get_rows(rows).T # (запросы, строки подмножества)
+        k = min(top_k, rows.size)
+        if k < rows.size:
+            order = np.argpartition(-row_scores, k - 1, axis=1)[:, :k]
+        else:
+            order = np.broadcast_to(np.arange(rows.size), row_scores.shape)
+        top_scores = np.take_along_axis(row_scores, order, axis=1)
+        ranked = np.argsort(-top_scores, axis=1, kind="stable")
+        return np.take_along_axis(top_scores, ranked, axis=1), rows[np.take_along_axis(order, ranked, axis=1)]
+
+    def search_batch(self, queries_f32: np.ndarray, top_k: int,
+                     nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                     filters: Optional[Dict[str, Any]] = None) -> List[List[Tuple[Dict[str, Any], float]]]:
+        """Поиск по шарду; ошибки пишутся в stderr, результат при ошибке — пустой список."""
+        # --- Фильтр по метаданным -> IDSelector ---
+        selector = None
+        filter_rows: Optional[np.ndarray] = None
+        if filters:
+            try:
+                filter_rows = self.resolve_filter_rows(filters)
+            except ValueError as e:
+                sys.stderr.write(f"❌ Ошибка фильтра поиска: {e}\n")
+                return []
+            if filter_rows is not None:
+                if filter_rows.size == 0:
+                    return [[] for _ in range(queries_f32.shape[0])]
+                selector = faiss.IDSelectorBatch(filter_rows)
+                # IVF ищет только в просмотренных списках: узкий фильтр без этого вернул бы меньше top_k совпадений
+                nprobe = _filtered_nprobe(self.faiss_index, nprobe, filter_rows.size)
+
+        # --- Выполнение поиска ---
+        batch_results: List[List[Tuple[Dict[str, Any], float]]] = []
+        try:
+            # Небольшое подмножество строк дешевле и точнее перебрать по эмбеддингам, чем искать в индексе
+            exact = None
+            if filter_rows is not None and filter_rows.size <= FILTER_EXACT_MAX_ROWS:
+                exact = self._search_rows_exact(queries_f32, top_k, filter_rows)
+            if exact is not None:
+                scores, indices = exact
+            else:
+                # index.search возвращает схожести (scores) и индексы (indices) для всего батча
+                search_params, _keepalive = _make_search_params(self.faiss_index, nprobe, ef_search, selector)
+                if search_params is not None:
+                    scores, indices = self.faiss_index.search(queries_f32, top_k, params=search_params)
+                else:
+                    scores, indices = self.faiss_index.search(queries_f32, top_k)
+
+            # Все найденные строки батча читаются из хранилища одним запросом
+            valid_rows = [int(idx) for idx in np.unique(indices) if idx >= 0]
+            chunks_by_row = dict(zip(valid_rows, self.chunk_store.get_many(valid_rows)))
+
+            for query_indices, query_scores in zip(indices, scores):
+                results_with_scores: List[Tuple[Dict[str, Any], float]] = []
+                for rank, (idx, score) in enumerate(zip(query_indices, query_scores)):
+                    if idx == -1: # FAISS возвращает -1, если найдено меньше k
+                        break
+                    chunk = chunks_by_row.get(int(idx))
+                    if chunk is not None:
+                        results_with_scores.append((chunk, float(score)))
+                    else:
+                        # Эта ошибка не должна возникать при корректной связке индекса и данных
+                        sys.stderr.write(f"⚠️ Предупреждение: Получен невалидный индекс ({idx}) от FAISS "
+                                         f"(ранг {rank+1}). Кол-во чанков в хранилище: {len(self.chunk_store)}.\n")
+                batch_results.append(results_with_scores)
+
+        except Exception as e:
+             sys.stderr.write(f"❌ Ошибка во время выполнения FAISS поиска: {e}\n")
+             traceback.print_exc()
+             return [] # Возвращаем пустой список при ошибке
+
+        # Все типы индексов используют METRIC_INNER_PRODUCT. Для нормализованных векторов
+        # это эквивалентно косинусному сходству. FAISS сортирует по убыванию.
+        return batch_results
+
+class IndexSnapshot:
+    """
+    Неизменяемый набор артефактов одной версии: один или несколько шардов (IndexShard).
+    Запросы берут снимок через acquire()/release(); после замены на новую версию старый снимок
+    помечается retire() и закрывается, когда его отпустит последний запрос.
     """
-    global faiss_index, indexed_chunks, index_dimension, is_initialized
 
-    # --- Инициализация при первом вызове ---
-    if not is_initialized:
-        if not _load_index_and_chunks():
-            # Если инициализация не удалась, поиск невозможен
+    def __init__(self, version: str):
+        self.version = version
+        self.directory = version_dir(version)
+        self.shards: List[IndexShard] = []
+        self.index_dimension: Optional[int] = None
+        self.shard_by: Optional[str] = None # Поле шардирования из shards.json (None — версия не шардирована)
+        self._refcount = 0
+        self._retired = False
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Загружает все шарды версии и проверяет, что у них одна размерность."""
+        print(f"🔄 Загрузка версии индекса '{self.version}' ({self.directory})...")
+        load_started = time.perf_counter()
+        memory_before = _process_memory_mb()
+        try:
+            shard_dirs = list_shards(self.version)
+        except Exception as e:
+            sys.stderr.write(f"❌ Не удалось прочитать список шардов версии '{self.version}': {e}\n")
+            return False
+        if not shard_dirs:
+            sys.stderr.write(f"❌ КРИТИЧЕСКАЯ ОШИБКА: В версии '{self.version}' нет ни одного шарда.\n")
+            return False
+        manifest = read_shard_manifest(self.directory)
+        self.shard_by = manifest.get("shard_by") if manifest else None
+
+        for name, directory in shard_dirs:
+            shard = IndexShard(name, directory)
+            if not shard.load():
+                self.close()
+                return False
+            self.shards.append(shard)
+        dimensions = {shard.index_dimension for shard in self.shards}
+        if len(dimensions) != 1:
+            sys.stderr.write(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Шарды версии '{self.version}' имеют разную размерность: {sorted(dimensions)}.\n")
+            self.close()
+            return False
+        self.index_dimension = dimensions.pop()
+
+        memory_after = _process_memory_mb()
+        total_vectors = sum(shard.faiss_index.ntotal for shard in self.shards)
+        print(f"✅ Версия индекса '{self.version}' загружена за {time.perf_counter() - load_started:.2f} с "
+              f"(Шардов: {len(self.shards)}, Векторов: {total_vectors}).")
+        if memory_after:
+            anon_delta = memory_after.get("anon", memory_after.get("rss", 0)) - memory_before.get("anon", memory_before.get("rss", 0))
+            print(f"   💾 Память процесса: {_format_memory(memory_after)}; собственная память выросла на {anon_delta:.0f} МБ.")
+        return True
+
+    # --- Учет использования ---
+    def acquire(self) -> None:
+        with self._lock:
+            self._refcount += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self._refcount -= 1
+            should_close = self._retired and self._refcount == 0
+        if should_close:
+            self.close()
+
+    def retire(self) -> None:
+        """Снимок больше не активен: закрыть сразу, если он не занят, иначе — после последнего release()."""
+        with self._lock:
+            self._retired = True
+            should_close = self._refcount == 0
+        if should_close:
+            self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for shard in self.shards:
+            shard.close()
+        if self._retired:
+            print(f"♻️ Версия индекса '{self.version}' освобождена.")
+
+    # --- Поиск ---
+    def search_batch(self, queries_f32: np.ndarray, top_k: int,
+                     nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                     filters: Optional[Dict[str, Any]] = None,
+                     executor: Optional[ThreadPoolExecutor] = None) -> List[List[Tuple[Dict[str, Any], float]]]:
+        """
+        Scatter-gather: каждый шард ищет свои top_k параллельно в пуле потоков executor (FAISS отпускает GIL;
+        без executor — по очереди), затем отсортированные списки шардов сливаются heapq.merge в общий рейтинг.
+        """
+        if len(self.shards) == 1:
+            return self.shards[0].search_batch(queries_f32, top_k, nprobe=nprobe, ef_search=ef_search, filters=filters)
+
+        unknown_fields = [field for field in (filters or {}) if field not in FILTERABLE_FIELDS]
+        if unknown_fields:
+            sys.stderr.write(f"❌ Ошибка фильтра поиска: Поле '{unknown_fields[0]}' не поддерживается фильтром "
+                             f"(доступно: {', '.join(FILTERABLE_FIELDS)}).\n")
+            return []
+
+        if executor is not None:
+            futures = [executor.submit(shard.search_batch, queries_f32, top_k, nprobe, ef_search, filters) for shard in self.shards]
+            shard_outputs = [future.result() for future in futures]
+        else:
+            shard_outputs = [shard.search_batch(queries_f32, top_k, nprobe, ef_search, filters) for shard in self.shards]
+        shard_results = []
+        for shard, results in zip(self.shards, shard_outputs):
+            if len(results) != queries_f32.shape[0]:
+                # Ошибка в одном шарде не должна ронять поиск по остальным
+                sys.stderr.write(f"⚠️ Шард '{shard.name}' не вернул результатов, он пропущен при слиянии.\n")
+                continue
+            shard_results.append(results)
+        if not shard_results:
             return []
 
-    # --- Проверка входных данных ---
-    if faiss_index is None or index_dimension is None: # Дополнительная проверка
-        sys.stderr.write("❌ Ошибка поиска: FAISS индекс не инициализирован.\n")
-        return []
-    if query_vector is None or query_vector.size == 0:
-        sys.stderr.write("❌ Ошибка поиска: Получен пустой вектор запроса.\n")
-        return []
+        return [list(itertools.islice(heapq.merge(*per_shard, key=lambda item: -item[1]), top_k))
+                for per_shard in zip(*shard_results)]
+
+    def get_vectors(self, chunks: List[Dict[str, Any]]) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """
+        Эмбеддинги чанков из результатов поиска. Шард чанка определяется по полю шардирования;
+        чанки, которых в нем не оказалось, ищутся в остальных шардах.
+        """
+        ids = [str(chunk.get("id")) for chunk in chunks]
+        found = np.zeros(len(chunks), dtype=bool)
+        vectors: Optional[np.ndarray] = None
+
+        def fill(shard: IndexShard, positions: List[int]) -> None:
+            nonlocal vectors
+            shard_vectors, shard_found = shard.get_vectors([ids[i] for i in positions])
+            if shard_vectors is None:
+                return
+            if vectors is None:
+                vectors = np.zeros((len(chunks), shard_vectors.shape[1]), dtype=np.float32)
+            for i, vector, ok in zip(positions, shard_vectors, shard_found):
+                if ok:
+                    vectors[i] = vector
+                    found[i] = True
+
+        if len(self.shards) == 1 or not self.shard_by:
+            fill(self.shards[0], list(range(len(chunks))))
+            return vectors, found
+        routes: Dict[str, List[int]] = {}
+        for i, chunk in enumerate(chunks):
+            routes.setdefault(shard_key(chunk, self.shard_by), []).append(i)
+        for shard in self.shards:
+            if shard.name in routes:
+                fill(shard, routes[shard.name])
+        for shard in self.shards:
+            missing = np.flatnonzero(~found)
+            if missing.size == 0:
+                break
+            fill(shard, missing.tolist())
+        return vectors, found
+
+# --- Бюджет потоков ---
+# FAISS распараллеливает поиск через OpenMP, и при одновременных запросах из очереди Gradio
+# N запросов x M потоков OpenMP перегружают CPU. Поэтому каждый запрос получает фиксированный
+# бюджет потоков FAISS, а число одновременных поисков ограничено семафором.
+CPU_COUNT = os.cpu_count() or 4
+FAISS_THREADS = max(1, _env_int("SEARCH_FAISS_THREADS", 1)) # Потоков OpenMP на один поиск
+MAX_CONCURRENT_SEARCHES = max(1, _env_int("SEARCH_MAX_CONCURRENCY", 0) or max(1, CPU_COUNT // FAISS_THREADS))
 
-    # --- Подготовка вектора запроса ---
+_thread_budget = threading.local()
+
+def _apply_faiss_thread_budget(threads: int) -> None:
+    """Число потоков OpenMP — настройка потока, поэтому выставляется в каждом потоке, который вызывает FAISS."""
+    if getattr(_thread_budget, "faiss_threads", None) != threads:
+        faiss.omp_set_num_threads(threads)
+        _thread_budget.faiss_threads = threads
+
+# --- Поиск с фильтром ---
+# Подмножество строк фильтра не больше этого размера ищется точным перебором по эмбеддингам шарда (0 — всегда через индекс)
+FILTER_EXACT_MAX_ROWS = max(0, _env_int("SEARCH_FILTER_EXACT_MAX_ROWS", 20000))
+
+# --- Кэш результатов поиска ---
+# Популярные вопросы дают один и тот же вектор запроса: результат берется из LRU без faiss.search и чтения чанков.
+RESULT_CACHE_SIZE = max(0, _env_int("SEARCH_RESULT_CACHE_SIZE", 1024)) # 0 — кэш выключен
+# Компоненты вектора округляются с шагом 1/SCALE: практически одинаковые векторы попадают в один ключ
+RESULT_CACHE_QUANTIZATION = max(1, _env_int("SEARCH_RESULT_CACHE_QUANTIZATION", 256))
+
+def _query_count(query_vectors: Any) -> int:
+    """Число запросов в батче (1D вектор — один запрос); 0, если форму определить нельзя."""
+    if query_vectors is None:
+        return 0
     try:
-        # FAISS ожидает float32
-        query_vector_f32 = query_vector.astype(np.float32)
-        # FAISS ожидает 2D массив (batch_size, dim)
-        if query_vector_f32.ndim == 1:
-            query_vector_f32 = np.expand_dims(query_vector_f32, axis=0)
-
-        # Проверка размерности
-        query_dim = query_vector_f32.shape[1]
-        if query_dim != index_dimension:
-            sys.stderr.write(f"❌ Ошибка: Размерность вектора запроса ({query_dim}) "
-                             f"не совпадает с размерностью индекса ({index_dimension}).\n")
+        shape = np.shape(query_vectors)
+    except Exception:
+        return 0
+    if len(shape) == 0:
+        return 0
+    return 1 if len(shape) == 1 else int(shape[0])
+
+def _filters_cache_key(filters: Optional[Dict[str, Any]]) -> str:
+    """Канонический вид фильтра: порядок полей и значений, регистр и одиночное значение vs список не важны."""
+    if not filters:
+        return ""
+    canonical = {}
+    for field, wanted in filters.items():
+        if wanted is None:
+            continue
+        values = wanted if isinstance(wanted, (list, tuple, set)) else [wanted]
+        canonical[field] = sorted({normalize_filter_value(v) for v in values})
+    return json.dumps(canonical, sort_keys=True, ensure_ascii=False)
+
+class SearchResultCache:
+    """LRU кэш результатов: ключ — версия индекса, квантованный вектор запроса, top_k, параметры поиска и фильтр."""
+
+    def __init__(self, max_size: int = RESULT_CACHE_SIZE, quantization: int = RESULT_CACHE_QUANTIZATION):
+        self.max_size = max_size
+        self.quantization = quantization
+        self._entries: "OrderedDict[bytes, List[Tuple[Dict[str, Any], float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, version: str, query_f32: np.ndarray, top_k: int, nprobe: Optional[int],
+                 ef_search: Optional[int], filters_key: str) -> bytes:
+        quantized = np.round(query_f32 * self.quantization).astype(np.int32)
+        digest = hashlib.blake2b(quantized.tobytes(), digest_size=16)
+        digest.update(f"|{version}|{top_k}|{nprobe}|{ef_search}|{filters_key}".encode("utf-8"))
+        return digest.digest()
+
+    def get(self, key: bytes) -> Optional[List[Tuple[Dict[str, Any], float]]]:
+        with self._lock:
+            results = self._entries.get(key)
+            if results is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return list(results) # Новый список; сами чанки общие — вызывающий код их не изменяет
+
+    def put(self, key: bytes, results: List[Tuple[Dict[str, Any], float]]) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = list(results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+class SearchEngine:
+    """
+    Поисковый движок: активный снимок индекса, фоновый подхват новых версий и ограничение параллелизма.
+    Инициализация защищена блокировкой (первый запрос из любого потока загружает индекс ровно один раз);
+    каждый поиск выполняется в пределах FAISS_THREADS потоков OpenMP и не более MAX_CONCURRENT_SEARCHES одновременно.
+    Повторные запросы обслуживаются из result_cache (сбрасывается при смене версии индекса).
+    """
+
+    def __init__(self, faiss_threads: int = FAISS_THREADS, max_concurrent_searches: int = MAX_CONCURRENT_SEARCHES,
+                 shard_workers: int = SHARD_SEARCH_WORKERS, watch_interval: float = INDEX_WATCH_INTERVAL,
+                 result_cache_size: int = RESULT_CACHE_SIZE):
+        self.faiss_threads = max(1, int(faiss_threads))
+        self.max_concurrent_searches = max(1, int(max_concurrent_searches))
+        self.shard_workers = max(1, int(shard_workers))
+        self.watch_interval = watch_interval
+        self._active_snapshot: Optional[IndexSnapshot] = None
+        self._snapshot_lock = threading.Lock() # Короткая блокировка: только чтение/замена ссылки на снимок
+        self._load_lock = threading.Lock() # Одна загрузка версии за раз (первичная и фоновая)
+        self._failed_version: Optional[str] = None # Версия, загрузка которой не удалась (не повторяем её на каждом тике)
+        self._search_slots = threading.BoundedSemaphore(self.max_concurrent_searches)
+        self._watcher_thread: Optional[threading.Thread] = None
+        self._watcher_stop = threading.Event()
+        self._shard_executor: Optional[ThreadPoolExecutor] = None
+        self._shard_executor_lock = threading.Lock()
+        self.result_cache = SearchResultCache(max_size=result_cache_size)
+
+    # --- Снимки ---
+    def _get_shard_executor(self) -> ThreadPoolExecutor:
+        """Пул потоков для поиска по шардам (создается при первом шардированном поиске)."""
+        if self._shard_executor is None:
+            with self._shard_executor_lock:
+                if self._shard_executor is None:
+                    self._shard_executor = ThreadPoolExecutor(
+                        max_workers=self.shard_workers, thread_name_prefix="search-shard",
+                        initializer=_apply_faiss_thread_budget, initargs=(self.faiss_threads,))
+        return self._shard_executor
+
+    def _acquire_snapshot(self) -> Optional[IndexSnapshot]:
+        """Возвращает активный снимок с увеличенным счетчиком использования (или None)."""
+        with self._snapshot_lock:
+            snapshot = self._active_snapshot
+            if snapshot is not None:
+                snapshot.acquire()
+            return snapshot
+
+    def _swap_snapshot(self, snapshot: IndexSnapshot) -> None:
+        """Атомарно делает снимок активным; предыдущий освобождается, когда его отпустят текущие запросы."""
+        with self._snapshot_lock:
+            previous, self._active_snapshot = self._active_snapshot, snapshot
+        # Результаты старой версии больше не нужны (ключи с версией всё равно не совпали бы)
+        self.result_cache.clear()
+        if previous is not None:
+            print(f"🔁 Активная версия индекса: '{previous.version}' -> '{snapshot.version}'.")
+            previous.retire()
+
+    def reload_index(self, version: Optional[str] = None) -> bool:
+        """
+        Загружает указанную (по умолчанию — текущую из CURRENT) версию и переключает на неё поиск.
+        Запросы, начатые до переключения, дорабатывают на старом снимке. Возвращает True при успехе.
+        """
+        with self._load_lock:
+            version = version or read_current_version()
+            if version is None:
+                sys.stderr.write("❌ КРИТИЧЕСКАЯ ОШИБКА: Не найдена ни одна версия индекса.\n")
+                sys.stderr.write("   Запустите скрипт run_embedder.py для его создания.\n")
+                return False
+            if self._active_snapshot is not None and self._active_snapshot.version == version:
+                return True
+            snapshot = IndexSnapshot(version)
+            if not snapshot.load():
+                self._failed_version = version
+                return False
+            self._failed_version = None
+            self._swap_snapshot(snapshot)
+            return True
+
+    def ensure_initialized(self) -> bool:
+        """Загружает индекс при первом обращении; одновременные первые запросы ждут одну загрузку."""
+        if self._active_snapshot is not None:
+            return True
+        return self.reload_index()
+
+    def get_index_version(self) -> Optional[str]:
+        """Версия активного индекса (None, если индекс еще не загружен)."""
+        snapshot = self._active_snapshot
+        return snapshot.version if snapshot is not None else None
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Статистика кэша результатов: размер, попадания, промахи, доля попаданий."""
+        return self.result_cache.stats()
+
+    def get_chunk_vectors(self, chunks: List[Dict[str, Any]]) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """Эмбеддинги чанков (из результатов поиска) по активной версии: (матрица (n, d) | None, маска найденных)."""
+        if not chunks or not self.ensure_initialized():
+            return None, np.zeros(len(chunks), dtype=bool)
+        snapshot = self._acquire_snapshot()
+        if snapshot is None:
+            return None, np.zeros(len(chunks), dtype=bool)
+        try:
+            return snapshot.get_vectors(chunks)
+        except Exception as e:
+            sys.stderr.write(f"⚠️ Не удалось получить эмбеддинги кандидатов: {e}\n")
+            return None, np.zeros(len(chunks), dtype=bool)
+        finally:
+            snapshot.release()
+
+    def get_index_dimension(self) -> Optional[int]:
+        """Размерность векторов запросов активного индекса."""
+        snapshot = self._active_snapshot
+        return snapshot.index_dimension if snapshot is not None else None
+
+    def index_stats(self) -> Optional[Dict[str, Any]]:
+        """Активный индекс: версия, число векторов и шардов, размерность (None, если индекс еще не загружен)."""
+        snapshot = self._active_snapshot
+        if snapshot is None:
+            return None
+        return {"version": snapshot.version, "vectors": sum(shard.faiss_index.ntotal for shard in snapshot.shards),
+                "shards": len(snapshot.shards), "dimension": snapshot.index_dimension}
+
+    # --- Фоновое наблюдение за CURRENT ---
+    def _watch_current_pointer(self, interval: float) -> None:
+        while not self._watcher_stop.wait(interval):
+            try:
+                version = read_current_version()
+                active = self._active_snapshot
+                if version is None or version == self._failed_version or (active is not None and active.version == version):
+                    continue
+                print(f"🆕 Обнаружена новая версия индекса '{version}', загрузка в фоне...")
+                if not self.reload_index(version):
+                    sys.stderr.write(f"⚠️ Версия '{version}' не загружена, поиск продолжает работать на текущей.\n")
+            except Exception as e:
+                sys.stderr.write(f"⚠️ Ошибка фонового обновления индекса: {e}\n")
+                traceback.print_exc()
+
+    def start_index_watcher(self, interval: Optional[float] = None) -> None:
+        """Запускает фоновый поток, который следит за указателем CURRENT и подхватывает новые версии."""
+        interval = self.watch_interval if interval is None else interval
+        if interval <= 0 or (self._watcher_thread is not None and self._watcher_thread.is_alive()):
+            return
+        self._watcher_stop.clear()
+        self._watcher_thread = threading.Thread(target=self._watch_current_pointer, args=(interval,),
+                                                name="search-index-watcher", daemon=True)
+        self._watcher_thread.start()
+        print(f"👀 Наблюдение за новыми версиями индекса включено (каждые {interval:g} с).")
+
+    def stop_index_watcher(self) -> None:
+        self._watcher_stop.set()
+
+    # --- Поиск ---
+    def search_batch(self, query_vectors: np.ndarray, top_k: int = 5,
+                     nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                     filters: Optional[Dict[str, Any]] = None) -> List[List[Tuple[Dict[str, Any], float]]]:
+        """См. semantic_search_batch."""
+        # При любой ошибке — пустой список на каждый запрос: результаты остаются сопоставимы со списком запросов
+        query_count = _query_count(query_vectors)
+        no_results = lambda: [[] for _ in range(query_count)]
+
+        # --- Инициализация при первом вызове ---
+        if not self.ensure_initialized():
+            # Если инициализация не удалась, поиск невозможен
+            return no_results()
+
+        if query_vectors is None or query_vectors.size == 0:
+            sys.stderr.write("❌ Ошибка поиска: Получен пустой вектор запроса.\n")
+            return no_results()
+
+        # --- Подготовка векторов запросов ---
+        try:
+            # FAISS ожидает C-contiguous float32 массив (batch_size, dim)
+            queries_f32 = np.ascontiguousarray(query_vectors, dtype=np.float32)
+            if queries_f32.ndim == 1:
+                queries_f32 = np.expand_dims(queries_f32, axis=0)
+        except Exception as e:
+            sys.stderr.write(f"❌ Ошибка при подготовке вектора запроса для FAISS: {e}\n")
+            traceback.print_exc()
+            return no_results()
+
+        snapshot = self._acquire_snapshot()
+        if snapshot is None: # Дополнительная проверка
+            sys.stderr.write("❌ Ошибка поиска: FAISS индекс не инициализирован.\n")
+            return no_results()
+        try:
+            # Проверка размерности
+            query_dim = queries_f32.shape[1]
+            if query_dim != snapshot.index_dimension:
+                sys.stderr.write(f"❌ Ошибка: Размерность вектора запроса ({query_dim}) "
+                                 f"не совпадает с размерностью индекса ({snapshot.index_dimension}).\n")
+                return no_results()
+
+            # --- Кэш результатов: FAISS вызывается только для запросов, которых нет в кэше ---
+            batch_results: List[Optional[List[Tuple[Dict[str, Any], float]]]] = [None] * queries_f32.shape[0]
+            cache_keys: List[Optional[bytes]] = [None] * queries_f32.shape[0]
+            if self.result_cache.max_size > 0:
+                filters_key = _filters_cache_key(filters)
+                for row in range(queries_f32.shape[0]):
+                    cache_keys[row] = self.result_cache.make_key(snapshot.version, queries_f32[row], top_k, nprobe, ef_search, filters_key)
+                    batch_results[row] = self.result_cache.get(cache_keys[row])
+            miss_rows = [row for row, results in enumerate(batch_results) if results is None]
+            if not miss_rows:
+                return batch_results
+
+            with self._search_slots:
+                _apply_faiss_thread_budget(self.faiss_threads)
+                miss_queries = queries_f32 if len(miss_rows) == queries_f32.shape[0] else np.ascontiguousarray(queries_f32[miss_rows])
+                found = snapshot.search_batch(miss_queries, top_k, nprobe=nprobe, ef_search=ef_search, filters=filters,
+                                              executor=self._get_shard_executor() if len(snapshot.shards) > 1 else None)
+            if len(found) != len(miss_rows): # Ошибка поиска — в кэш не попадает; найденные в кэше строки сохраняются
+                return [results if results is not None else [] for results in batch_results]
+            for row, results in zip(miss_rows, found):
+                batch_results[row] = results
+                if cache_keys[row] is not None:
+                    self.result_cache.put(cache_keys[row], results)
+            return batch_results
+        finally:
+            snapshot.release()
+
+    def search(self, query_vector: np.ndarray, top_k: int = 5,
+               nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+               filters: Optional[Dict[str, Any]] = None) -> List[Tuple[Dict[str, Any], float]]:
+        """См. semantic_search."""
+        if query_vector is not None and query_vector.ndim > 1 and query_vector.shape[0] != 1:
+            sys.stderr.write("❌ Ошибка поиска: semantic_search ожидает один вектор. Для батча используйте semantic_search_batch.\n")
             return []
-    except Exception as e:
-        sys.stderr.write(f"❌ Ошибка при подготовке вектора запроса для FAISS: {e}\n")
-        traceback.print_exc()
-        return []
+        batch_results = self.search_batch(query_vector, top_k=top_k, nprobe=nprobe, ef_search=ef_search, filters=filters)
+        return batch_results[0] if batch_results else []
 
-    # --- Выполнение поиска ---
-    results_with_scores: List[Tuple[Dict[str, Any], float]] = []
-    try:
-        # print(f"🔍 Поиск FAISS top_k={top_k}...") # Отладочный вывод
-        # index.search возвращает схожести (scores) и индексы (indices)
-        scores, indices = faiss_index.search(query_vector_f32, top_k)
-        # print(f"📊 Результаты FAISS raw: indices={indices}, scores={scores}") # Отладочный вывод
-
-        # scores[0] и indices[0], так как у нас batch_size=1
-        if len(indices) > 0 and len(scores) > 0:
-            for rank, (idx, score) in enumerate(zip(indices[0], scores[0])):
-                if idx == -1: # FAISS возвращает -1, если найдено меньше k
-                    break
-                if 0 <= idx < len(indexed_chunks):
-                    results_with_scores.append((indexed_chunks[idx], float(score)))
-                else:
-                    # Эта ошибка не должна возникать при корректной связке индекса и данных
-                    sys.stderr.write(f"⚠️ Предупреждение: Получен невалидный индекс ({idx}) от FAISS "
-                                     f"(ранг {rank+1}). Макс. индекс в данных: {len(indexed_chunks)-1}.\n")
-        # print(f"✅ Найдено результатов: {len(results_with_scores)}") # Отладочный вывод
+    def initialize(self) -> bool:
+        """Выполняет загрузку индекса и данных чанков заранее и включает подхват новых версий."""
+        print("🔄 Инициализация поискового движка: Загрузка FAISS индекса и данных чанков...")
+        print(f"   🧵 Бюджет потоков: FAISS {self.faiss_threads} на запрос, одновременных поисков до {self.max_concurrent_searches}.")
+        init_started = time.perf_counter()
+        initialized = self.reload_index()
+        if initialized:
+            print(f"✅ Поисковый движок успешно инициализирован за {time.perf_counter() - init_started:.2f} с "
+                  f"(версия индекса: {self.get_index_version()}, память: {_format_memory(_process_memory_mb())}).")
+        self.start_index_watcher()
+        return initialized
 
-    except Exception as e:
-         sys.stderr.write(f"❌ Ошибка во время выполнения FAISS поиска: {e}\n")
-         traceback.print_exc()
-         return [] # Возвращаем пустой список при ошибке
+    def close(self) -> None:
+        """Останавливает наблюдение и освобождает активный снимок."""
+        self.stop_index_watcher()
+        with self._snapshot_lock:
+            snapshot, self._active_snapshot = self._active_snapshot, None
+        if snapshot is not None:
+            snapshot.retire()
+        if self._shard_executor is not None:
+            self._shard_executor.shutdown(wait=False)
 
-    # IndexFlatIP возвращает скалярное произведение. Для нормализованных векторов
-    # это эквивалентно косинусному сходству. FAISS сортирует по убыванию.
-    return results_with_scores
+# --- Движок по умолчанию и функции модуля (используются в event_handlers и run_app) ---
+_default_engine: Optional[SearchEngine] = None
+_default_engine_lock = threading.Lock()
+
+def get_search_engine() -> SearchEngine:
+    """Возвращает общий для процесса SearchEngine (создается при первом обращении)."""
+    global _default_engine
+    if _default_engine is None:
+        with _default_engine_lock:
+            if _default_engine is None:
+                _default_engine = SearchEngine()
+    return _default_engine
+
+def reload_index(version: Optional[str] = None) -> bool:
+    return get_search_engine().reload_index(version)
+
+def start_index_watcher(interval: Optional[float] = None) -> None:
+    get_search_engine().start_index_watcher(interval)
+
+def stop_index_watcher() -> None:
+    get_search_engine().stop_index_watcher()
+
+def get_index_version() -> Optional[str]:
+    """Версия активного индекса (None, если индекс еще не загружен)."""
+    return get_search_engine().get_index_version()
+
+def get_chunk_vectors(chunks: List[Dict[str, Any]]) -> Tuple[Optional[np.ndarray], np.ndarray]:
+    """Эмбеддинги чанков, возвращенных поиском (см. SearchEngine.get_chunk_vectors)."""
+    return get_search_engine().get_chunk_vectors(chunks)
+
+def semantic_search_batch(query_vectors: np.ndarray, top_k: int = 5,
+                          nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                          filters: Optional[Dict[str, Any]] = None) -> List[List[Tuple[Dict[str, Any], float]]]:
+    """
+    Выполняет семантический поиск сразу для нескольких запросов одним вызовом faiss_index.search.
+
+    Args:
+        query_vectors (np.ndarray): Матрица запросов (n, d) (уже нормализованных). 1D вектор считается батчем из одного запроса.
+        top_k (int): Количество возвращаемых результатов на каждый запрос.
+        nprobe (int, optional): Число просматриваемых кластеров для IVF индексов (по умолчанию — из index_meta.json).
+        ef_search (int, optional): Ширина поиска для HNSW индексов (по умолчанию — из index_meta.json).
+        filters (dict, optional): Фильтр по метаданным {поле: значение | [значения]}, например
+            {"geo": "KZ", "tools": ["Asana", "Jira"]}. Поля: type, geo, stage, tools, document_name, table.
+            Поиск идет только по подходящим чанкам (IDSelector FAISS), а не по всему индексу.
+
+    Returns:
+        list: Для каждого запроса — список [(chunk_dict, similarity_score), ...] по убыванию схожести.
+              В случае ошибки — пустой список для каждого запроса (длина ответа равна числу запросов).
+    """
+    return get_search_engine().search_batch(query_vectors, top_k=top_k, nprobe=nprobe, ef_search=ef_search, filters=filters)
+
+def semantic_search(query_vector: np.ndarray, top_k: int = 5,
+                    nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                    filters: Optional[Dict[str, Any]] = None) -> List[Tuple[Dict[str, Any], float]]:
+    """
+    Выполняет семантический поиск по предзагруженному индексу для одного запроса.
+
+    Args:
+        query_vector (np.ndarray): Вектор запроса (уже нормализованный).
+        top_k (int): Количество возвращаемых результатов.
+        nprobe (int, optional): Число просматриваемых кластеров для IVF индексов (по умолчанию — из index_meta.json).
+        ef_search (int, optional): Ширина поиска для HNSW индексов (по умолчанию — из index_meta.json).
+        filters (dict, optional): Фильтр по метаданным (см. semantic_search_batch).
+
+    Returns:
+        list: Список кортежей [(chunk_dict, similarity_score), ...], отсортированных по убыванию схожести.
+              Или пустой список в случае ошибки.
+    """
+    return get_search_engine().search(query_vector, top_k=top_k, nprobe=nprobe, ef_search=ef_search, filters=filters)
 
 # --- Функция для предварительной загрузки (можно вызвать при старте приложения) ---
 def initialize_search_engine():
-    """Выполняет загрузку индекса и данных чанков заранее."""
-    _load_index_and_chunks()
+    """Выполняет загрузку индекса и данных чанков заранее и включает подхват новых версий."""
+    get_search_engine().initialize()
 
-# --- END OF FILE search_engine.py ---
\ No newline at end of file
+# --- END OF FILE search_engine.py ---
@@ -0,0 +1,164 @@
+# --- START OF FILE single_flight.py ---
+# Объединение одинаковых одновременных запросов (single-flight): пока вычисление по ключу выполняется,
+# остальные запросы с тем же ключом не запускают свое, а ждут его результат.
+# Нужно при всплесках после анонсов, когда десятки людей за секунды задают один и тот же вопрос:
+# эмбеддинг, поиск и вызов LLM выполняются один раз. Потоковый вариант (stream) раздает фрагменты
+# ответа всем ожидающим, опоздавшие получают уже выданное начало, затем — новые фрагменты.
+# Результат не кэшируется: после завершения следующий запрос с тем же ключом вычисляется заново.
+# SINGLE_FLIGHT_ENABLED=0 выключает объединение (каждый запрос считается сам) — для нагрузочных тестов.
+
+import os
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1").strip().lower() in ("1", "true", "yes", "on")
+
+class FlightCancelledError(RuntimeError):
+    """Общее вычисление потока отменено (не отмена самого ожидающего) — обычная ошибка, а не CancelledError."""
+
+class _Broadcast:
+    """Фрагменты потока одного вычисления и его подписчики."""
+
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk: Any) -> None:
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_change(self) -> None:
+        await self._changed.wait()
+
+class AsyncSingleFlight:
+    """Single-flight для корутин и асинхронных потоков одного цикла событий."""
+
+    def __init__(self, name: str, enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.name = name
+        self.enabled = enabled
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self._streams: Dict[Hashable, _Broadcast] = {}
+        self._stats_lock = threading.Lock()
+        self.leaders = 0 # Запросов, выполнивших вычисление
+        self.followers = 0 # Запросов, получивших результат чужого вычисления
+
+    def _count(self, leader: bool) -> None:
+        with self._stats_lock:
+            if leader:
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Результат fn() для ключа; одновременные вызовы с тем же ключом ждут одно вычисление."""
+        if not self.enabled:
+            self._count(leader=True)
+            return await fn()
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done, key=key: self._finish_call(key, done))
+            self._count(leader=True)
+        else:
+            self._count(leader=False)
+        # Отмена одного из ожидающих (в том числе первого) не отменяет общее вычисление
+        return await asyncio.shield(task)
+
+    def _finish_call(self, key: Hashable, task: asyncio.Future) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception() # Ошибка не остается "не полученной", если все ожидающие ушли
+
+    async def stream(self, key: Hashable, make_stream: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """
+        Фрагменты потока make_stream() для ключа. Поток читается одной фоновой задачей и раздается
+        всем подписчикам; если все подписчики ушли до конца, чтение потока отменяется.
+        """
+        if not self.enabled:
+            self._count(leader=True)
+            async for chunk in make_stream():
+                yield chunk
+            return
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            broadcast = _Broadcast()
+            self._streams[key] = broadcast
+            self._count(leader=True)
+
+            async def produce() -> None:
+                try:
+                    async for chunk in make_stream():
+                        broadcast.publish(chunk)
+                    broadcast.finish()
+                except asyncio.CancelledError:
+                    # Подписчикам — обычное исключение: CancelledError обошел бы их except Exception
+                    broadcast.finish(FlightCancelledError(f"{self.name}: вычисление отменено"))
+                    raise
+                except BaseException as e:
+                    broadcast.finish(e)
+                finally:
+                    if self._streams.get(key) is broadcast:
+                        del self._streams[key]
+
+            broadcast.task = asyncio.ensure_future(produce())
+        else:
+            self._count(leader=False)
+
+        broadcast.subscribers += 1
+        position = 0
+        try:
+            while True:
+                if position < len(broadcast.chunks):
+                    chunk = broadcast.chunks[position]
+                    position += 1
+                    yield chunk
+                elif broadcast.done:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+                else:
+                    await broadcast.wait_change()
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.done and broadcast.task is not None:
+                # Убираем из _streams сразу, без ожидания finally производителя: новый запрос с тем же ключом
+                # начнет свое вычисление, а не подпишется на отмененное
+                if self._streams.get(key) is broadcast:
+                    del self._streams[key]
+                broadcast.task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            total = self.leaders + self.followers
+            return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._calls) + len(self._streams),
+                    "coalesced_rate": self.followers / total if total else 0.0}
+
+# --- Общие экземпляры для этапов обработчика чата ---
+embed_flight = AsyncSingleFlight("embed")
+search_flight = AsyncSingleFlight("search")
+llm_flight = AsyncSingleFlight("llm")
+
+def normalize_flight_query(query: str) -> str:
+    """Ключ запроса: текст без лишних пробелов (регистр и пунктуация влияют на эмбеддинг и сохраняются)."""
+    return " ".join(str(query).split())
+
+def single_flight_stats() -> Dict[str, Dict[str, Any]]:
+    return {flight.name: flight.stats() for flight in (embed_flight, search_flight, llm_flight)}
+
+# --- END OF FILE single_flight.py ---
@@ -30,6 +30,43 @@ def deobfuscate_text(text: str, mask_map: dict) -> str:
         text = text.replace(token, entry["original"])
     return text
 
+# Токен обфускации: @@TYPE_xxxxxx@@ (тип — ключ patterns в верхнем регистре, 6 hex-символов uuid4)
+TOKEN_MAX_LEN = len("@@") + max(len(k) for k in patterns) + len("_") + 6 + len("@@")
+_TOKEN_PREFIX_RE = re.compile(r"@(?:@(?:[A-Z]+(?:_[0-9a-f]{0,6}(?:@@?)?)?)?)?\Z")
+_TOKEN_RE = re.compile(r"@@[A-Z]+_[0-9a-f]{6}@@")
+
+class StreamingDeobfuscator:
+    """
+    Деобфускация потокового ответа: токен может прийти разрезанным между фрагментами
+    ("...@@CONT" + "ACT_1a2b3c@@..."), поэтому хвост, похожий на начало токена, придерживается
+    до следующего фрагмента. feed() возвращает готовый к показу текст, flush() — остаток в конце потока.
+    """
+
+    def __init__(self, mask_map: dict):
+        self.mask_map = mask_map
+        self._pending = ""
+
+    def _split_point(self, text: str) -> int:
+        """Позиция, с которой хвост text может быть незаконченным токеном (len(text) — такого хвоста нет)."""
+        start = max(0, len(text) - TOKEN_MAX_LEN)
+        # Закрывающие @@ целого токена не должны приниматься за начало следующего
+        for match in _TOKEN_RE.finditer(text, max(0, start - TOKEN_MAX_LEN)):
+            start = max(start, match.end())
+        for i in range(start, len(text)):
+            if text[i] == "@" and _TOKEN_PREFIX_RE.match(text, i):
+                return i
+        return len(text)
+
+    def feed(self, delta: str) -> str:
+        text = self._pending + (delta or "")
+        cut = self._split_point(text)
+        self._pending = text[cut:]
+        return deobfuscate_text(text[:cut], self.mask_map)
+
+    def flush(self) -> str:
+        text, self._pending = self._pending, ""
+        return deobfuscate_text(text, self.mask_map)
+
 def save_map(mask_map: dict, path: str):
     with open(path, "w", encoding="utf-8") as f:
         json.dump(mask_map, f, ensure_ascii=False, indent=2)
@@ -16,6 +16,9 @@ try:
     # --- Конец изменения ---
     from assistant.llm_client import together_configured, gemini_configured
     from assistant.search_engine import initialize_search_engine
+    from assistant.embedder import configure_torch_threads
+    from assistant.cross_encoder_ranker import initialize_reranker
+    from assets.metrics import start_app_metrics # Prometheus /metrics: время этапов, кэши, очереди, индекс
     # Проверяем наличие encryptor_tools для SAFE_MODE
     from encryptor_tools import deobfuscate_text # Просто проверяем импорт
     safe_mode_possible = True
@@ -26,15 +29,20 @@ except ImportError as e:
     def create_ui(state): return gr.Markdown("Ошибка загрузки UI компонентов.")
     def authenticate(u, p): return False
     def initialize_search_engine(): pass
+    def configure_torch_threads(threads=None): pass
+    def initialize_reranker(): pass
+    def start_app_metrics(): return None
     # def load_map(p): return {} # load_map здесь не нужен, он импортируется ниже
     together_configured = False; gemini_configured = False; safe_mode_possible = False
 
 # --- Выбор LLM ---
-llm_choice = ""
+# LLM_CHOICE=together|gemini|mock задает LLM без интерактивного выбора (mock — локальная заглушка, см. LLM_MOCK_* в llm_client.py)
+llm_choice = os.getenv("LLM_CHOICE", "").strip().lower()
 available_llms = []
 if together_configured: available_llms.append("1. Together AI")
 if gemini_configured: available_llms.append("2. Google Gemini")
-if not available_llms: print("❌ Ни одна LLM не сконфигурирована!"); llm_choice = "none"
+if llm_choice in ("together", "gemini", "mock"): print(f"✅ LLM задана переменной LLM_CHOICE: {llm_choice}.")
+elif not available_llms: print("❌ Ни одна LLM не сконфигурирована!"); llm_choice = "none"
 elif len(available_llms) == 1:
     choice_str = available_llms[0]; llm_choice = "together" if "Together" in choice_str else "gemini"
     print(f"✅ Обнаружена только одна LLM: {choice_str}. Используем её.")
@@ -80,7 +88,9 @@ else:
 
 # --- Инициализация ---
 print("⏳ Инициализация поискового движка...")
+configure_torch_threads()
 initialize_search_engine()
+initialize_reranker()
 
 # --- Запуск приложения ---
 if __name__ == "__main__":
@@ -94,7 +104,9 @@ if __name__ == "__main__":
             "safe_mode": SAFE_MODE,
             "obfuscation_map": obfuscation_map
         }
+        start_app_metrics() # METRICS_ENABLED / METRICS_HOST / METRICS_PORT
         ui = create_ui(initial_app_state)
+        ui.queue() # Очередь нужна для потоковых (генераторных) обработчиков
         ui.launch(
             auth=authenticate,
             auth_message="Вход в PromoAI",
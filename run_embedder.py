@@ -2,10 +2,12 @@
 
 import os
 import json
+import shutil
 import numpy as np
 import faiss
 import sys
 import traceback
+from typing import List, Optional
 
 # --- Импорты из нашего проекта ---
 try:
@@ -15,6 +17,20 @@ try:
     # Если запускаем как скрипт, пробуем прямые импорты
     from assistant.embedder import model, embed_texts, get_embedding_dim, MODEL_NAME # Добавил MODEL_NAME
     from document_processor.common_utils import load_chunks_json
+    from assistant.embedding_store import EmbeddingMatrix, save_embeddings, load_embeddings, SUPPORTED_DTYPES
+    from assistant.chunk_store import CHUNK_STORE_FILENAME, write_chunk_store
+    from assistant.heuristic_ranker import compute_chunk_features
+    from assistant.artifacts import (
+        CACHE_DIR, SHARDS_DIRNAME, create_version_dir, version_dir, read_current_version,
+        publish_version, link_or_copy, prune_versions, shard_dir_name, write_shard_manifest, read_shard_manifest
+    )
+    from assistant.index_builder import (
+        INDEX_META_FILENAME, METADATA_INDEX_FILENAME, SUPPORTED_PROJECTIONS, SUPPORTED_INDEX_TYPES, SUPPORTED_SHARD_KEYS,
+        PROJECTION_TRAIN_SAMPLE, INDEX_TRAIN_SAMPLE,
+        sample_rows, train_projection, choose_index_type, default_index_params, build_index,
+        write_index_meta, evaluate_projection_recall, build_metadata_index, write_metadata_index,
+        group_chunks_by_shard, shard_fingerprint
+    )
     print("✅ Импорты embedder и common_utils выполнены.")
 except ImportError as e:
     sys.stderr.write(f"❌ Ошибка импорта необходимых модулей: {e}\n")
@@ -29,22 +45,234 @@ except Exception as e_imp: # Ловим другие возможные ошиб
 OUTPUT_DIR = os.path.join("data", "output")
 PROCESSED_CHUNKS_FILENAME = "processed_chunks.json"
 CHUNKS_PATH = os.path.join(OUTPUT_DIR, PROCESSED_CHUNKS_FILENAME)
-CACHE_DIR = "data/cache"
-EMBEDDINGS_FILENAME = "embeddings.npy"
-INDEXED_CHUNKS_FILENAME = "indexed_chunks.json"
+EMBEDDINGS_FILENAME = "embeddings.vec" # Формат assistant/embedding_store.py (memmap + заголовок)
+LEGACY_EMBEDDINGS_FILENAME = "embeddings.npy"
 FAISS_INDEX_FILENAME = "faiss_index.bin"
-EMBEDDINGS_PATH = os.path.join(CACHE_DIR, EMBEDDINGS_FILENAME)
-INDEXED_CHUNKS_PATH = os.path.join(CACHE_DIR, INDEXED_CHUNKS_FILENAME)
-FAISS_INDEX_PATH = os.path.join(CACHE_DIR, FAISS_INDEX_FILENAME)
+LEGACY_CHUNKS_FILENAME = "indexed_chunks.json"
+# Артефакты пишутся в data/cache/versions/<версия>/, активная версия — в data/cache/CURRENT (см. assistant/artifacts.py)
+KEEP_VERSIONS = int(os.getenv("EMBEDDER_KEEP_VERSIONS", "3")) # Сколько последних версий хранить на диске
 
-def run_embedding_pipeline():
+def _artifact_paths(directory: str) -> dict:
+    """Пути всех артефактов внутри каталога версии."""
+    return {
+        "embeddings": os.path.join(directory, EMBEDDINGS_FILENAME),
+        "chunks": os.path.join(directory, CHUNK_STORE_FILENAME),
+        "faiss_index": os.path.join(directory, FAISS_INDEX_FILENAME),
+        "index_meta": os.path.join(directory, INDEX_META_FILENAME),
+        "metadata_index": os.path.join(directory, METADATA_INDEX_FILENAME),
+    }
+
+def _current_embeddings_path() -> str:
+    """Файл эмбеддингов активной версии (для оценки проекции; у шардированной — самого большого шарда)."""
+    current = read_current_version()
+    directory = version_dir(current) if current else CACHE_DIR
+    manifest = read_shard_manifest(directory) if current else None
+    if manifest and manifest.get("shards"):
+        largest = max(manifest["shards"], key=lambda shard: shard.get("count", 0))
+        print(f"ℹ️ Версия шардирована, используются эмбеддинги самого большого шарда '{largest['name']}'.")
+        directory = os.path.join(directory, largest["dir"])
+    path = os.path.join(directory, EMBEDDINGS_FILENAME)
+    legacy_path = os.path.join(directory, LEGACY_EMBEDDINGS_FILENAME)
+    return path if os.path.exists(path) or not os.path.exists(legacy_path) else legacy_path
+
+def _publish(version: str) -> None:
+    """Переключает CURRENT на новую версию и удаляет старые версии сверх KEEP_VERSIONS."""
+    publish_version(version)
+    print(f"🔀 Активная версия индекса: {version} (работающий run_app.py подхватит её без перезапуска).")
+    removed = prune_versions(keep=KEEP_VERSIONS)
+    if removed:
+        print(f"🧹 Удалены старые версии: {', '.join(removed)}")
+
+def _discard(version: str) -> None:
+    """Удаляет недописанную версию после ошибки, чтобы она не попала в CURRENT."""
+    shutil.rmtree(version_dir(version), ignore_errors=True)
+
+def _link_artifacts(source_dir: str, target_dir: str, include_index: bool = True) -> None:
+    """Переносит неизменные артефакты шарда (или версии) в новую версию жесткими ссылками."""
+    filenames = [EMBEDDINGS_FILENAME, LEGACY_EMBEDDINGS_FILENAME, CHUNK_STORE_FILENAME, METADATA_INDEX_FILENAME]
+    if include_index:
+        filenames += [FAISS_INDEX_FILENAME, INDEX_META_FILENAME]
+    for filename in filenames:
+        source_path = os.path.join(source_dir, filename)
+        if os.path.exists(source_path):
+            link_or_copy(source_path, os.path.join(target_dir, filename))
+
+# --- Шардирование ---
+# 'none' — один индекс на все чанки; 'document_name' — шард на документ; 'department' — шард на подразделение.
+# У каждого шарда свой индекс, хранилище чанков и индекс метаданных; поиск опрашивает шарды параллельно.
+SHARD_BY = os.getenv("EMBEDDER_SHARD_BY", "none").lower()
+
+# --- Настройки хранения эмбеддингов ---
+# float16 вдвое меньше float32 на диске; int8 — ещё вдвое меньше (с масштабом на каждый вектор)
+EMBEDDINGS_DTYPE = os.getenv("EMBEDDINGS_DTYPE", "float16")
+INDEX_BUILD_BATCH_SIZE = 65536 # Сколько векторов читать из memmap за раз при пересборке индекса
+
+# --- Настройки проекции (уменьшение размерности перед индексацией) ---
+# 'none' — полная размерность; 'pca' / 'opq' — обучаемая проекция до EMBEDDER_PROJECTION_DIM
+PROJECTION_TYPE = os.getenv("EMBEDDER_PROJECTION", "none").lower()
+PROJECTION_DIM = int(os.getenv("EMBEDDER_PROJECTION_DIM", "256"))
+
+# --- Тип FAISS индекса ---
+# 'auto' выбирает тип по числу чанков (см. index_builder.choose_index_type);
+# 'flat' / 'ivf_flat' / 'ivf_pq' / 'hnsw' — явный выбор. Параметры можно переопределить через env.
+INDEX_TYPE = os.getenv("EMBEDDER_INDEX_TYPE", "auto").lower()
+INDEX_PARAM_OVERRIDES = {
+    name: int(os.environ[env_name])
+    for name, env_name in (("nlist", "EMBEDDER_IVF_NLIST"), ("nprobe", "EMBEDDER_IVF_NPROBE"), ("m", "EMBEDDER_PQ_M"),
+                           ("M", "EMBEDDER_HNSW_M"), ("efConstruction", "EMBEDDER_HNSW_EF_CONSTRUCTION"),
+                           ("efSearch", "EMBEDDER_HNSW_EF_SEARCH"))
+    if os.getenv(env_name)
+}
+
+def _build_and_save_index(matrix: EmbeddingMatrix, out_dir: str) -> bool:
+    """
+    Строит FAISS индекс по матрице эмбеддингов (с проекцией, если она включена)
+    и сохраняет его вместе с index_meta.json. Проекция хранится внутри индекса
+    (IndexPreTransform), поэтому search_engine применяет её к запросам автоматически.
+    Тип индекса и его параметры записываются в метаданные — по ним search_engine
+    настраивает nprobe/efSearch при загрузке.
+    """
+    paths = _artifact_paths(out_dir)
+    projection = None
+    projection_info = None
+    try:
+        if PROJECTION_TYPE != "none":
+            print(f"📐 Обучение проекции {PROJECTION_TYPE.upper()} {matrix.dim} -> {PROJECTION_DIM}...")
+            train_vectors = matrix.get_rows(sample_rows(matrix.count, PROJECTION_TRAIN_SAMPLE))
+            projection = train_projection(train_vectors, PROJECTION_TYPE, PROJECTION_DIM)
+            projection_info = {"type": PROJECTION_TYPE, "dim": PROJECTION_DIM}
+
+        index_dim = PROJECTION_DIM if projection else matrix.dim
+        index_type = choose_index_type(matrix.count) if INDEX_TYPE == "auto" else INDEX_TYPE
+        index_params = {**default_index_params(index_type, matrix.count, index_dim), **INDEX_PARAM_OVERRIDES}
+        if index_type == "flat":
+            index_params = {}
+        train_vectors_index = None
+        if index_type in ("ivf_flat", "ivf_pq"):
+            train_vectors_index = matrix.get_rows(sample_rows(matrix.count, INDEX_TRAIN_SAMPLE, seed=321))
+
+        print(f"🛠️ Создание FAISS индекса ({index_type}{' [auto]' if INDEX_TYPE == 'auto' else ''}) "
+              f"с размерностью {index_dim}, параметры: {index_params or '-'}...")
+        index = build_index(matrix.dim, matrix.iter_batches(INDEX_BUILD_BATCH_SIZE), projection,
+                            index_type=index_type, params=index_params, train_vectors=train_vectors_index)
+        print(f"📊 FAISS индекс создан. Количество векторов в индексе: {index.ntotal}")
+
+        print(f"💾 Сохранение FAISS индекса в {paths['faiss_index']}...")
+        faiss.write_index(index, paths["faiss_index"])
+        write_index_meta(paths["index_meta"], {
+            "model": matrix.model_name or MODEL_NAME,
+            "dim": matrix.dim,
+            "index_type": index_type,
+            "index_params": index_params,
+            "projection": projection_info,
+            "ntotal": int(index.ntotal),
+        })
+        print("✅ FAISS индекс успешно сохранен.")
+        return True
+    except Exception as e:
+        sys.stderr.write(f"❌ Ошибка при создании или сохранении FAISS индекса: {e}\n")
+        traceback.print_exc()
+        return False
+
+def _with_features(chunks: list):
+    """Чанки с предвычисленными признаками ре-ранкинга (исходные словари не изменяются)."""
+    return ({**chunk, "features": compute_chunk_features(chunk)} for chunk in chunks)
+
+def _embed_and_save(chunks: list, out_dir: str, label: str = "") -> bool:
+    """Считает эмбеддинги чанков и сохраняет в out_dir эмбеддинги, хранилище чанков, индекс метаданных и FAISS индекс."""
+    paths = _artifact_paths(out_dir)
+    texts_to_embed = [chunk.get("text", "") for chunk in chunks]
+
+    # --- ИСПРАВЛЕНИЕ: Используем MODEL_NAME для вывода ---
+    print(f"🧠 Генерация эмбеддингов для {len(texts_to_embed)} чанков{label} (Модель: {MODEL_NAME})...")
+    # --- Конец исправления ---
+    embeddings = embed_texts(texts_to_embed)
+
+    if embeddings is None or embeddings.size == 0:
+        sys.stderr.write("❌ Ошибка: Не удалось сгенерировать эмбеддинги.\n")
+        return False
+
+    print(f"🔢 Размерность эмбеддингов: {embeddings.shape[1]}")
+    print(f"🔢 Количество эмбеддингов: {embeddings.shape[0]}")
+
+    try:
+        print(f"💾 Сохранение эмбеддингов в {paths['embeddings']} (тип хранения: {EMBEDDINGS_DTYPE})...")
+        save_embeddings(paths["embeddings"], embeddings, MODEL_NAME, dtype=EMBEDDINGS_DTYPE)
+
+        print(f"💾 Сохранение соответствующих чанков в {paths['chunks']}...")
+        # Признаки для эвристического ре-ранкинга считаются здесь один раз, а не на каждый запрос
+        stored_count = write_chunk_store(paths["chunks"], _with_features(chunks))
+        print(f"   ✅ В хранилище записано чанков: {stored_count} ({os.path.getsize(paths['chunks']) / 1024 / 1024:.1f} МБ).")
+
+        # Номера строк в инвертированных индексах совпадают с номерами векторов в FAISS
+        print(f"💾 Сохранение индекса метаданных в {paths['metadata_index']}...")
+        write_metadata_index(paths["metadata_index"], build_metadata_index(chunks))
+        print("✅ Эмбеддинги, чанки и индекс метаданных сохранены.")
+    except Exception as e:
+        sys.stderr.write(f"❌ Ошибка при сохранении эмбеддингов или чанков: {e}\n")
+        traceback.print_exc()
+        return False
+
+    embedding_dim = embeddings.shape[1]
+    model_dim = get_embedding_dim()
+    if model_dim is not None and embedding_dim != model_dim:
+         print(f"⚠️ Предупреждение: Размерность сгенерированных эмбеддингов ({embedding_dim}) не совпадает с ожидаемой размерностью модели ({model_dim}).")
+
+    return _build_and_save_index(EmbeddingMatrix(None, MODEL_NAME, "float32", embeddings), out_dir)
+
+def _current_shards(shard_by: str) -> dict:
+    """Шарды активной версии {имя: {"dir", "fingerprint"}}, если она шардирована по тому же ключу."""
+    current = read_current_version()
+    if current is None:
+        return {}
+    directory = version_dir(current)
+    manifest = read_shard_manifest(directory)
+    if not manifest or manifest.get("shard_by") != shard_by:
+        return {}
+    return {shard["name"]: {"dir": os.path.join(directory, shard["dir"]), "fingerprint": shard.get("fingerprint")}
+            for shard in manifest.get("shards", [])}
+
+def _build_shards(chunks: list, out_dir: str, full_rebuild: bool = False) -> bool:
+    """
+    Раскладывает чанки по шардам (SHARD_BY) и собирает артефакты каждого шарда в out_dir/shards/<шард>/.
+    Шарды, содержимое которых не изменилось с активной версии (тот же отпечаток), не пересчитываются:
+    их артефакты переносятся жесткими ссылками. full_rebuild=True пересчитывает все шарды.
+    """
+    groups = group_chunks_by_shard(chunks, SHARD_BY)
+    print(f"🧩 Шардирование по '{SHARD_BY}': {len(groups)} шард(ов).")
+    previous = {} if full_rebuild else _current_shards(SHARD_BY)
+    manifest_shards = []
+    reused = 0
+    for shard_name, shard_chunks in groups.items():
+        dir_name = shard_dir_name(shard_name)
+        shard_dir = os.path.join(out_dir, SHARDS_DIRNAME, dir_name)
+        os.makedirs(shard_dir, exist_ok=True)
+        fingerprint = shard_fingerprint(shard_chunks, MODEL_NAME)
+        previous_shard = previous.get(shard_name)
+        if (previous_shard and previous_shard["fingerprint"] == fingerprint
+                and os.path.exists(os.path.join(previous_shard["dir"], FAISS_INDEX_FILENAME))):
+            print(f"♻️ Шард '{shard_name}' не изменился ({len(shard_chunks)} чанков), артефакты взяты из активной версии.")
+            _link_artifacts(previous_shard["dir"], shard_dir)
+            reused += 1
+        else:
+            print(f"🧩 Шард '{shard_name}': {len(shard_chunks)} чанков.")
+            if not _embed_and_save(shard_chunks, shard_dir, label=f" шарда '{shard_name}'"):
+                return False
+        manifest_shards.append({"name": shard_name, "dir": f"{SHARDS_DIRNAME}/{dir_name}",
+                                "count": len(shard_chunks), "fingerprint": fingerprint})
+    write_shard_manifest(out_dir, {"shard_by": SHARD_BY, "model": MODEL_NAME, "shards": manifest_shards})
+    print(f"✅ Шарды готовы: пересчитано {len(groups) - reused}, без изменений {reused}.")
+    return True
+
+def run_embedding_pipeline(full_rebuild: bool = False):
     """
     Запускает полный процесс создания эмбеддингов и FAISS-индекса.
+    При шардировании (EMBEDDER_SHARD_BY) пересчитываются только изменившиеся шарды, если не указан full_rebuild.
     """
     print("-" * 60)
     print("🚀 Запуск процесса создания эмбеддингов и FAISS индекса...")
     print(f"📂 Исходные чанки: {CHUNKS_PATH}")
-    print(f"💾 Артефакты будут сохранены в: {CACHE_DIR}")
+    print(f"💾 Артефакты будут сохранены в новую версию внутри: {CACHE_DIR}")
     print("-" * 60)
 
     if model is None:
@@ -66,79 +294,165 @@ def run_embedding_pipeline():
 
     print(f"📊 Загружено чанков: {len(chunks)}")
 
-    texts_to_embed = [chunk.get("text", "") for chunk in chunks]
-    valid_indices = [i for i, text in enumerate(texts_to_embed) if text and text.strip()]
-    if len(valid_indices) != len(texts_to_embed):
-        print(f"⚠️ Предупреждение: Обнаружено {len(texts_to_embed) - len(valid_indices)} пустых чанков. Они будут пропущены при эмбеддинге.")
-        valid_chunks = [chunks[i] for i in valid_indices]
-        valid_texts = [texts_to_embed[i] for i in valid_indices]
+    valid_chunks = [chunk for chunk in chunks if chunk.get("text", "") and chunk.get("text", "").strip()]
+    if len(valid_chunks) != len(chunks):
+        print(f"⚠️ Предупреждение: Обнаружено {len(chunks) - len(valid_chunks)} пустых чанков. Они будут пропущены при эмбеддинге.")
         if not valid_chunks:
             print("⚠️ Предупреждение: Не осталось валидных непустых чанков для эмбеддинга.")
             return
         chunks = valid_chunks
-        texts_to_embed = valid_texts
         print(f"📊 Осталось валидных чанков для эмбеддинга: {len(chunks)}")
 
-    # --- ИСПРАВЛЕНИЕ: Используем MODEL_NAME для вывода ---
-    print(f"🧠 Генерация эмбеддингов для {len(texts_to_embed)} чанков (Модель: {MODEL_NAME})...")
-    # --- Конец исправления ---
-    embeddings = embed_texts(texts_to_embed)
-
-    if embeddings is None or embeddings.size == 0:
-        sys.stderr.write("❌ Ошибка: Не удалось сгенерировать эмбеддинги.\n")
-        return
-
-    print(f"🔢 Размерность эмбеддингов: {embeddings.shape[1]}")
-    print(f"🔢 Количество эмбеддингов: {embeddings.shape[0]}")
-
+    version = create_version_dir()
+    out_dir = version_dir(version)
+    print(f"🏷️ Новая версия артефактов: {version}")
     try:
-        print(f"💾 Сохранение эмбеддингов в {EMBEDDINGS_PATH}...")
-        np.save(EMBEDDINGS_PATH, embeddings.astype(np.float32))
-
-        print(f"💾 Сохранение соответствующих чанков в {INDEXED_CHUNKS_PATH}...")
-        with open(INDEXED_CHUNKS_PATH, "w", encoding="utf-8") as f:
-            json.dump(chunks, f, indent=2, ensure_ascii=False, default=str)
-        print("✅ Эмбеддинги и чанки сохранены.")
+        if SHARD_BY == "none":
+            built = _embed_and_save(chunks, out_dir)
+        else:
+            built = _build_shards(chunks, out_dir, full_rebuild=full_rebuild)
     except Exception as e:
-        sys.stderr.write(f"❌ Ошибка при сохранении эмбеддингов или чанков: {e}\n")
+        sys.stderr.write(f"❌ Ошибка при создании версии {version}: {e}\n")
         traceback.print_exc()
+        built = False
+    if not built:
+        _discard(version)
         return
+    _publish(version)
 
-    embedding_dim = embeddings.shape[1]
-    model_dim = get_embedding_dim()
-    if model_dim is not None and embedding_dim != model_dim:
-         print(f"⚠️ Предупреждение: Размерность сгенерированных эмбеддингов ({embedding_dim}) не совпадает с ожидаемой размерностью модели ({model_dim}).")
+    print("-" * 60)
+    print("🎉 Процесс создания эмбеддингов и индекса завершен успешно!")
+    if SHARD_BY == "none":
+        paths = _artifact_paths(out_dir)
+        print(f"   - Эмбеддинги: {paths['embeddings']}")
+        print(f"   - Данные чанков: {paths['chunks']}")
+        print(f"   - Индекс метаданных: {paths['metadata_index']}")
+        print(f"   - FAISS Индекс: {paths['faiss_index']}")
+        print(f"   - Метаданные индекса: {paths['index_meta']}")
+    else:
+        print(f"   - Шарды: {os.path.join(out_dir, SHARDS_DIRNAME)} (список: {os.path.join(out_dir, 'shards.json')})")
+    print("-" * 60)
 
-    print(f"🛠️ Создание FAISS индекса (IndexFlatIP) с размерностью {embedding_dim}...")
+def _rebuild_index_in(source_dir: str, target_dir: str) -> bool:
+    """Переносит эмбеддинги, чанки и индекс метаданных из source_dir в target_dir и строит там новый индекс."""
+    paths = _artifact_paths(target_dir)
     try:
-        index = faiss.IndexFlatIP(embedding_dim)
-        # Добавляем проверки перед добавлением векторов
-        if embeddings.flags['C_CONTIGUOUS']:
-             index.add(embeddings.astype(np.float32))
-        else:
-             print("⚠️ Предупреждение: Массив эмбеддингов не C-contiguous. Создается копия.")
-             embeddings_contiguous = np.ascontiguousarray(embeddings.astype(np.float32))
-             index.add(embeddings_contiguous)
+        _link_artifacts(source_dir, target_dir, include_index=False)
+        if not os.path.exists(paths["chunks"]):
+            # Старый формат (indexed_chunks.json) конвертируется в хранилище при пересборке
+            write_chunk_store(paths["chunks"], _with_features(load_chunks_json(os.path.join(source_dir, LEGACY_CHUNKS_FILENAME))))
+        embeddings_path = paths["embeddings"]
+        if not os.path.exists(embeddings_path):
+            embeddings_path = os.path.join(target_dir, LEGACY_EMBEDDINGS_FILENAME)
+        matrix = load_embeddings(embeddings_path, mmap=True)
+    except Exception as e:
+        sys.stderr.write(f"❌ Ошибка при подготовке артефактов из {source_dir}: {e}\n")
+        traceback.print_exc()
+        return False
 
-        print(f"📊 FAISS индекс создан. Количество векторов в индексе: {index.ntotal}")
+    if matrix is None or matrix.count == 0:
+        sys.stderr.write("❌ Ошибка: Нет сохраненных эмбеддингов для пересборки индекса. Запустите run_embedder.py без флагов.\n")
+        return False
+    print(f"📊 Эмбеддинги: {matrix.count} x {matrix.dim} ({matrix.dtype}, модель: {matrix.model_name or 'N/A'})")
+    if matrix.model_name and matrix.model_name != MODEL_NAME:
+        print(f"⚠️ Предупреждение: Эмбеддинги созданы моделью '{matrix.model_name}', текущая модель — '{MODEL_NAME}'.")
+    return _build_and_save_index(matrix, target_dir)
 
-        print(f"💾 Сохранение FAISS индекса в {FAISS_INDEX_PATH}...")
-        faiss.write_index(index, FAISS_INDEX_PATH)
-        print("✅ FAISS индекс успешно сохранен.")
+def rebuild_index_from_embeddings(only_shards: Optional[List[str]] = None):
+    """
+    Пересобирает FAISS индекс из эмбеддингов активной версии без повторного эмбеддинга.
+    Результат — новая версия: эмбеддинги, чанки и индекс метаданных переносятся жесткими ссылками,
+    индекс строится заново. Файл эмбеддингов отображается в память и читается батчами.
+    Для шардированной версии only_shards ограничивает пересборку указанными шардами
+    (индексы остальных переносятся без изменений).
+    """
+    current = read_current_version()
+    if current is None:
+        sys.stderr.write("❌ Ошибка: Нет активной версии индекса для пересборки. Запустите run_embedder.py без флагов.\n")
+        return
+    source_dir = version_dir(current)
+    manifest = read_shard_manifest(source_dir)
+    if manifest is not None and only_shards:
+        unknown = set(only_shards) - {shard["name"] for shard in manifest.get("shards", [])}
+        if unknown:
+            sys.stderr.write(f"❌ Ошибка: Шарды не найдены в версии {current}: {', '.join(sorted(unknown))}\n")
+            return
+    elif manifest is None and only_shards:
+        print("⚠️ Активная версия не шардирована, флаг --shards игнорируется.")
+    print("-" * 60)
+    print(f"🔁 Пересборка FAISS индекса из версии {current} ({source_dir})...")
 
+    version = create_version_dir()
+    target_dir = version_dir(version)
+    try:
+        if manifest is None:
+            rebuilt = _rebuild_index_in(source_dir, target_dir)
+        else:
+            rebuilt = True
+            for shard in manifest.get("shards", []):
+                shard_source = os.path.join(source_dir, shard["dir"])
+                shard_target = os.path.join(target_dir, shard["dir"])
+                os.makedirs(shard_target, exist_ok=True)
+                if only_shards and shard["name"] not in only_shards:
+                    _link_artifacts(shard_source, shard_target)
+                    continue
+                print(f"🧩 Шард '{shard['name']}'...")
+                if not _rebuild_index_in(shard_source, shard_target):
+                    rebuilt = False
+                    break
+            if rebuilt:
+                write_shard_manifest(target_dir, manifest)
     except Exception as e:
-        sys.stderr.write(f"❌ Ошибка при создании или сохранении FAISS индекса: {e}\n")
+        sys.stderr.write(f"❌ Ошибка при подготовке новой версии из {current}: {e}\n")
         traceback.print_exc()
+        rebuilt = False
+    if not rebuilt:
+        _discard(version)
         return
+    _publish(version)
 
+def run_projection_evaluation(dims_arg: str):
+    """
+    Печатает recall@10 индексов с проекцией до каждой из размерностей dims_arg ("128,256,384")
+    относительно полного IndexFlatIP — чтобы выбрать допустимую EMBEDDER_PROJECTION_DIM.
+    """
+    projection_type = PROJECTION_TYPE if PROJECTION_TYPE != "none" else "pca"
+    try:
+        dims = [int(d) for d in dims_arg.split(",") if d.strip()]
+    except ValueError:
+        sys.stderr.write(f"❌ Неверный список размерностей: '{dims_arg}'. Пример: 128,256,384\n")
+        return
+    matrix = load_embeddings(_current_embeddings_path(), mmap=True)
+    if matrix is None or matrix.count == 0:
+        sys.stderr.write("❌ Ошибка: Нет сохраненных эмбеддингов для оценки. Запустите run_embedder.py без флагов.\n")
+        return
     print("-" * 60)
-    print("🎉 Процесс создания эмбеддингов и индекса завершен успешно!")
-    print(f"   - Эмбеддинги: {EMBEDDINGS_PATH}")
-    print(f"   - Данные чанков: {INDEXED_CHUNKS_PATH}")
-    print(f"   - FAISS Индекс: {FAISS_INDEX_PATH}")
+    print(f"🔬 Оценка проекции {projection_type.upper()} ({matrix.count} x {matrix.dim}) для размерностей: {dims}")
+    evaluate_projection_recall(matrix, dims, projection_type)
     print("-" * 60)
 
 if __name__ == "__main__":
-    run_embedding_pipeline()
+    if EMBEDDINGS_DTYPE not in SUPPORTED_DTYPES:
+        sys.stderr.write(f"❌ Неверное значение EMBEDDINGS_DTYPE='{EMBEDDINGS_DTYPE}'. Допустимо: {', '.join(SUPPORTED_DTYPES)}\n")
+        sys.exit(1)
+    if PROJECTION_TYPE not in SUPPORTED_PROJECTIONS:
+        sys.stderr.write(f"❌ Неверное значение EMBEDDER_PROJECTION='{PROJECTION_TYPE}'. Допустимо: {', '.join(SUPPORTED_PROJECTIONS)}\n")
+        sys.exit(1)
+    if INDEX_TYPE not in SUPPORTED_INDEX_TYPES:
+        sys.stderr.write(f"❌ Неверное значение EMBEDDER_INDEX_TYPE='{INDEX_TYPE}'. Допустимо: {', '.join(SUPPORTED_INDEX_TYPES)}\n")
+        sys.exit(1)
+    if SHARD_BY not in SUPPORTED_SHARD_KEYS:
+        sys.stderr.write(f"❌ Неверное значение EMBEDDER_SHARD_BY='{SHARD_BY}'. Допустимо: {', '.join(SUPPORTED_SHARD_KEYS)}\n")
+        sys.exit(1)
+    if "--rebuild-index" in sys.argv:
+        shards_arg = None
+        if "--shards" in sys.argv and sys.argv.index("--shards") + 1 < len(sys.argv):
+            shards_arg = [name.strip() for name in sys.argv[sys.argv.index("--shards") + 1].split(",") if name.strip()]
+        rebuild_index_from_embeddings(only_shards=shards_arg)
+    elif "--eval-projection" in sys.argv:
+        arg_pos = sys.argv.index("--eval-projection") + 1
+        run_projection_evaluation(sys.argv[arg_pos] if arg_pos < len(sys.argv) else "128,256,384")
+    else:
+        run_embedding_pipeline(full_rebuild="--full" in sys.argv)
 
 # --- END OF FILE run_embedder.py ---
\ No newline at end of file
@@ -0,0 +1,195 @@
+# --- START OF FILE run_load_test.py ---
+# Сквозной нагрузочный тест обработчика чата (assets/event_handlers.handle_bot_response):
+# запросы из logs/queries.jsonl (или файла с запросами) прогоняются через весь конвейер — эмбеддинг, поиск,
+# ре-ранкинг, сборка контекста, LLM — с заданным числом одновременных запросов.
+# Печатаются p50/p95/p99 по этапам и пропускная способность. По умолчанию LLM — локальная заглушка 'mock'
+# (профиль задержки — LLM_MOCK_* в assistant/llm_client.py), так что тест работает офлайн и не тратит квоту.
+#
+#   python run_load_test.py                                   # 16 одновременных запросов, 200 запросов, mock
+#   python run_load_test.py --concurrency 64 --requests 1000 --no-answer-cache --no-search-cache --no-single-flight
+# Запросы повторяются по кругу: без --no-search-cache / --no-single-flight p95 эмбеддинга и поиска после первого круга —
+# в основном попадания в кэш и объединенные запросы. Лог запросов теста пишется в --query-log-out, а не в рабочий лог.
+#   python run_load_test.py --queries data/queries.txt --llm gemini
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+import numpy as np
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from assets.query_logger import QUERY_LOG_PATH, read_query_log, configure_query_logger
+
+DEFAULT_QUERY_LOG = QUERY_LOG_PATH
+DEFAULT_LOADTEST_QUERY_LOG = os.path.join("logs", "loadtest_queries.jsonl")
+LOADTEST_USER_PREFIX = "loadtest_"
+STAGE_ORDER = ["history_read", "classify", "embed", "search", "rerank", "cross_encoder", "mmr", "answer_cache", "pack_context",
+               "llm_first_token", "llm", "deobfuscate", "history_write", "total"]
+
+def parse_query_log(path: str) -> List[str]:
+    """
+    Вопросы пользователей из лога запросов: logs/queries.jsonl (и сжатые queries.jsonl.N.gz) — поле "message";
+    старый текстовый logs/queries.log — строки '❓ Message: ...'.
+    """
+    if path.endswith((".jsonl", ".gz")):
+        return [str(record["message"]).strip() for record in read_query_log(path) if str(record.get("message", "")).strip()]
+    queries: List[str] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("❓ Message: "):
+                query = line[len("❓ Message: "):].strip()
+                if query:
+                    queries.append(query)
+    return queries
+
+def load_queries(queries_path: Optional[str], log_path: str) -> List[str]:
+    if queries_path:
+        with open(queries_path, "r", encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+        source = queries_path
+    elif os.path.exists(log_path):
+        queries = parse_query_log(log_path)
+        source = log_path
+    else:
+        sys.stderr.write(f"❌ Лог запросов {log_path} не найден. Укажите файл запросов через --queries.\n")
+        sys.exit(1)
+    if not queries:
+        sys.stderr.write(f"❌ В {source} нет запросов.\n")
+        sys.exit(1)
+    print(f"📄 Загружено {len(queries)} запросов из {source}.")
+    return queries
+
+def _print_stats(name: str, values_s: List[float]) -> None:
+    if not values_s:
+        return
+    values_ms = np.asarray(values_s) * 1000.0
+    p50, p95, p99 = np.percentile(values_ms, [50, 95, 99])
+    print(f"   {name:<16} p50 {p50:9.1f} мс | p95 {p95:9.1f} мс | p99 {p99:9.1f} мс | max {values_ms.max():9.1f} мс | n={len(values_ms)}")
+
+async def run_load_test(queries: List[str], concurrency: int, total_requests: int, llm_choice: str,
+                        safe_mode: bool, obfuscation_map: Dict[str, str], warmup: int) -> None:
+    from assets.event_handlers import handle_bot_response, add_stage_listener, remove_stage_listener
+    from assets.history_store import get_history_store
+    from assistant.llm_client import is_llm_error_answer
+
+    timings: Dict[str, List[float]] = {}
+    timings_lock = threading.Lock()
+    recording = False
+
+    def on_stage(stage: str, seconds: float) -> None:
+        if recording:
+            with timings_lock:
+                timings.setdefault(stage, []).append(seconds)
+
+    app_state = {"llm_choice": llm_choice, "safe_mode": safe_mode, "obfuscation_map": obfuscation_map}
+    errors = 0
+    next_request = 0
+    usernames = [f"{LOADTEST_USER_PREFIX}{worker}" for worker in range(concurrency)]
+
+    async def one_request(query: str, username: str) -> None:
+        nonlocal errors
+        history = [[query, None]]
+        started = time.perf_counter()
+        first_update = None
+        async for _ in handle_bot_response(history, SimpleNamespace(username=username), app_state):
+            if first_update is None and history[-1][1]:
+                first_update = time.perf_counter() - started
+        answer = history[-1][1] or ""
+        if recording:
+            with timings_lock:
+                timings.setdefault("request", []).append(time.perf_counter() - started)
+                if first_update is not None:
+                    timings.setdefault("first_update", []).append(first_update)
+                if is_llm_error_answer(answer) or answer == "Внутренняя ошибка.":
+                    errors += 1
+
+    async def worker(worker_id: int) -> None:
+        nonlocal next_request
+        while next_request < total_requests:
+            index = next_request
+            next_request += 1
+            await one_request(queries[index % len(queries)], usernames[worker_id])
+
+    add_stage_listener(on_stage)
+    try:
+        for i in range(warmup): # Прогрев: модель эмбеддингов, индекс, клиенты LLM
+            await one_request(queries[i % len(queries)], usernames[0])
+        recording = True
+        print("-" * 70)
+        print(f"🏁 Нагрузочный тест: {total_requests} запросов, одновременно {concurrency}, LLM: {llm_choice}, SAFE_MODE: {safe_mode}")
+        wall_started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        wall_seconds = time.perf_counter() - wall_started
+    finally:
+        remove_stage_listener(on_stage)
+        for username in usernames: # История тестовых пользователей не сохраняется
+            get_history_store().clear(username)
+        get_history_store().flush()
+
+    print("📊 Задержки по этапам:")
+    for stage in STAGE_ORDER + sorted(set(timings) - set(STAGE_ORDER) - {"request", "first_update"}):
+        _print_stats(stage, timings.get(stage, []))
+    print("📊 Со стороны клиента:")
+    _print_stats("first_update", timings.get("first_update", []))
+    _print_stats("request", timings.get("request", []))
+    completed = len(timings.get("request", []))
+    print(f"🚀 Пропускная способность: {completed / wall_seconds:.2f} запросов/с ({completed} запросов за {wall_seconds:.2f} с), ошибок: {errors}")
+    try:
+        from assistant.answer_cache import get_answer_cache
+        answer_cache = get_answer_cache()
+        if answer_cache is not None:
+            print(f"💾 Кэш ответов: {answer_cache.stats()}")
+        from assistant.search_engine import get_search_engine
+        print(f"🔍 Кэш результатов поиска: {get_search_engine().cache_stats()}")
+        from assistant.single_flight import single_flight_stats
+        print(f"🤝 Объединение запросов: {single_flight_stats()}")
+        from assistant.llm_policy import get_llm_policy
+        print(f"🛡 Провайдеры LLM: {get_llm_policy().stats()}")
+    except ImportError:
+        pass
+    print("-" * 70)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный тест обработчика чата")
+    parser.add_argument("--concurrency", type=int, default=16, help="Одновременных запросов")
+    parser.add_argument("--requests", type=int, default=200, help="Всего запросов (запросы из лога повторяются по кругу)")
+    parser.add_argument("--queries", help="Файл с запросами (по одному на строку) вместо лога")
+    parser.add_argument("--log", default=DEFAULT_QUERY_LOG, help="Лог запросов приложения")
+    parser.add_argument("--llm", default="mock", choices=["mock", "together", "gemini"], help="LLM (по умолчанию локальная заглушка)")
+    parser.add_argument("--safe-mode", action="store_true", help="SAFE_MODE с картой data/output/obfuscation_map.json")
+    parser.add_argument("--no-answer-cache", action="store_true", help="Отключить кэш ответов (каждый запрос идет в LLM)")
+    parser.add_argument("--no-search-cache", action="store_true", help="Отключить кэш результатов поиска (каждый запрос идет в FAISS)")
+    parser.add_argument("--no-single-flight", action="store_true", help="Не объединять одинаковые одновременные запросы")
+    parser.add_argument("--query-log-out", default=DEFAULT_LOADTEST_QUERY_LOG, help="Куда писать лог запросов теста")
+    parser.add_argument("--warmup", type=int, default=1, help="Запросов прогрева (не входят в статистику)")
+    args = parser.parse_args()
+
+    # До импорта обработчика и движка поиска: настройки читаются при импорте
+    if args.no_answer_cache:
+        os.environ["ANSWER_CACHE_ENABLED"] = "0"
+    if args.no_search_cache:
+        os.environ["SEARCH_RESULT_CACHE_SIZE"] = "0"
+    if args.no_single_flight:
+        os.environ["SINGLE_FLIGHT_ENABLED"] = "0"
+    queries = load_queries(args.queries, args.log)
+    if os.path.abspath(args.query_log_out) == os.path.abspath(args.log):
+        sys.stderr.write(f"❌ --query-log-out совпадает с логом, из которого берутся запросы ({args.log}).\n")
+        sys.exit(1)
+    configure_query_logger(args.query_log_out)
+    print(f"📝 Лог запросов теста: {args.query_log_out}")
+
+    from assistant.embedder import configure_torch_threads
+    from assistant.search_engine import initialize_search_engine
+    configure_torch_threads()
+    initialize_search_engine()
+    obfuscation_map: Dict[str, str] = {}
+    if args.safe_mode:
+        from encryptor_tools import load_map
+        obfuscation_map = load_map("data/output/obfuscation_map.json")
+    asyncio.run(run_load_test(queries, max(1, args.concurrency), max(1, args.requests), args.llm,
+                              args.safe_mode, obfuscation_map, max(0, args.warmup)))
+
+# --- END OF FILE run_load_test.py ---
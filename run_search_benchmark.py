@@ -0,0 +1,128 @@
+# --- START OF FILE run_search_benchmark.py ---
+# Нагрузочный тест поиска: N пользователей одновременно отправляют запросы,
+# печатаются задержки p50/p95/p99 по этапам (эмбеддинг запроса, FAISS поиск) и пропускная способность.
+#
+#   python run_search_benchmark.py                       # 16 пользователей, эмбеддинг + поиск
+#   python run_search_benchmark.py --search-only         # только FAISS поиск (случайные векторы, без модели)
+#   python run_search_benchmark.py --faiss-threads 2 --max-concurrency 4 --users 32
+#   python run_search_benchmark.py --result-cache        # с кэшем результатов поиска (как в приложении)
+# Кэш результатов по умолчанию выключен: запросы повторяются по кругу, и с кэшем замерялись бы попадания в LRU, а не FAISS.
+
+import os
+import sys
+import time
+import argparse
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from assistant.search_engine import SearchEngine, FAISS_THREADS, MAX_CONCURRENT_SEARCHES, RESULT_CACHE_SIZE
+
+DEFAULT_QUERIES = [
+    "SLA для VIP акций в KZ",
+    "Кто отвечает за запуск акций с CashBack?",
+    "Ссылка на форму Inbox 360",
+    "Какие этапы у Promo процесса?",
+]
+
+def _load_queries(path: Optional[str]) -> List[str]:
+    if not path:
+        return DEFAULT_QUERIES
+    with open(path, "r", encoding="utf-8") as f:
+        queries = [line.strip() for line in f if line.strip()]
+    if not queries:
+        sys.stderr.write(f"❌ Файл запросов {path} пуст.\n")
+        sys.exit(1)
+    return queries
+
+def _print_stats(name: str, values_ms: List[float]) -> None:
+    if not values_ms:
+        return
+    p50, p95, p99 = np.percentile(values_ms, [50, 95, 99])
+    print(f"   {name:<8} p50 {p50:8.1f} мс | p95 {p95:8.1f} мс | p99 {p99:8.1f} мс | max {max(values_ms):8.1f} мс")
+
+def run_benchmark(users: int, requests_per_user: int, top_k: int, queries: List[str], search_only: bool,
+                  faiss_threads: int, max_concurrency: int, result_cache: bool = False) -> None:
+    engine = SearchEngine(faiss_threads=faiss_threads, max_concurrent_searches=max_concurrency, watch_interval=0,
+                          result_cache_size=RESULT_CACHE_SIZE if result_cache else 0)
+    if not engine.ensure_initialized():
+        sys.stderr.write("❌ Индекс не загружен. Запустите run_embedder.py.\n")
+        sys.exit(1)
+
+    embed_query = None
+    query_vectors = None
+    if search_only:
+        # Случайные нормализованные векторы: нагрузка на FAISS без модели эмбеддингов
+        dim = engine.get_index_dimension()
+        query_vectors = np.random.default_rng(0).standard_normal((max(len(queries), 64), dim)).astype(np.float32)
+        query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    else:
+        from assistant.embedder import embed_query, configure_torch_threads
+        configure_torch_threads()
+        embed_query(queries[0]) # Прогрев модели
+
+    timings: Dict[str, List[float]] = {"embed": [], "search": [], "total": []}
+    timings_lock = threading.Lock()
+    errors = 0
+    start_barrier = threading.Barrier(users)
+
+    def user_session(user_id: int) -> None:
+        nonlocal errors
+        start_barrier.wait() # Все пользователи стартуют одновременно
+        for i in range(requests_per_user):
+            request_started = time.perf_counter()
+            if search_only:
+                vector = query_vectors[(user_id * requests_per_user + i) % len(query_vectors)]
+                embed_ms = 0.0
+            else:
+                vector = embed_query(queries[(user_id + i) % len(queries)])
+                embed_ms = (time.perf_counter() - request_started) * 1000
+            search_started = time.perf_counter()
+            results = engine.search(vector, top_k=top_k) if vector is not None else []
+            search_ms = (time.perf_counter() - search_started) * 1000
+            with timings_lock:
+                if not results:
+                    errors += 1
+                if not search_only:
+                    timings["embed"].append(embed_ms)
+                timings["search"].append(search_ms)
+                timings["total"].append((time.perf_counter() - request_started) * 1000)
+
+    print("-" * 60)
+    print(f"🏁 Бенчмарк поиска: {users} пользователей x {requests_per_user} запросов, top_k={top_k}, "
+          f"режим: {'только поиск' if search_only else 'эмбеддинг + поиск'}")
+    print(f"   Версия индекса: {engine.get_index_version()}, FAISS потоков на запрос: {engine.faiss_threads}, "
+          f"одновременных поисков: {engine.max_concurrent_searches}, ядер: {os.cpu_count()}, "
+          f"кэш результатов: {'вкл' if result_cache else 'выкл'}")
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        list(executor.map(user_session, range(users)))
+    wall_seconds = time.perf_counter() - wall_started
+
+    print("📊 Задержки:")
+    _print_stats("embed", timings["embed"])
+    _print_stats("search", timings["search"])
+    _print_stats("total", timings["total"])
+    print(f"🚀 Пропускная способность: {len(timings['total']) / wall_seconds:.1f} запросов/с "
+          f"({len(timings['total'])} запросов за {wall_seconds:.2f} с), пустых ответов: {errors}")
+    if result_cache:
+        print(f"💾 Кэш результатов: {engine.cache_stats()}")
+    print("-" * 60)
+    engine.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест семантического поиска")
+    parser.add_argument("--users", type=int, default=16, help="Число одновременных пользователей")
+    parser.add_argument("--requests", type=int, default=20, help="Запросов на пользователя")
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--queries", help="Файл с запросами (по одному на строку)")
+    parser.add_argument("--search-only", action="store_true", help="Без модели эмбеддингов: случайные векторы запросов")
+    parser.add_argument("--faiss-threads", type=int, default=FAISS_THREADS)
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENT_SEARCHES)
+    parser.add_argument("--result-cache", action="store_true", help="Включить кэш результатов поиска (по умолчанию выключен)")
+    args = parser.parse_args()
+    run_benchmark(args.users, args.requests, args.top_k, _load_queries(args.queries), args.search_only,
+                  args.faiss_threads, args.max_concurrency, args.result_cache)
+
+# --- END OF FILE run_search_benchmark.py ---
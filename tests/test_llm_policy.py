@@ -0,0 +1,230 @@
+# --- START OF FILE tests/test_llm_policy.py ---
+# Политика вызова LLM (assistant/llm_policy.py) с локальными заглушками провайдеров и заданной задержкой:
+# хеджирование по p95, переключение после повторов, выключатель, таймауты, отмена и закрытие проигравших.
+
+import time
+import asyncio
+from typing import Optional, Sequence
+
+from assistant.llm_client import LLM_EMPTY_ANSWER_MESSAGE
+from assistant.llm_policy import CircuitBreaker, LLMPolicy, LLMProvider
+
+class FakeProvider:
+    """Заглушка провайдера: задержка до первого фрагмента и между фрагментами, ошибка API, учет вызовов и закрытий."""
+
+    def __init__(self, name: str, chunks: Sequence[str] = ("Ответ", " готов."), first_delay_s: float = 0.0,
+                 chunk_delay_s: float = 0.0, error: Optional[str] = None):
+        self.name = name
+        self.chunks = list(chunks)
+        self.first_delay_s = first_delay_s
+        self.chunk_delay_s = chunk_delay_s
+        self.error = error # Текст исключения API на каждой попытке
+        self.calls = 0
+        self.cancelled = 0
+        self.closed = 0
+
+    async def stream(self, prompt: str, system_prompt: str):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.first_delay_s)
+            if self.error:
+                raise RuntimeError(self.error)
+            for i, chunk in enumerate(self.chunks):
+                if i:
+                    await asyncio.sleep(self.chunk_delay_s)
+                yield chunk
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.closed += 1
+
+    def provider(self) -> LLMProvider:
+        return LLMProvider(self.name, self.stream)
+
+def make_policy(*fakes: FakeProvider, **overrides) -> LLMPolicy:
+    params = dict(first_token_timeout_s=2.0, idle_timeout_s=2.0, max_retries=2, retry_base_delay_s=0.0, retry_max_delay_s=0.0,
+                  hedging=False, hedge_default_delay_s=5.0, hedge_min_delay_s=0.0, hedge_min_samples=1,
+                  breaker_failures=5, breaker_cooldown_s=30.0)
+    params.update(overrides)
+    return LLMPolicy({fake.name: fake.provider() for fake in fakes}, **params)
+
+def ask(policy: LLMPolicy, llm_choice: str) -> str:
+    return asyncio.run(policy.ask(llm_choice, "prompt", "system"))
+
+# --- Хеджирование ---
+def test_hedge_fires_after_p95_delay_and_wins():
+    slow, fast = FakeProvider("together", ("медленный",), first_delay_s=2.0), FakeProvider("gemini", ("быстрый",))
+    policy = make_policy(slow, fast, hedging=True)
+    policy._states["together"].first_token_s.extend([0.05] * 20) # p95 основного — 50 мс
+    started = time.perf_counter()
+    assert ask(policy, "together") == "быстрый"
+    assert time.perf_counter() - started < 1.0
+    stats = policy.stats()
+    assert stats["gemini"]["hedges"] == 1 and stats["gemini"]["wins"] == 1
+    assert stats["together"]["wins"] == 0
+
+def test_no_hedge_before_p95_delay():
+    primary, backup = FakeProvider("together", ("основной",), first_delay_s=0.02), FakeProvider("gemini", ("резерв",))
+    policy = make_policy(primary, backup, hedging=True)
+    policy._states["together"].first_token_s.extend([0.5] * 20)
+    assert ask(policy, "together") == "основной"
+    assert backup.calls == 0 and policy.stats()["gemini"]["hedges"] == 0
+
+def test_hedge_uses_default_delay_without_latency_samples():
+    primary, backup = FakeProvider("together", ("основной",), first_delay_s=0.3), FakeProvider("gemini", ("резерв",))
+    policy = make_policy(primary, backup, hedging=True, hedge_min_samples=20, hedge_default_delay_s=1.0)
+    assert ask(policy, "together") == "основной"
+    assert backup.calls == 0
+
+# --- Повторы и переключение ---
+def test_failover_after_retries():
+    broken, backup = FakeProvider("together", error="503 Service Unavailable"), FakeProvider("gemini", ("резерв",))
+    policy = make_policy(broken, backup, max_retries=2)
+    assert ask(policy, "together") == "резерв"
+    assert broken.calls == 3 # Первая попытка + 2 повтора
+    assert policy.stats()["together"]["failures"] == 3
+    assert backup.calls == 1
+
+def test_retry_succeeds_on_same_provider():
+    flaky, backup = FakeProvider("together", ("со второй попытки",)), FakeProvider("gemini", ("резерв",))
+    original_stream = flaky.stream
+
+    def fail_once(prompt, system_prompt):
+        flaky.error = "timeout" if flaky.calls == 0 else None
+        return original_stream(prompt, system_prompt)
+
+    policy = LLMPolicy({"together": LLMProvider("together", fail_once), "gemini": backup.provider()}, max_retries=2,
+                       retry_base_delay_s=0.0, retry_max_delay_s=0.0, hedging=False)
+    assert ask(policy, "together") == "со второй попытки"
+    assert flaky.calls == 2 and backup.calls == 0
+
+def test_all_providers_failing_returns_error_answer():
+    first, second = FakeProvider("together", error="500"), FakeProvider("gemini", error="500")
+    answer = ask(make_policy(first, second, max_retries=1), "together")
+    assert answer.startswith("Ошибка:")
+    assert first.calls == 2 and second.calls == 2
+
+# --- Детерминированные ответы ---
+def test_safety_block_is_returned_without_retry_or_failover():
+    block = "Ответ не может быть сгенерирован из-за ограничений безопасности (Причина: SAFETY). Попробуйте переформулировать запрос."
+    blocked, backup = FakeProvider("gemini", (block,)), FakeProvider("together", ("обход",))
+    policy = make_policy(blocked, backup, breaker_failures=1)
+    assert ask(policy, "gemini") == block
+    assert blocked.calls == 1 and backup.calls == 0
+    assert policy.stats()["gemini"]["failures"] == 0 and policy.stats()["gemini"]["breaker"] == "closed"
+
+def test_empty_stream_is_returned_without_retry_or_failover():
+    empty, backup = FakeProvider("gemini", ()), FakeProvider("together", ("обход",))
+    policy = make_policy(empty, backup)
+    assert ask(policy, "gemini") == LLM_EMPTY_ANSWER_MESSAGE
+    assert empty.calls == 1 and backup.calls == 0
+
+def test_transient_error_answer_is_retried():
+    transient = FakeProvider("together", ("Произошла ошибка при обращении к языковой модели Together AI: 429",))
+    backup = FakeProvider("gemini", ("резерв",))
+    policy = make_policy(transient, backup, max_retries=1)
+    assert ask(policy, "together") == "резерв"
+    assert transient.calls == 2
+
+# --- Выключатель ---
+def test_breaker_opens_after_consecutive_failures_and_skips_provider():
+    broken, backup = FakeProvider("together", error="500"), FakeProvider("gemini", ("резерв",))
+    policy = make_policy(broken, backup, max_retries=1, breaker_failures=2, breaker_cooldown_s=30.0)
+    assert ask(policy, "together") == "резерв"
+    assert policy.stats()["together"]["breaker"] == "open"
+    calls_before = broken.calls
+    assert ask(policy, "together") == "резерв"
+    assert broken.calls == calls_before # Разомкнутый провайдер не вызывается
+
+def test_breaker_half_open_allows_single_trial():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown_s=0.05)
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    assert breaker.allow() # Одна пробная попытка
+    assert not breaker.allow() # Остальные ждут ее результата
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+def test_breaker_failed_trial_reopens():
+    breaker = CircuitBreaker(failure_threshold=3, cooldown_s=0.05)
+    for _ in range(3):
+        breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.record_failure() is False # Уже был разомкнут — повторное размыкание не новое событие
+    assert breaker.state == "open" and not breaker.allow()
+
+def test_provider_recovers_through_half_open_trial():
+    provider, backup = FakeProvider("together", error="500"), FakeProvider("gemini", ("резерв",))
+    policy = make_policy(provider, backup, max_retries=0, breaker_failures=1, breaker_cooldown_s=0.05)
+    assert ask(policy, "together") == "резерв"
+    assert policy.stats()["together"]["breaker"] == "open"
+    time.sleep(0.06)
+    provider.error = None
+    provider.chunks = ["восстановился"]
+    assert ask(policy, "together") == "восстановился"
+    assert policy.stats()["together"]["breaker"] == "closed"
+
+# --- Таймауты ---
+def test_first_fragment_timeout():
+    silent = FakeProvider("together", ("поздно",), first_delay_s=5.0)
+    policy = make_policy(silent, first_token_timeout_s=0.05, max_retries=1)
+    started = time.perf_counter()
+    answer = ask(policy, "together")
+    assert answer.startswith("Ошибка:") and "нет ответа" in answer
+    assert time.perf_counter() - started < 1.0
+    assert silent.calls == 2 and silent.cancelled == 2 and silent.closed == 2
+
+def test_first_fragment_timeout_fails_over():
+    silent, backup = FakeProvider("together", first_delay_s=5.0), FakeProvider("gemini", ("резерв",))
+    policy = make_policy(silent, backup, first_token_timeout_s=0.05, max_retries=0)
+    assert ask(policy, "together") == "резерв"
+
+def test_idle_timeout_interrupts_stream():
+    stalled = FakeProvider("together", ("начало", " конец"), chunk_delay_s=5.0)
+    policy = make_policy(stalled, idle_timeout_s=0.05)
+    started = time.perf_counter()
+    answer = ask(policy, "together")
+    assert answer.startswith("начало") and "ответ прерван по таймауту" in answer and "конец" not in answer
+    assert time.perf_counter() - started < 1.0
+    assert stalled.closed == 1
+
+# --- Проигравшие ---
+def test_hedge_loser_is_cancelled_and_closed():
+    slow, fast = FakeProvider("together", ("медленный",), first_delay_s=2.0), FakeProvider("gemini", ("быстрый",))
+    policy = make_policy(slow, fast, hedging=True, hedge_default_delay_s=0.05, hedge_min_samples=20)
+    assert ask(policy, "together") == "быстрый"
+    assert slow.calls == 1 and slow.cancelled == 1 and slow.closed == 1
+    assert policy.stats()["together"]["failures"] == 0 # Отмена проигравшего — не ошибка провайдера
+
+def test_loser_with_opened_stream_is_closed():
+    # Оба провайдера успевают выдать первый фрагмент почти одновременно: победитель один, поток второго закрывается
+    first, second = FakeProvider("together", ("первый", " хвост"), first_delay_s=0.1), FakeProvider("gemini", ("второй", " хвост"), first_delay_s=0.1)
+
+    async def run():
+        policy = make_policy(first, second, hedging=True, hedge_default_delay_s=0.0, hedge_min_samples=20)
+        answer = await policy.ask("together", "prompt", "system")
+        await asyncio.sleep(0) # Закрытие проигравшего завершается до выхода из ask
+        return answer
+
+    answer = asyncio.run(run())
+    assert answer in ("первый хвост", "второй хвост")
+    assert first.closed == 1 and second.closed == 1
+
+def test_stream_closed_when_consumer_stops_early():
+    provider = FakeProvider("together", ("раз", "два", "три"), chunk_delay_s=0.01)
+    policy = make_policy(provider)
+
+    async def run():
+        stream = policy.stream("together", "prompt", "system")
+        first = await stream.__anext__()
+        await stream.aclose()
+        return first
+
+    assert asyncio.run(run()) == "раз"
+    assert provider.closed == 1
+
+# --- END OF FILE tests/test_llm_policy.py ---